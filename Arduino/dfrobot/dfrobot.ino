@@ -1,6 +1,14 @@
 #include <Wire.h>
 #include <Servo.h>
 #define SLAVE_ADDRESS 0x04
+#define I2C_FRAME_MARKER 0xA5     // Register byte of a framed command.
+#define I2C_REGISTER_CONSUMED 1   // Register to read the sequence number of the last command handled by loop().
+#define I2C_REGISTER_TELEMETRY 2  // Register to read the telemetry block, see updateTelemetry().
+#define I2C_REGISTER_PENDING 3    // Register to read if a command is received which loop() did not take over yet.
+#define I2C_TELEMETRY_SIZE 7
+#define I2C_MAX_PARAMETERS 10
+#define I2C_BUFFER_SIZE 32        // Size of the receive buffer of the Wire library.
+#define EXT_POWER_CONNECTED_LEVEL 100  // External power level [0..1023] above which external power is connected.
 
 //This motor shield use Pin 6,5,7,4 to control the motor
 // Simply connect your motors to M1+,M1-,M2+,M2-
@@ -19,36 +27,140 @@ int EXT_POWER_SWITCH_PIN = 2;
 int LIGHT_PIN = 3;
 int SERVO_CAMERA_PIN = 8;
 
-int i2cCommand = 0;         // global variable for receiving command from I2C
-int i2cParameters[10];      // global array for receiving parameters from I2C
-int i2cParameterCount = 0;  // global variable for keeping I2C parameter count
-int i2cDataByteToSend = 0;  // global variable to send back over I2C in receiveData() callback fucntion.
+// The variables below are written by the receiveData() interrupt callback, so they are volatile.
+volatile int i2cCommand = 0;         // global variable for receiving command from I2C
+volatile int i2cParameters[I2C_MAX_PARAMETERS];  // global array for receiving parameters from I2C
+volatile int i2cParameterCount = 0;  // global variable for keeping I2C parameter count
+volatile byte i2cCommandSeq = 0;     // sequence number of the received command
+volatile byte i2cConsumedSeq = 0;    // sequence number of the last command handled by loop(), read by the Raspberry
+volatile int i2cFrameErrors = 0;     // number of framed commands dropped because of a wrong length or checksum, or because a command was pending
+volatile boolean i2cStopReceived = false;  // a stop is handled by receiveData(), loop() still has to end the drive and turn in progress
+volatile boolean i2cStopConsumed = false;  // a stop is consumed by receiveData() after loop() took over its command
+volatile int i2cReadRegister = I2C_REGISTER_CONSUMED;  // register of the next read
+volatile byte i2cTelemetry[I2C_TELEMETRY_SIZE];  // telemetry block sent back over I2C in the sendData() callback function
 
 Servo myServo;  // create servo camera object to control a servo
 int servoCameraPos;   // variable to store the servo camera position
 
+boolean extPowerAvailable = false;
+unsigned long lastTimeWithoutExternalPowerMillis = 0; // Last time without external power in millis.
+
+// State of the drive and turn of command 1. The turn and the drive are timed with millis() instead of delay(),
+// so loop() keeps taking over I2C commands while the robot moves, see updateMotion().
+#define MOTION_IDLE 0
+#define MOTION_SWITCH_POWER 1   // Waiting until the switch from external power to the batteries is done.
+#define MOTION_TURN 2
+#define MOTION_DRIVE 3
+int motionState = MOTION_IDLE;
+unsigned long motionStateStartMillis = 0;
+unsigned long motionStateDuration = 0;
+boolean motionBackward = false;
+int motionSpeedStraight = 0;  // [0..255]
+int motionSpeedTurn = 0;      // [-252..252]
+int motionDelayDrive = 0;     // ms, 0 means infinite
+int motionDelayTurn = 0;      // ms, 0 means infinite
+
 // callback for received data
+// A command comes in one transaction: I2C_FRAME_MARKER, sequence number, command, number of parameters, parameters, checksum.
+// The sum of the bytes from the sequence number up to and including the checksum is 0 modulo 256.
+// A read starts with a write of only the register to read, see sendData().
 void receiveData(int byteCount)
 {
-  int i2cData;
+  int i2cData[I2C_BUFFER_SIZE];
+  int n = 0;
   while (Wire.available()) {
-    i2cData = Wire.read();
+    int b = Wire.read();
+    if (n < I2C_BUFFER_SIZE) {
+      i2cData[n++] = b;
+    }
   }
-  // All values below 128 are commands, else it is a parameter.
-  if (i2cData < 128) {
-    // New command so reset parameter count.
-    i2cParameterCount = 0;
-    i2cCommand = i2cData;
+  if (n == 1) {
+    i2cReadRegister = i2cData[0];
+    return;
   }
-  else {
-    i2cParameters[i2cParameterCount++] = i2cData;
+  if (n == 0 || i2cData[0] != I2C_FRAME_MARKER) {
+    return;
+  }
+  int length = n >= 5 ? i2cData[3] : -1;
+  byte checksum = 0;
+  for (int i = 1; i < n; i++) {
+    checksum += i2cData[i];
+  }
+  if (length < 0 || length > I2C_MAX_PARAMETERS || n != length + 5 || checksum != 0) {
+    // Incomplete or corrupted frame, drop it. Its sequence number is never consumed, so the Raspberry notices.
+    i2cFrameErrors++;
+    return;
+  }
+  // A stop, command 1 with both speeds zero, is handled at once, also while loop() is busy or a command is pending.
+  // It replaces a pending drive and turn.
+  if (i2cData[2] == 1 && length == 4 && i2cData[4] == 192 && i2cData[5] == 192) {
+    Motor1(0, false);
+    Motor2(0, false);
+    i2cStopReceived = true;
+    if (i2cCommand == 1) {
+      i2cCommand = 0;
+    }
+    i2cConsumedSeq = i2cData[1];
+    i2cStopConsumed = true;
+    return;
+  }
+  // Do not overwrite a command which loop() did not take over yet. This frame is dropped, its sequence number is
+  // never consumed, so the Raspberry notices.
+  if (i2cCommand != 0) {
+    i2cFrameErrors++;
+    return;
   }
+  // The complete command is taken over at once, so it can not be mixed up with another command.
+  for (int i = 0; i < length; i++) {
+    i2cParameters[i] = i2cData[4 + i];
+  }
+  i2cParameterCount = length;
+  i2cCommandSeq = i2cData[1];
+  i2cCommand = i2cData[2];
 }
 
 // callback for sending data
+// The Raspberry polls I2C_REGISTER_CONSUMED after every command until loop() handled the command,
+// so it does not overwrite a command which is not handled yet.
 void sendData()
 {
-  Wire.write(i2cDataByteToSend); // Send data back over I2C.
+  if (i2cReadRegister == I2C_REGISTER_TELEMETRY) {
+    Wire.write((byte *)i2cTelemetry, I2C_TELEMETRY_SIZE); // Send the telemetry block back over I2C.
+  }
+  else if (i2cReadRegister == I2C_REGISTER_PENDING) {
+    Wire.write(i2cCommand != 0 ? 1 : 0);
+  }
+  else {
+    Wire.write(i2cConsumedSeq);
+  }
+}
+
+// Update the telemetry block which the Raspberry reads in one transaction from I2C_REGISTER_TELEMETRY:
+//   0, 1: external power level [0..1023], high byte first.
+//   2, 3: internal power level [0..1023], high byte first. This power level can be from external power or the batteries.
+//   4:    flags, bit 0: external power connected, the batteries are charging. Bit 1: switched to external power.
+//   5:    number of dropped frames modulo 256.
+//   6:    checksum, the sum of all bytes is 0 modulo 256.
+// The block is updated with the interrupts disabled, so a read never gets values of two different loops.
+void updateTelemetry(int extPowerLevel, int intPowerLevel, boolean isCharging, boolean extPowerAvailable)
+{
+  byte telemetry[I2C_TELEMETRY_SIZE];
+  byte checksum = 0;
+  telemetry[0] = extPowerLevel >> 8;
+  telemetry[1] = extPowerLevel & 0xFF;
+  telemetry[2] = intPowerLevel >> 8;
+  telemetry[3] = intPowerLevel & 0xFF;
+  telemetry[4] = (isCharging ? 1 : 0) | (extPowerAvailable ? 2 : 0);
+  noInterrupts();
+  telemetry[5] = i2cFrameErrors & 0xFF;
+  for (int i = 0; i < I2C_TELEMETRY_SIZE - 1; i++) {
+    checksum += telemetry[i];
+  }
+  telemetry[I2C_TELEMETRY_SIZE - 1] = -checksum;
+  for (int i = 0; i < I2C_TELEMETRY_SIZE; i++) {
+    i2cTelemetry[i] = telemetry[i];
+  }
+  interrupts();
 }
 
 // Left motor.
@@ -79,6 +191,83 @@ void Motor2(int pwm, boolean reverse)
   }
 }
 
+void setMotionState(int state, unsigned long duration)
+{
+  motionState = state;
+  motionStateStartMillis = millis();
+  motionStateDuration = duration;
+}
+
+// Start the turn of command 1, or the drive when there is no turn.
+void startTurn()
+{
+  if (motionSpeedTurn != 0) {
+    int speed1 = motionSpeedStraight + motionSpeedTurn;
+    int speed2 = motionSpeedStraight - motionSpeedTurn;
+    // Because of speedTurn it can now be that one of the speeds is above 255 or below 0.
+    // In this case we shift both speeds back into the [0..255] range such that we do not have to clip the speeds and the difference is still speedTurn.
+    // This way the steering behavior will be the same for all speeds.
+    if (speed1 > 255 || speed2 > 255) {
+      int shift = max(speed1, speed2) - 255;
+      speed1 = speed1 - shift;
+      speed2 = speed2 - shift;
+    }
+    // If speed is negative, we have to inverse the direction.
+    bool dir1 = speed1 >= 0 ? motionBackward : !motionBackward;
+    bool dir2 = speed2 >= 0 ? motionBackward : !motionBackward;
+    Motor1(abs(speed1), dir1);
+    Motor2(abs(speed2), dir2);
+    if (motionDelayTurn != 0) {
+      // Turn temporary, then drive straight, see updateMotion().
+      setMotionState(MOTION_TURN, motionDelayTurn);
+    }
+    else {
+      // Turn infinitely.
+      setMotionState(MOTION_IDLE, 0);
+    }
+  }
+  else {
+    startDrive();
+  }
+}
+
+// Drive straight, for motionDelayDrive ms or infinitely.
+void startDrive()
+{
+  Motor1(motionSpeedStraight, motionBackward);
+  Motor2(motionSpeedStraight, motionBackward);
+  if (motionDelayDrive != 0 && motionSpeedStraight != 0) {
+    // If we have to drive temporary at nonzero speed we have to stop after the drive, see updateMotion().
+    setMotionState(MOTION_DRIVE, motionDelayDrive);
+  }
+  else {
+    setMotionState(MOTION_IDLE, 0);
+  }
+}
+
+// Go to the next state of the drive and turn of command 1 when the time of the current state has passed.
+void updateMotion()
+{
+  if (motionState == MOTION_IDLE || millis() - motionStateStartMillis < motionStateDuration) {
+    return;
+  }
+  switch (motionState)
+  {
+    case MOTION_SWITCH_POWER:
+      lastTimeWithoutExternalPowerMillis = millis();  // To make sure external power is not reconnected if robot drives away slowly.
+      startTurn();
+      break;
+    case MOTION_TURN:
+      startDrive();
+      break;
+    case MOTION_DRIVE:
+      Motor1(0, false);
+      Motor2(0, false);
+      setMotionState(MOTION_IDLE, 0);
+      break;
+  }
+}
+
 void setup()
 {
   pinMode(DIR1, OUTPUT);
@@ -101,8 +290,6 @@ void setup()
 
 void loop()
 {
-  static boolean extPowerAvailable = false;
-  static unsigned long lastTimeWithoutExternalPowerMillis = 0; // Last time without external power in millis.
   int extPowerLevel;  // External power level.
   int intPowerLevel;  // Internal power level.
 
@@ -112,7 +299,7 @@ void loop()
 
   // If external power is available, switch to external power.
   // First check if external power is connected reliably for an amount of time.
-  if (extPowerLevel > 100) {
+  if (extPowerLevel > EXT_POWER_CONNECTED_LEVEL) {
     if (millis() - lastTimeWithoutExternalPowerMillis > 10000) {
       // At least 10 seconds external power available, so switch to external power. The 10 seconds is needed for the robot to park properly in the garage.
       digitalWrite(EXT_POWER_SWITCH_PIN, HIGH);
@@ -125,129 +312,117 @@ void loop()
     digitalWrite(EXT_POWER_SWITCH_PIN, LOW);
     extPowerAvailable = false;
   }
+  updateTelemetry(extPowerLevel, intPowerLevel, extPowerLevel > EXT_POWER_CONNECTED_LEVEL, extPowerAvailable);
 
-  switch (i2cCommand)
+  // Take the received command over at once, so the next command can be received while this one is handled.
+  int command;
+  int parameters[I2C_MAX_PARAMETERS];
+  int parameterCount;
+  byte commandSeq;
+  noInterrupts();
+  command = i2cCommand;
+  parameterCount = i2cParameterCount;
+  for (int i = 0; i < parameterCount; i++) {
+    parameters[i] = i2cParameters[i];
+  }
+  commandSeq = i2cCommandSeq;
+  i2cCommand = 0;
+  i2cStopConsumed = false;
+  interrupts();
+
+  switch (command)
   {
     case 1: // Drive and turn, make a temporary turn while driving, used for autonomous control
-      if (i2cParameterCount == 4) {
-        // i2cParameters[0]: driving spead [128..255], where [128..191] means backward, 192 means zero speed and [193..255] means forward.
-        // i2cParameters[1]: turning speed [128..255], where [128..191] means left, 192 means straight forward and [193..255] means right.
-        // i2cParameters[2]: time to drive [128..255], where 128 means infinite, 129 means 50 ms and 255 means 1000 ms.
-        // i2cParameters[3]: time to turn  [128..255], where 128 means infinite, 129 means 50 ms and 255 means 1000 ms.
-        boolean directionBackward;
-        int speedStraight;
+      if (parameterCount == 4) {
+        // parameters[0]: driving spead [128..255], where [128..191] means backward, 192 means zero speed and [193..255] means forward.
+        // parameters[1]: turning speed [128..255], where [128..191] means left, 192 means straight forward and [193..255] means right.
+        // parameters[2]: time to drive [128..255], where 128 means infinite, 129 means 50 ms and 255 means 1000 ms.
+        // parameters[3]: time to turn  [128..255], where 128 means infinite, 129 means 50 ms and 255 means 1000 ms.
         // For speedTurn we do not use the map function to keep it symmetric around 0 as it originated from 192+[-63..63] = [129..255].
-        int speedTurn = (i2cParameters[1] - 192) * 4; // map speedTurn back to 4*[-63..63] = [-252..252]
-        int delayDrive = i2cParameters[2] > 128 ? map(i2cParameters[2], 129, 255, 50, 1000): 0; // For value 128 make delay zero to indicate infinite.
-        int delayTurn = i2cParameters[3] > 128 ? map(i2cParameters[3], 129, 255, 50, 1000): 0;  // For value 128 make delay zero to indicate infinite.
+        motionSpeedTurn = (parameters[1] - 192) * 4; // map speedTurn back to 4*[-63..63] = [-252..252]
+        motionDelayDrive = parameters[2] > 128 ? map(parameters[2], 129, 255, 50, 1000): 0; // For value 128 make delay zero to indicate infinite.
+        motionDelayTurn = parameters[3] > 128 ? map(parameters[3], 129, 255, 50, 1000): 0;  // For value 128 make delay zero to indicate infinite.
 
-        if (i2cParameters[0] < 192) {
+        if (parameters[0] < 192) {
           // Backward.
-          directionBackward = true; // backward left wheels
-          speedStraight = map(i2cParameters[0], 191, 128, 0, 255);
+          motionBackward = true; // backward left wheels
+          motionSpeedStraight = map(parameters[0], 191, 128, 0, 255);
         }
         else {
           // Forward.
-          directionBackward = false; // forward left wheels
-          speedStraight = map(i2cParameters[0], 192, 255, 0, 255);
+          motionBackward = false; // forward left wheels
+          motionSpeedStraight = map(parameters[0], 192, 255, 0, 255);
         }
 
         // If robot is on external power, first switch to batteries.
         // Because switching from external power to batteries is done by a relay, the robot only gets power from a capacitor during the switch.
         // Therefore it is important to do this switching before the robot starts to drive, otherwise the capacitor will not have enough charge.
         // When both speeds are zero (stop command), do not switch off external power. The stop command is sent when losing connection in FPV mode.
-        if (extPowerAvailable == true && (i2cParameters[0] != 192 || i2cParameters[1] != 192)) {
+        // A new drive and turn replaces the one in progress.
+        if (motionState == MOTION_SWITCH_POWER) {
+          // The switch to battery power is in progress, this drive and turn starts when it is done.
+        }
+        else if (extPowerAvailable == true && (parameters[0] != 192 || parameters[1] != 192)) {
           digitalWrite(EXT_POWER_SWITCH_PIN, LOW);
           extPowerAvailable = false;
-          // Delay to make sure switch to battery power is done before the robot starts to drive.
-          // Make sure that after this delay the i2cParameters[...] are not used anymore because during the delay they can be overwritten by the receiveData() callback fuction.
-          delay(500);
-          lastTimeWithoutExternalPowerMillis = millis();  // To make sure external power is not reconnected if robot drives away slowly.
-        }
-
-        if (speedTurn != 0) {
-          // If we have to turn we do this first for turnDelay ms.
-          int speed1 = speedStraight + speedTurn;
-          int speed2 = speedStraight - speedTurn;
-          // Because of speedTurn it can now be that one of the speeds is above 255 or below 0.
-          // In this case we shift both speeds back into the [0..255] range such that we do not have to clip the speeds and the difference is still speedTurn.
-          // This way the steering behavior will be the same for all speeds.
-          if (speed1 > 255 || speed2 > 255) {
-            int shift = max(speed1, speed2) - 255;
-            speed1 = speed1 - shift;
-            speed2 = speed2 - shift;
-          }
-          // If speed is negative, we have to inverse the direction.
-          bool dir1 = speed1 >= 0 ? directionBackward : !directionBackward;
-          bool dir2 = speed2 >= 0 ? directionBackward : !directionBackward;
-          Motor1(abs(speed1), dir1);
-          Motor2(abs(speed2), dir2);
-          if (delayTurn != 0) {
-            delay(delayTurn);
-          }
+          lastTimeWithoutExternalPowerMillis = millis();
+          // Wait 500 ms to make sure switch to battery power is done before the robot starts to drive, see updateMotion().
+          setMotionState(MOTION_SWITCH_POWER, 500);
         }
-        if (speedTurn == 0 || delayTurn != 0) {
-          // If we do not have to turn or only turn temporary we have to change to driving straight.
-          Motor1(speedStraight, directionBackward);
-          Motor2(speedStraight, directionBackward);
-          if (delayDrive != 0 && speedStraight != 0) {
-            // If we have to drive temporary at nonzero speed we have to stop after the drive.
-            delay(delayDrive);
-            // Continue driving straight
-            Motor1(0, false);
-            Motor2(0, false);
-          }
+        else {
+          startTurn();
         }
-        i2cCommand = 0;
       }
       break;
     case 10: // servo for camera up, relative movement
-      if (i2cParameterCount == 1) {
-        // i2cParameters[0] - 128 is number of degrees
-        servoCameraPos = min(servoCameraPos + (i2cParameters[0] - 128), 90);
+      if (parameterCount == 1) {
+        // parameters[0] - 128 is number of degrees
+        servoCameraPos = min(servoCameraPos + (parameters[0] - 128), 90);
         myServo.write(servoCameraPos);
-        i2cCommand = 0;
       }
       break;
     case 11: // servo for camera down, relative movement
-      if (i2cParameterCount == 1) {
-        // i2cParameters[0] - 128 is number of degrees
-        servoCameraPos = max(servoCameraPos - (i2cParameters[0] - 128), 0);
+      if (parameterCount == 1) {
+        // parameters[0] - 128 is number of degrees
+        servoCameraPos = max(servoCameraPos - (parameters[0] - 128), 0);
         myServo.write(servoCameraPos);
-        i2cCommand = 0;
       }
       break;
     case 12: // servo for camera, absolute movement
-      if (i2cParameterCount == 1) {
-        // i2cParameters[0] - 128 is number of degrees
-        servoCameraPos = min(i2cParameters[0] - 128, 90);
+      if (parameterCount == 1) {
+        // parameters[0] - 128 is number of degrees
+        servoCameraPos = min(parameters[0] - 128, 90);
         myServo.write(servoCameraPos);
-        i2cCommand = 0;
       }
       break;
     case 20: // light on
       digitalWrite(LIGHT_PIN, HIGH);
-      i2cCommand = 0;
       break;
     case 21: // light off
       digitalWrite(LIGHT_PIN, LOW);
-      i2cCommand = 0;
-      break;
-    case 100: // Command to indicate a read is going to follow.
-      if (i2cParameterCount == 1) {
-        if (i2cParameters[0] == 128) {            // 128 means read external power level.
-          i2cDataByteToSend = extPowerLevel / 4;  // Map level [0..1023] to [0..255] so it fits in one byte.
-        }
-        else if (i2cParameters[0] == 129) {       // 129 means read internal power level. This power level can be from external power or the batteries.
-          i2cDataByteToSend = intPowerLevel / 4;  // Map level [0..1023] to [0..255] so it fits in one byte.
-        }
-        i2cCommand = 0;
-      }
       break;
 
     default:
       break;
   }
+  // Report the command as consumed after it is handled. A stop which receiveData() consumed in the meantime is newer,
+  // its sequence number is kept, otherwise the Raspberry waits for the stop until its handshake timeout.
+  noInterrupts();
+  if (command != 0 && !i2cStopConsumed) {
+    i2cConsumedSeq = commandSeq;
+  }
+  interrupts();
+
+  updateMotion();
+  // A stop received by receiveData() ends the drive and turn in progress, also one started in this loop.
+  noInterrupts();
+  if (i2cStopReceived) {
+    i2cStopReceived = false;
+    Motor1(0, false);
+    Motor2(0, false);
+    setMotionState(MOTION_IDLE, 0);
+  }
+  interrupts();
 
   // No delay here as it will degrade I2C performance.
 }
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+import time
+import json
+import argparse
+import cv2
+import numpy as np
+import capture
+import motion
+import docking
+
+
+# Global constants.
+Percentiles = [50, 90, 99]
+
+
+# Returns the latency percentiles in ms of a list of durations in seconds.
+def getLatencies(durations):
+    if len(durations) == 0:
+        return {}
+    values = np.percentile(np.array(durations) * 1000.0, Percentiles)
+    return dict([('p' + str(p), round(float(v), 3)) for (p, v) in zip(Percentiles, values)])
+
+
+# Read all frames of a source, played at fps frames per second when realtime is True, otherwise as fast as possible.
+# Calls process(frame) for every frame and returns the number of frames.
+def replay(source, fps, realtime, process):
+    source.open()
+    nofFrames = 0
+    nextFrameTime = time.time()
+    while True:
+        if realtime:
+            time.sleep(max(nextFrameTime - time.time(), 0))
+            nextFrameTime += 1.0 / fps
+        jpg = source.readFrame()
+        if jpg is None:
+            break
+        if isinstance(jpg, memoryview):
+            jpg = jpg.tobytes()
+        # The timestamp is the recording time, so filters see the same time steps as on the robot.
+        process(capture.Frame(nofFrames + 1, jpg, nofFrames / float(fps)))
+        nofFrames += 1
+    source.close()
+    return nofFrames
+
+
+# Motion detection as done by captureAndMotionDetection().
+# With gate the frames of a static scene are skipped as in captureAndMotionDetection().
+class MotionBenchmark(object):
+    def __init__(self, scale, engine, gate = False):
+        self.scale = scale
+        self.engine = engine
+        self.motionDetector = None
+        self.staticSceneGate = capture.StaticSceneGate() if gate else None
+        self.durations = {'decode': [], 'blur': [], 'diff': [], 'contours': [], 'total': []}
+        self.nofMotionFrames = 0
+        self.nofMotionEvents = 0
+        self.prevMotion = False
+
+    def process(self, frame):
+        if self.motionDetector is None:
+            (height, width) = capture.decodeGray(frame.jpg, 1).shape
+            self.motionDetector = motion.MotionDetector(width, height, self.scale, self.engine)
+        startTime = time.time()
+        if self.staticSceneGate is not None and self.motionDetector.noOfConsecutiveMotions == 0 and self.staticSceneGate.isStatic(frame):
+            self.motionDetector.skip()
+            motionInImage = False
+        else:
+            motionInImage = self.motionDetector.detect(frame)
+        self.durations['total'].append(time.time() - startTime)
+        for stage in self.motionDetector.timings:
+            self.durations[stage].append(self.motionDetector.timings[stage])
+        if motionInImage:
+            self.nofMotionFrames += 1
+            if not self.prevMotion:
+                self.nofMotionEvents += 1
+        self.prevMotion = motionInImage
+
+    def getResults(self):
+        results = {'motionFrames': self.nofMotionFrames, 'motionEvents': self.nofMotionEvents}
+        if self.staticSceneGate is not None:
+            results.update({'processedFrames': self.staticSceneGate.nofProcessed, 'skippedFrames': self.staticSceneGate.nofSkipped,
+                            'forcedFrames': self.staticSceneGate.nofForced})
+        return results
+
+
+# Marker detection, tracking and pose estimation as done by homeRun(), without moving.
+class HomeRunBenchmark(object):
+    def __init__(self):
+        self.markerDetector = None
+        self.markerTracker = docking.MarkerTracker()
+        self.durations = {'decode': [], 'detect': [], 'track': [], 'total': []}
+        self.nofMarkerFrames = 0
+        self.nofTrackedFrames = 0
+
+    def process(self, frame):
+        startTime = time.time()
+        img = frame.img
+        if img is None:
+            return
+        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        decodeTime = time.time()
+        if self.markerDetector is None:
+            (height, width) = img_gray.shape
+            self.markerDetector = docking.MarkerDetector(width, height)
+        marker = self.markerDetector.detect(img_gray)
+        detectTime = time.time()
+        self.markerTracker.update(marker, frame.timestamp)
+        if marker is not None:
+            docking.estimatePose(marker, img_gray.shape[1])
+        endTime = time.time()
+        self.durations['decode'].append(decodeTime - startTime)
+        self.durations['detect'].append(detectTime - decodeTime)
+        self.durations['track'].append(endTime - detectTime)
+        self.durations['total'].append(endTime - startTime)
+        if marker is not None:
+            self.nofMarkerFrames += 1
+        if self.markerTracker.confidence > 0:
+            self.nofTrackedFrames += 1
+
+    def getResults(self):
+        results = {'markerFrames': self.nofMarkerFrames, 'trackedFrames': self.nofTrackedFrames}
+        if self.markerDetector is not None:
+            results.update({'locks': self.markerDetector.nofLocks, 'losses': self.markerDetector.nofLosses})
+        return results
+
+
+# The code below is used when this script is run as a separate python script.
+# It replays a recorded .mjpg or .avi file or a directory of JPEG files through the motion detection and the Home run
+# vision processing and writes frames/s, latency percentiles per stage and the detection results as JSON, for example:
+#   python benchmark.py --source /home/pi/DFRobotUploads/dfrobot_video.avi --out results.json
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', required=True)
+    parser.add_argument('--mode', default='motion,homerun')
+    parser.add_argument('--fps', type=float, default=2)
+    parser.add_argument('--realtime', action='store_true')
+    parser.add_argument('--scale', type=int, default=motion.AnalysisScale)
+    parser.add_argument('--engine', default=motion.BackgroundEngine)
+    parser.add_argument('--gate', action='store_true')
+    parser.add_argument('--out', default='')
+    args = parser.parse_args()
+
+    report = {'source': args.source, 'realtime': args.realtime, 'fps': args.fps}
+    for mode in args.mode.split(','):
+        if mode == 'motion':
+            benchmark = MotionBenchmark(args.scale, args.engine, args.gate)
+        else:
+            benchmark = HomeRunBenchmark()
+        startTime = time.time()
+        nofFrames = replay(capture.createSource(args.source), args.fps, args.realtime, benchmark.process)
+        duration = time.time() - startTime
+        report[mode] = {'frames': nofFrames,
+                        'framesPerSecond': round(nofFrames / duration, 2) if duration > 0 else 0,
+                        'latencyMs': dict([(stage, getLatencies(benchmark.durations[stage])) for stage in benchmark.durations]),
+                        'results': benchmark.getResults()}
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.out != '':
+        f = open(args.out, 'w')
+        f.write(output + '\n')
+        f.close()
+    else:
+        print output
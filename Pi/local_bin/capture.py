@@ -0,0 +1,519 @@
+#!/usr/bin/python
+import thread
+import threading
+import os
+import time
+import argparse
+import urllib
+import logging
+import collections
+import zlib
+import cv2
+import numpy as np
+import glob
+import mjpeg
+import clip
+import latency
+
+
+# Global constants.
+StreamUrl = 'http://@localhost:44445/?action=stream'
+ReconnectDelay = 1.0  # Delay before reconnecting when the stream is lost, for example when mjpg_streamer is restarted.
+LatestOnly = 1        # Queue size of a subscription which only keeps the latest frame.
+DecimationTolerance = 0.2   # A frame up to this part of the frame interval early is still handed to a subscriber with a lower frame rate.
+BrightnessInterval = 1.0    # Minimum time in seconds between two brightness estimates.
+BrightnessScale = 8         # The brightness is estimated on an image which is BrightnessScale times smaller in both directions.
+BrightnessTolerance = 5     # Maximum brightness difference between the last estimates to consider the exposure settled.
+BrightnessNofSettled = 3    # Number of estimates within BrightnessTolerance to consider the exposure settled.
+StaticLengthTolerance = 0.005   # Maximum relative JPEG length difference with the last analysed frame to consider the scene static.
+StaticThumbnailScale = 8        # At 1/8 libjpeg only decodes the DC coefficients, so the thumbnail is almost free.
+StaticThumbnailTolerance = 12   # Maximum gray level difference of the thumbnail with the last analysed frame to consider the scene static.
+StaticForceInterval = 10        # A frame is analysed at least every StaticForceInterval frames, even when the scene looks static.
+
+
+# Decode a JPEG to an image which is 'scale' times smaller in both directions, mode is 'GRAYSCALE' or 'COLOR'.
+# OpenCV 3.2 and later can decode directly at a reduced size, which is much faster than a full decode.
+# With an older OpenCV, like the OpenCV 2.4 of Raspbian, the full image is decoded and resized. The IMREAD_* flags
+# are used instead of the CV_LOAD_IMAGE_* flags because they exist in OpenCV 2.4 as well as in 3.x.
+def decodeReduced(jpg, scale, mode):
+    buf = np.frombuffer(jpg, dtype=np.uint8)
+    fullFlag = getattr(cv2, 'IMREAD_' + mode)
+    if scale == 1:
+        return cv2.imdecode(buf, fullFlag)
+    flag = getattr(cv2, 'IMREAD_REDUCED_' + mode + '_' + str(scale), None)
+    if flag is not None:
+        return cv2.imdecode(buf, flag)
+    img = cv2.imdecode(buf, fullFlag)
+    if img is None:
+        return None
+    return cv2.resize(img, (img.shape[1] / scale, img.shape[0] / scale), interpolation = cv2.INTER_AREA)
+
+
+def decodeGray(jpg, scale):
+    return decodeReduced(jpg, scale, 'GRAYSCALE')
+
+
+# A frame as handed out to the subscribers, with the JPEG bytes from the stream.
+# The image is only decoded when a subscriber asks for it, and then only once for all subscribers.
+# Frames are shared between subscribers, so a subscriber that wants to draw on img has to make a copy first.
+class Frame(object):
+    def __init__(self, seq, jpg, timestamp):
+        self.seq = seq
+        self.jpg = jpg
+        self.timestamp = timestamp
+        self.stamps = []        # (stage, monotonic time) of the stream read and the complete JPEG, see latency.Trace.
+        self._img = None
+        self._grays = {}
+        self.lock = thread.allocate_lock()
+
+    # The full resolution color image.
+    @property
+    def img(self):
+        self.lock.acquire()
+        if self._img is None:
+            self._img = cv2.imdecode(np.frombuffer(self.jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.lock.release()
+        return self._img
+
+    # The grayscale image, 'scale' times smaller in both directions.
+    def gray(self, scale):
+        self.lock.acquire()
+        if scale not in self._grays:
+            self._grays[scale] = decodeGray(self.jpg, scale)
+        self.lock.release()
+        return self._grays[scale]
+
+
+# The FrameDecimator takes frames at fps frames per second from a stream with a higher frame rate, keeping the cadence.
+# A frame which is a little early is taken, so 10 fps is decimated to 2 fps by taking every fifth frame.
+class FrameDecimator(object):
+    def __init__(self, fps):
+        self.setFps(fps)
+
+    def setFps(self, fps):
+        self.fps = fps
+        self.nextFrameTime = 0  # Timestamp from which the next frame is taken.
+
+    # Returns True when the frame with this timestamp is taken.
+    def accept(self, timestamp):
+        if self.fps is None:
+            return True
+        interval = 1.0 / self.fps
+        if timestamp < self.nextFrameTime - DecimationTolerance * interval:
+            return False
+        # Keep the cadence, unless the stream was interrupted.
+        if timestamp - self.nextFrameTime < interval:
+            self.nextFrameTime += interval
+        else:
+            self.nextFrameTime = timestamp + interval
+        return True
+
+
+# A FrameMailbox receives the frames of the CaptureService for one subscriber.
+# With queueSize == LatestOnly only the newest frame is kept, otherwise at most queueSize frames
+# are queued and the oldest frame is dropped when the queue is full.
+# The subscriber sleeps in wait() until a new frame arrives, so no CPU is used between frames.
+# With fps the frames of the stream are decimated to this frame rate for the subscriber, None means all frames.
+class FrameMailbox(object):
+    def __init__(self, name, queueSize, fps = None):
+        self.name = name
+        self.frames = collections.deque(maxlen = queueSize)
+        self.condition = threading.Condition()
+        self.decimator = FrameDecimator(fps)
+        self.lastSeq = 0        # Sequence number of the last frame taken by the subscriber.
+        self.nofReceived = 0    # Number of frames taken by the subscriber.
+        self.nofDropped = 0     # Number of frames dropped because the subscriber was too slow or cleared them.
+        self.nofDecimated = 0   # Number of frames not handed to the subscriber because of its lower frame rate.
+
+    # Change the frame rate of the subscriber, the stream itself keeps its frame rate.
+    def setFps(self, fps):
+        if fps != self.decimator.fps:
+            self.decimator.setFps(fps)
+            logging.getLogger("MyLog").info('capture: ' + self.name + ' at ' + str(fps) + ' fps')
+
+    def put(self, frame):
+        if not self.decimator.accept(frame.timestamp):
+            self.nofDecimated += 1
+            return
+        # Keep critical section as short as possible.
+        self.condition.acquire()
+        if len(self.frames) == self.frames.maxlen:
+            # The deque drops the oldest frame when appending to a full deque.
+            self.nofDropped += 1
+        self.frames.append(frame)
+        self.condition.notify()
+        self.condition.release()
+
+    # Returns the oldest queued frame, waiting at most timeout seconds for a new frame.
+    # Returns None if no frame arrived in time, so the subscriber can check its stop conditions.
+    def wait(self, timeout):
+        frame = None
+        self.condition.acquire()
+        if len(self.frames) == 0:
+            self.condition.wait(timeout)
+        if len(self.frames) > 0:
+            frame = self.frames.popleft()
+            self.lastSeq = frame.seq
+            self.nofReceived += 1
+        self.condition.release()
+        return frame
+
+    # Drop all queued frames, for example to make sure the next frame is taken after a movement.
+    def clear(self):
+        self.condition.acquire()
+        self.nofDropped += len(self.frames)
+        self.frames.clear()
+        self.condition.release()
+
+
+# The BrightnessEstimator estimates the brightness of the camera image at most once per interval, on a small decoded image.
+# The brightness is the average of the maximum of the color channels, which is the 'v' (value or brightness) of HSV,
+# so the thresholds calibrated with the former HSV average still apply.
+# The exposure is 'settled' when the last BrightnessNofSettled estimates are within BrightnessTolerance, otherwise 'changing'.
+class BrightnessEstimator(object):
+    def __init__(self, interval = BrightnessInterval):
+        self.interval = interval
+        self.brightness = 0
+        self.lastTime = 0
+        self.estimates = collections.deque(maxlen = BrightnessNofSettled)  # (timestamp, brightness) of the last estimates.
+        self.lock = thread.allocate_lock()
+        self.settled = False
+
+    def update(self, frame):
+        if frame.timestamp - self.lastTime < self.interval:
+            return
+        self.lastTime = frame.timestamp
+        img = decodeReduced(frame.jpg, BrightnessScale, 'COLOR')
+        if img is None:
+            return
+        (b, g, r) = cv2.split(img)
+        self.brightness = cv2.mean(cv2.max(cv2.max(b, g), r))[0]
+        self.lock.acquire()
+        self.estimates.append((frame.timestamp, self.brightness))
+        self.lock.release()
+        settled = self.isSettled()
+        if settled != self.settled:
+            self.settled = settled
+            logging.getLogger("MyLog").info('capture: exposure ' + self.getState() + ', brightness ' + str(int(self.brightness)))
+
+    # Returns True if the last estimates, all made after 'since', are within BrightnessTolerance.
+    def isSettled(self, since = 0):
+        self.lock.acquire()
+        values = [brightness for (timestamp, brightness) in self.estimates if timestamp > since]
+        self.lock.release()
+        return len(values) == self.estimates.maxlen and max(values) - min(values) <= BrightnessTolerance
+
+    def getState(self):
+        if self.isSettled():
+            return 'settled'
+        return 'changing'
+
+
+# The StaticSceneGate decides before decoding if a frame is effectively the same as the last analysed frame, so the
+# full motion detection can be skipped, for example at night when the camera watches an unchanged room.
+# It compares cheap JPEG domain signals with the last analysed frame, not with the previous frame, so a slow change adds up:
+#   - a CRC of the entropy coded data after the start of scan marker: equal means the image is identical.
+#   - the JPEG length: sensor noise changes it a little, a change in the scene changes it more.
+#   - a thumbnail of the DC coefficients, only when OpenCV can decode at a reduced size, see decodeReduced().
+# The length and the thumbnail are only used together: the length alone can not tell a small moving object from sensor
+# noise. OpenCV before 3.2, like the OpenCV 2.4 of Raspbian, has no thumbnail, so there only identical frames are skipped.
+# As a safety valve a frame is analysed at least every forceInterval frames.
+class StaticSceneGate(object):
+    def __init__(self, forceInterval = StaticForceInterval):
+        self.forceInterval = forceInterval
+        self.useThumbnail = hasattr(cv2, 'IMREAD_REDUCED_GRAYSCALE_' + str(StaticThumbnailScale))
+        if not self.useThumbnail:
+            logging.getLogger("MyLog").info('capture: OpenCV ' + cv2.__version__ + ' can not decode a thumbnail, the static scene gate only skips identical frames')
+        self.nofProcessed = 0
+        self.nofSkipped = 0
+        self.nofIdentical = 0       # Skipped frames which were identical to the last analysed frame.
+        self.nofForced = 0          # Frames analysed because of the safety valve.
+        self.reset()
+
+    # Forget the last analysed frame, the next frame is always analysed.
+    def reset(self):
+        self.length = None
+        self.crc = None
+        self.thumbnail = None
+        self.nofSkippedInRow = 0
+
+    # Returns True when the frame can be skipped. Otherwise the frame becomes the reference for the next frames.
+    def isStatic(self, frame):
+        sos = frame.jpg.find('\xff\xda')
+        crc = zlib.crc32(buffer(frame.jpg, max(sos, 0)))
+        thumbnail = None
+        static = False
+        if self.length is not None and self.nofSkippedInRow < self.forceInterval:
+            if crc == self.crc:
+                self.nofIdentical += 1
+                static = True
+            elif self.useThumbnail and abs(len(frame.jpg) - self.length) <= StaticLengthTolerance * self.length:
+                thumbnail = frame.gray(StaticThumbnailScale)
+                static = thumbnail is not None and self.thumbnail is not None and thumbnail.shape == self.thumbnail.shape and \
+                         cv2.minMaxLoc(cv2.absdiff(thumbnail, self.thumbnail))[1] <= StaticThumbnailTolerance
+        elif self.length is not None:
+            self.nofForced += 1
+        if static:
+            self.nofSkipped += 1
+            self.nofSkippedInRow += 1
+            return True
+        self.length = len(frame.jpg)
+        self.crc = crc
+        if self.useThumbnail:
+            self.thumbnail = thumbnail if thumbnail is not None else frame.gray(StaticThumbnailScale)
+        self.nofSkippedInRow = 0
+        self.nofProcessed += 1
+        return False
+
+
+# Log the number of analysed and skipped frames of the static scene gate.
+def logMetrics(staticSceneGate):
+    logging.getLogger("MyLog").info('capture: static scene gate processed ' + str(staticSceneGate.nofProcessed) + ', skipped ' + str(staticSceneGate.nofSkipped) +
+                                    ' (identical ' + str(staticSceneGate.nofIdentical) + '), forced ' + str(staticSceneGate.nofForced) +
+                                    ', thumbnail ' + ('on' if staticSceneGate.useThumbnail else 'off, only identical frames are skipped'))
+
+
+# Frame sources. A source is opened with open(), after which readFrame() returns the JPEG bytes of the next frame,
+# or None at the end. A returned frame is only valid until the next readFrame(). 'live' sources are reconnected
+# when they end, recorded sources are played once.
+
+# The MJPEG http stream of mjpg_streamer.
+class HttpSource(object):
+    live = True
+
+    def __init__(self, url = StreamUrl):
+        self.name = url
+        self.stream = None
+
+    def open(self):
+        self.stream = urllib.urlopen(self.name)
+        self.mjpegParser = mjpeg.MjpegParser(self.stream)
+
+    def readFrame(self):
+        return self.mjpegParser.readFrame()
+
+    # Monotonic time the stream read of the last frame started.
+    @property
+    def readTime(self):
+        return self.mjpegParser.headerTime
+
+    def close(self):
+        # Close the stream to have a correct administration of the number of connections.
+        self.stream.close()
+
+
+# A recorded MJPEG stream, for example saved with 'curl http://localhost:44445/?action=stream > file.mjpg'.
+# Concatenated JPEG files without multipart headers work as well.
+class MjpegFileSource(HttpSource):
+    live = False
+
+    def open(self):
+        self.stream = open(self.name, 'rb')
+        self.mjpegParser = mjpeg.MjpegParser(self.stream)
+
+
+# A recorded MJPG AVI file, like the motion and Home run videos.
+class AviSource(object):
+    live = False
+
+    def __init__(self, path):
+        self.name = path
+
+    def open(self):
+        self.frames = clip.readMjpegAvi(self.name)
+
+    def readFrame(self):
+        return next(self.frames, None)
+
+    def close(self):
+        self.frames.close()
+
+
+# A directory of JPEG files, played in the order of their names.
+class JpegDirectorySource(object):
+    live = False
+
+    def __init__(self, directory):
+        self.name = directory
+
+    def open(self):
+        self.jpgFiles = sorted(glob.glob(os.path.join(self.name, '*.jpg')))
+        self.index = 0
+
+    def readFrame(self):
+        if self.index >= len(self.jpgFiles):
+            return None
+        f = open(self.jpgFiles[self.index], 'rb')
+        jpg = f.read()
+        f.close()
+        self.index += 1
+        return jpg
+
+    def close(self):
+        pass
+
+
+# Returns the frame source for a stream url, an .mjpg or .avi file or a directory of JPEG files.
+def createSource(name):
+    if name.startswith('http://') or name.startswith('https://'):
+        return HttpSource(name)
+    if os.path.isdir(name):
+        return JpegDirectorySource(name)
+    if name.lower().endswith('.avi'):
+        return AviSource(name)
+    return MjpegFileSource(name)
+
+
+# The CaptureService owns the one connection to the frame source, by default the mjpg_streamer stream.
+# Every frame is decoded at most once and handed out to all subscribers, so switching between
+# modes does not need a reconnect and two features running at once do not decode twice.
+# When a live stream is lost it is reconnected automatically.
+# A recorded source is played once, at fps frames per second or, with fps None, as fast as it can be read.
+class CaptureService(object):
+    def __init__(self, source = None, fps = None):
+        if source is None:
+            source = HttpSource()
+        self.source = source
+        self.fps = fps
+        self.subscriptions = []
+        self.subscriptionsLock = thread.allocate_lock()
+        self.running = False
+        self.seq = 0
+        self.lastFrameTime = 0  # Time the last frame was read from the source, also when nobody is subscribed.
+        self.brightnessEstimator = BrightnessEstimator()
+
+    @property
+    def brightness(self):
+        return self.brightnessEstimator.brightness
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            thread.start_new_thread(self._captureThread, ())
+
+    def stop(self):
+        self.running = False
+
+    # Returns the mailbox of a new subscriber, which receives the frames at fps frames per second, None means all frames.
+    def subscribe(self, name, queueSize = LatestOnly, fps = None):
+        mailbox = FrameMailbox(name, queueSize, fps)
+        self.subscriptionsLock.acquire()
+        # Replace the list instead of modifying it so the capture thread can iterate without the lock.
+        self.subscriptions = self.subscriptions + [mailbox]
+        self.subscriptionsLock.release()
+        logging.getLogger("MyLog").info('capture: ' + name + ' subscribed')
+        return mailbox
+
+    def unsubscribe(self, mailbox):
+        self.subscriptionsLock.acquire()
+        self.subscriptions = [s for s in self.subscriptions if s is not mailbox]
+        self.subscriptionsLock.release()
+        logging.getLogger("MyLog").info('capture: ' + mailbox.name + ' unsubscribed, frames received: ' + str(mailbox.nofReceived) + ', dropped: ' + str(mailbox.nofDropped) +
+                                        ', decimated: ' + str(mailbox.nofDecimated))
+
+    def _captureThread(self):
+        streamLost = False
+        while self.running:
+            try:
+                self.source.open()
+            except Exception,e:
+                # Only log the first failure, mjpg_streamer can be stopped for a longer time.
+                if not streamLost:
+                    logging.getLogger("MyLog").info('capture: cannot open ' + self.source.name + ': ' + str(e))
+                    streamLost = True
+                time.sleep(ReconnectDelay)
+                continue
+            logging.getLogger("MyLog").info('capture: ' + self.source.name + ' opened')
+            streamLost = False
+            try:
+                self._readFrames()
+            except Exception,e:
+                logging.getLogger("MyLog").info('capture: stream exception: ' + str(e))
+            self.source.close()
+            if not self.source.live:
+                logging.getLogger("MyLog").info('capture: ' + self.source.name + ' finished, ' + str(self.seq) + ' frames')
+                self.running = False
+            elif self.running:
+                logging.getLogger("MyLog").info('capture: stream lost, going to reconnect')
+                time.sleep(ReconnectDelay)
+
+    def _readFrames(self):
+        nextFrameTime = time.time()
+        while self.running:
+            if self.fps is not None and not self.source.live:
+                # Play a recorded source at the original pace.
+                time.sleep(max(nextFrameTime - time.time(), 0))
+                nextFrameTime = max(nextFrameTime + 1.0 / self.fps, time.time() - 1.0 / self.fps)
+            jpg = self.source.readFrame()
+            completeTime = latency.now()
+            if jpg is None:
+                return
+            self.lastFrameTime = time.time()
+            subscriptions = self.subscriptions
+            if len(subscriptions) == 0:
+                # Nobody is interested in this frame, so do not spend time on decoding it.
+                continue
+            self.seq += 1
+            # The parse buffer of a stream is reused for the next frame, so the JPEG bytes are copied once here.
+            if isinstance(jpg, memoryview):
+                jpg = jpg.tobytes()
+            # The frame is not decoded here, each subscriber decodes what it needs and the result is shared.
+            frame = Frame(self.seq, jpg, time.time())
+            frame.stamps = [('read', getattr(self.source, 'readTime', completeTime)), ('complete', completeTime)]
+            self.brightnessEstimator.update(frame)
+            for mailbox in subscriptions:
+                mailbox.put(frame)
+
+
+# The original way of handing over frames, a lock protected flag which the subscriber polls, only used for the benchmark below.
+class PollingMailbox(object):
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.frame = None
+
+    def put(self, frame):
+        self.lock.acquire()
+        self.frame = frame
+        self.lock.release()
+
+    def wait(self, timeout):
+        frame = None
+        self.lock.acquire()
+        if self.frame is not None:
+            frame = self.frame
+            self.frame = None
+        self.lock.release()
+        return frame
+
+
+# Feed a mailbox with frames at fps frames per second and let a subscriber take them as the motion detection loop does.
+# Returns the CPU time used per second.
+def measureCpuUsage(mailbox, fps, duration):
+    state = {'running': True}
+    def producer():
+        seq = 0
+        while state['running']:
+            seq += 1
+            mailbox.put(Frame(seq, None, time.time()))
+            time.sleep(1.0 / fps)
+    thread.start_new_thread(producer, ())
+    startTimes = os.times()
+    startTime = time.time()
+    while time.time() - startTime < duration:
+        mailbox.wait(0.5)
+    endTimes = os.times()
+    state['running'] = False
+    # User plus system time of the whole process.
+    return ((endTimes[0] - startTimes[0]) + (endTimes[1] - startTimes[1])) / duration
+
+
+# The code below is used when this script is run as a separate python script.
+# It compares the CPU usage of a subscriber which busy-polls for new frames with one that waits on a FrameMailbox.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fps', type=float, default=2)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    print 'busy polling: ', round(measureCpuUsage(PollingMailbox(), args.fps, args.duration) * 100, 1), '% CPU'
+    print 'FrameMailbox: ', round(measureCpuUsage(FrameMailbox('benchmark', LatestOnly), args.fps, args.duration) * 100, 1), '% CPU'
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+import os
+import thread
+import Queue
+import time
+import glob
+import struct
+import argparse
+import logging
+import cv2
+import numpy as np
+
+
+# Global constants.
+ClipWriterType = 'avi'  # 'avi' to put the stream JPEGs in an AVI file as they are, 'opencv' to encode the clip with cv2.VideoWriter.
+
+# Global variables.
+globStartTime = time.time()
+globBytesWritten = 0  # Number of bytes written to the SD card for clips since the start.
+
+
+# Administer bytes written to the SD card, used for the write-bytes-per-hour metric.
+def addBytesWritten(nofBytes):
+    global globBytesWritten
+    globBytesWritten += nofBytes
+
+
+def getWriteBytesPerHour():
+    hours = max((time.time() - globStartTime) / 3600.0, 1.0 / 3600.0)
+    return int(globBytesWritten / hours)
+
+
+# The JpegRingBuffer keeps the last 'length' JPEG frames in memory as the raw bytes coming from the stream.
+# Slots are preallocated and overwritten in a circular way, so the buffer never holds more than 'length' frames.
+class JpegRingBuffer(object):
+    def __init__(self, length):
+        self.slots = [None] * length
+        self.index = 0          # Slot where the next frame is stored.
+        self.nofFrames = 0      # Number of valid frames in the buffer.
+        self.nofBytes = 0       # Number of JPEG bytes currently in the buffer.
+        self.maxNofBytes = 0    # Peak of nofBytes, to check the memory budget.
+
+    def append(self, jpg):
+        if self.slots[self.index] is not None:
+            self.nofBytes -= len(self.slots[self.index])
+        self.slots[self.index] = jpg
+        self.nofBytes += len(jpg)
+        self.maxNofBytes = max(self.maxNofBytes, self.nofBytes)
+        self.index = (self.index + 1) % len(self.slots)
+        self.nofFrames = min(self.nofFrames + 1, len(self.slots))
+
+    # Returns the frames in the buffer from oldest to newest.
+    def frames(self):
+        if self.nofFrames < len(self.slots):
+            return self.slots[0:self.nofFrames]
+        return self.slots[self.index:] + self.slots[0:self.index]
+
+    def clear(self):
+        self.slots = [None] * len(self.slots)
+        self.index = 0
+        self.nofFrames = 0
+        self.nofBytes = 0
+
+    # Estimate of the memory needed when the buffer is full, based on the average frame size so far.
+    def getMemoryBudget(self):
+        if self.nofFrames == 0:
+            return 0
+        return self.nofBytes / self.nofFrames * len(self.slots)
+
+
+# The MjpegAviWriter writes JPEG frames as they are into an AVI file with the MJPG codec.
+# The frames are not decoded or encoded, and as frames are written when they arrive the clip is
+# ready as soon as the last frame is added. The header sizes and the index are filled in by close().
+class MjpegAviWriter(object):
+    def __init__(self, path, width, height, fps):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.index = []         # (offset, size) of every frame, relative to the 'movi' list.
+        self.maxFrameSize = 0
+        self.nofBytes = 0
+        self.file = open(path, 'wb')
+        self._writeHeader()
+
+    def _writeHeader(self):
+        # Positions of the fields which are only known when the clip is closed.
+        f = self.file
+        f.write('RIFF' + struct.pack('<I', 0) + 'AVI ')
+        hdrl = self._avih() + self._list('strl', self._strh() + self._chunk('strf', self._strf()))
+        f.write(self._list('hdrl', hdrl))
+        self.moviPos = f.tell()
+        f.write('LIST' + struct.pack('<I', 0) + 'movi')
+
+    def _chunk(self, fourcc, data):
+        return fourcc + struct.pack('<I', len(data)) + data + ('\0' if len(data) % 2 else '')
+
+    def _list(self, fourcc, data):
+        return 'LIST' + struct.pack('<I', len(data) + 4) + fourcc + data
+
+    def _avih(self):
+        self.avihPos = 12 + 12 + 8  # RIFF header, hdrl list header, avih chunk header.
+        return self._chunk('avih', struct.pack('<14I',
+            int(1000000 / self.fps),            # dwMicroSecPerFrame
+            0,                                  # dwMaxBytesPerSec
+            0,                                  # dwPaddingGranularity
+            0x10,                               # dwFlags: AVIF_HASINDEX
+            0,                                  # dwTotalFrames, filled in by close()
+            0,                                  # dwInitialFrames
+            1,                                  # dwStreams
+            0,                                  # dwSuggestedBufferSize, filled in by close()
+            self.width, self.height, 0, 0, 0, 0))
+
+    def _strh(self):
+        self.strhPos = self.avihPos + 56 + 12 + 8  # avih data, strl list header, strh chunk header.
+        return self._chunk('strh', 'vidsMJPG' + struct.pack('<IHHIIIIIIIIhhhh',
+            0,                                  # dwFlags
+            0, 0,                               # wPriority, wLanguage
+            0,                                  # dwInitialFrames
+            1000,                               # dwScale
+            int(self.fps * 1000),               # dwRate, so frame rate is dwRate / dwScale
+            0,                                  # dwStart
+            0,                                  # dwLength, filled in by close()
+            0,                                  # dwSuggestedBufferSize, filled in by close()
+            0xffffffff,                         # dwQuality, default
+            0,                                  # dwSampleSize, 0 for video
+            0, 0, self.width, self.height))     # rcFrame
+
+    def _strf(self):
+        # BITMAPINFOHEADER
+        return struct.pack('<IiiHH4sIiiII', 40, self.width, self.height, 1, 24, 'MJPG', self.width * self.height * 3, 0, 0, 0, 0)
+
+    def addFrame(self, jpg):
+        self.index.append((self.file.tell() - self.moviPos - 8, len(jpg)))
+        self.file.write(self._chunk('00dc', jpg))
+        self.maxFrameSize = max(self.maxFrameSize, len(jpg))
+
+    def close(self):
+        f = self.file
+        idx1 = ''.join(['00dc' + struct.pack('<III', 0x10, offset, size) for (offset, size) in self.index])  # 0x10: AVIIF_KEYFRAME
+        moviEnd = f.tell()
+        f.write(self._chunk('idx1', idx1))
+        fileSize = f.tell()
+        f.seek(4)
+        f.write(struct.pack('<I', fileSize - 8))
+        f.seek(self.avihPos + 16)
+        f.write(struct.pack('<I', len(self.index)))
+        f.seek(self.avihPos + 28)
+        f.write(struct.pack('<I', self.maxFrameSize))
+        f.seek(self.strhPos + 32)
+        f.write(struct.pack('<II', len(self.index), self.maxFrameSize))
+        f.seek(self.moviPos + 4)
+        f.write(struct.pack('<I', moviEnd - self.moviPos - 8))
+        f.close()
+        self.nofBytes = fileSize
+        addBytesWritten(fileSize)
+
+
+# Generator which returns the JPEG frames of an MJPG AVI file, like the ones written by the MjpegAviWriter.
+# The RIFF chunks are walked in the file order, so the index is not needed.
+def readMjpegAvi(path):
+    f = open(path, 'rb')
+    try:
+        if f.read(12)[0:4] != 'RIFF':
+            return
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            (fourcc, size) = (header[0:4], struct.unpack('<I', header[4:8])[0])
+            if fourcc == 'LIST':
+                # Only the movi list contains frames, continue with its chunks.
+                if f.read(4) != 'movi':
+                    f.seek(size - 4 + size % 2, 1)
+            elif fourcc[2:4] in ('dc', 'db'):
+                data = f.read(size)
+                f.seek(size % 2, 1)
+                yield data
+            else:
+                f.seek(size + size % 2, 1)
+    finally:
+        f.close()
+
+
+# The OpenCvClipWriter writes the clip with cv2.VideoWriter. The frames are decoded and encoded again,
+# which costs more time than the MjpegAviWriter but can give a smaller file depending on the codec.
+class OpenCvClipWriter(object):
+    def __init__(self, path, width, height, fps, codec = 'XVID'):
+        self.path = path
+        if hasattr(cv2, 'VideoWriter_fourcc'):
+            fourcc = cv2.VideoWriter_fourcc(*codec)
+        else:
+            fourcc = cv2.cv.CV_FOURCC(*codec)
+        self.writer = cv2.VideoWriter(path, fourcc, fps, (width, height))
+        self.nofBytes = 0
+
+    def addFrame(self, jpg):
+        self.writer.write(cv2.imdecode(np.fromstring(jpg, dtype=np.uint8), cv2.IMREAD_COLOR))
+
+    def close(self):
+        self.writer.release()
+        self.nofBytes = os.path.getsize(self.path)
+        addBytesWritten(self.nofBytes)
+
+
+# Returns a clip writer of the configured ClipWriterType.
+def openClipWriter(path, width, height, fps):
+    if ClipWriterType == 'opencv':
+        return OpenCvClipWriter(path, width, height, fps)
+    return MjpegAviWriter(path, width, height, fps)
+
+
+# The ClipWorker finishes clips and sends them in a background thread, so capturing and
+# motion detection can continue with the next frame while a clip is closed and uploaded.
+# sendFunction(path, caption) is called for every finished clip, after which the clip file is removed.
+# The file is also removed when sending fails, or when the clip is discarded, so no clips are left on the SD card.
+class ClipWorker(object):
+    def __init__(self, sendFunction):
+        self.sendFunction = sendFunction
+        self.queue = Queue.Queue()
+        self.clipCount = 0
+        thread.start_new_thread(self._workerThread, ())
+
+    # Returns a path for a new clip. Every clip gets its own file because the worker can still
+    # be busy with the previous clip when the next one is started.
+    def newClipPath(self, directory, prefix):
+        self.clipCount += 1
+        return os.path.join(directory, prefix + str(self.clipCount).zfill(6) + '.avi')
+
+    def finish(self, clipWriter, caption):
+        self.queue.put((clipWriter, caption))
+
+    # Close and remove a clip which is not finished, for example when motion detection is stopped during a motion.
+    def discard(self, clipWriter):
+        self.queue.put((clipWriter, None))
+
+    def _workerThread(self):
+        while True:
+            (clipWriter, caption) = self.queue.get()
+            try:
+                try:
+                    startTime = time.time()
+                    clipWriter.close()
+                    if caption is not None:
+                        self.sendFunction(clipWriter.path, caption)
+                        logging.getLogger("MyLog").info('clip: ' + clipWriter.path + ' finished and sent in ' + str(round(time.time() - startTime, 3)) + ' s')
+                    else:
+                        logging.getLogger("MyLog").info('clip: ' + clipWriter.path + ' discarded')
+                finally:
+                    os.remove(clipWriter.path)
+            except Exception,e:
+                logging.getLogger("MyLog").info('clip: worker exception: ' + str(e))
+
+
+# Log the memory use of the ring buffer and the number of bytes written to the SD card for clips.
+def logMetrics(ringBuffer):
+    logging.getLogger("MyLog").info('clip: ring buffer ' + str(ringBuffer.nofBytes) + ' bytes, peak ' + str(ringBuffer.maxNofBytes) +
+                                    ' bytes, budget ' + str(ringBuffer.getMemoryBudget()) + ' bytes, SD card writes ' + str(getWriteBytesPerHour()) + ' bytes/hour')
+
+
+# The code below is used when this script is run as a separate python script.
+# It compares the time to make a clip of a directory of JPEG files with mencoder and with the clip writers.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='/home/pi/DFRobotUploads/benchmark')
+    parser.add_argument('--fps', type=float, default=2)
+    args = parser.parse_args()
+
+    jpgFiles = sorted(glob.glob(os.path.join(args.dir, '*.jpg')))
+    jpgs = [open(jpgFile, 'rb').read() for jpgFile in jpgFiles]
+    img = cv2.imdecode(np.fromstring(jpgs[0], dtype=np.uint8), cv2.IMREAD_COLOR)
+    height, width = img.shape[0:2]
+    print len(jpgs), 'frames of', width, 'x', height
+
+    startTime = time.time()
+    os.system('mencoder "mf://' + args.dir + '/*.jpg" -mf w=' + str(width) + ':h=' + str(height) + ':fps=' + str(args.fps) + ':type=jpg -ovc lavc -lavcopts vcodec=mpeg4:mbd=2:trell -oac copy -o /tmp/clip_mencoder.avi >/dev/null 2>&1')
+    print 'mencoder:        ', round(time.time() - startTime, 2), 's', os.path.getsize('/tmp/clip_mencoder.avi'), 'bytes'
+
+    for (name, writerClass) in [('MjpegAviWriter: ', MjpegAviWriter), ('OpenCvClipWriter:', OpenCvClipWriter)]:
+        startTime = time.time()
+        writer = writerClass('/tmp/clip_' + writerClass.__name__ + '.avi', width, height, args.fps)
+        for jpg in jpgs:
+            writer.addFrame(jpg)
+        writer.close()
+        print name, round(time.time() - startTime, 2), 's', writer.nofBytes, 'bytes'
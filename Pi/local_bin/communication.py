@@ -12,15 +12,22 @@ import tornado.web
 import re
 import logging
 import time
+import collections
 import own_util
+import latency
 import personal_assistant
 import telepot
 import secret
 
 
+# Global constants.
+IoLoopProbeInterval = 0.1   # Interval in seconds of the websocket server responsiveness probe.
+
 # Global variables
 globWebSocketInteractive = False
+globIoLoopLags = collections.deque(maxlen = 600)   # Lateness in seconds of the last probes.
 globWebSocketInMsg = ''
+globWebSocketInTime = 0     # Monotonic time globWebSocketInMsg was received, see latency.py.
 
 
 def TelegramClient():
@@ -177,7 +184,12 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         logging.getLogger("MyLog").info("New websocket connection")
     
     def on_message(self, message):
-        global globWebSocketInteractive, globWebSocketInMsg
+        global globWebSocketInteractive, globWebSocketInMsg, globWebSocketInTime
+        # The latency histograms can be queried without switching to the interactive mode.
+        if str(message) == "latency":
+            self.write_message(latency.getReportJson())
+            return
+        globWebSocketInTime = latency.now()
         globWebSocketInteractive = True
         globWebSocketInMsg = str(message) # message received is Unicode. Convert back to ASCII.
         # Check for reboot command coming in via the websocket right here, other parts of the code might not run anymore.
@@ -213,7 +225,26 @@ def startWebSocketServer():
     http_server.listen(44447)
     myIP = socket.gethostbyname(socket.gethostname())
     logging.getLogger("MyLog").info('*** Websocket Server Started at %s***' % myIP)
-    thread.start_new_thread(tornado.ioloop.IOLoop.instance().start, ())
+    ioLoop = tornado.ioloop.IOLoop.instance()
+    firstProbeTime = time.time() + IoLoopProbeInterval
+    ioLoop.add_timeout(firstProbeTime, lambda: ioLoopProbe(firstProbeTime))
+    thread.start_new_thread(ioLoop.start, ())
+
+
+# The probe is scheduled on the websocket server loop every IoLoopProbeInterval. How late it runs is how long a websocket
+# message, for example a drive command, waits before it is handled, because the other threads hold the GIL.
+def ioLoopProbe(expectedTime):
+    now = time.time()
+    globIoLoopLags.append(max(now - expectedTime, 0))
+    tornado.ioloop.IOLoop.instance().add_timeout(now + IoLoopProbeInterval, lambda: ioLoopProbe(now + IoLoopProbeInterval))
+
+
+# Returns the median and the maximum lateness in ms of the websocket server loop over the last minute.
+def getIoLoopLag():
+    lags = sorted(globIoLoopLags)
+    if len(lags) == 0:
+        return (0, 0)
+    return (round(lags[len(lags) / 2] * 1000, 1), round(lags[-1] * 1000, 1))
 
 
 
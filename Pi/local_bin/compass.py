@@ -4,6 +4,7 @@ import time
 import math
 import subprocess
 import i2c
+import i2c_dispatcher
 import own_util
 
 
@@ -11,12 +12,17 @@ import own_util
 slaveAddressCompass = 0x1e
 
 
+# Read the compass by the I2C dispatcher at the priority of the telemetry, so it does not delay a stop of the motors.
 def readCompass(debug = False):
-    # Create i2c lock if it does not exist yet.
-    i2c.createI2cLock()
-    # Lock  i2c communication for this thread.
-    i2c.globI2cLock.acquire()
-    
+    return requestCompass(debug).wait()
+
+
+# Queue a compass read on the I2C dispatcher without waiting for it. Returns the i2c_dispatcher.I2cFuture of the heading.
+def requestCompass(debug = False):
+    return i2c_dispatcher.submit(i2c_dispatcher.PriorityTelemetry, lambda: readCompassLocked(debug))
+
+
+def readCompassLocked(debug = False):
     i2c.write_byte(slaveAddressCompass, 0, 0b01110000) # Set to 8 samples @ 15Hz.
     i2c.write_byte(slaveAddressCompass, 1, 0b00100000) # 1.3 gain LSb / Gauss 1090 (default).
     i2c.write_byte(slaveAddressCompass, 2, 0b00000000) # Continuous-Measurement Mode.
@@ -60,12 +66,6 @@ def readCompass(debug = False):
     else:
         degrees = degrees_raw + (360.0 - degrees_raw) / 180.0 * offsetCorrectionAt180Degrees
 
-    # Delay for i2c communication.
-    time.sleep(i2c.globI2cDelay)
-
-    # Release i2c communication for this thread.
-    i2c.globI2cLock.release()
-
     if debug:
         return x_out_raw, y_out_raw, z_out_raw, x_out, y_out, degrees_raw, degrees
     else:
@@ -0,0 +1,411 @@
+#!/usr/bin/python
+import os
+import glob
+import time
+import math
+import argparse
+import logging
+import cv2
+import numpy as np
+import session_log
+
+
+# Docking marker constants.
+# The marker consists of three circles: a left and a right one of equal size, about 3 times their size apart,
+# and a smaller one in the middle which is used to estimate the approach angle.
+MinBlobArea = 100           # Calibrated with 640 * 480 image.
+MaxBlobArea = 100000        # Calibrated with 640 * 480 image.
+MinCircularity = 0.80
+RoiMarginFactor = 1.0       # Margin around the last marker position as a factor of the marker width, the robot turns between frames.
+RoiMinMargin = 0.1          # Minimum margin around the last marker position as a fraction of the image width.
+# Marker geometry and camera intrinsics for the pose estimation.
+# The pose based steering and approach correction are experimental and off by default: MarkerBlobDistance,
+# MarkerMiddleDepth and DriveUnitsPerCm are placeholders which are not measured on the robot yet. The Home run uses
+# the empirical correction below unless run_dfrobot.py is started with --posecorrection.
+MarkerBlobDistance = 15.0   # Distance in cm between the centers of the left and right circle.
+MarkerMiddleDepth = 3.0     # Distance in cm the middle circle is mounted out of the plane of the left and right circle.
+CameraHorizontalFov = 53.5  # Horizontal field of view in degrees of the Raspberry Pi camera module.
+# Conversion of the pose to moves, see own_util.move().
+TurnUnitsPer90Degrees = 112 # Turn delay for a 90 degrees turn.
+DriveUnitsPerCm = 1.0       # Drive delay per cm forward.
+MaxMoveDelay = 127          # Largest delay of one move.
+MaxLateralOffset = 5.0      # Maximum distance in cm from the marker axis before the approach is corrected.
+# Empirical correction, calibrated with 640 * 480 images.
+EmpiricalTurnSmall = 1      # Turn delay when the marker is near the course.
+EmpiricalTurnLarge = 12     # Turn delay when the marker is more than a fifth of the image width off course.
+EmpiricalMinCorrection = 2.0  # Minimum shift in pixels of the middle circle before the approach is corrected.
+EmpiricalDriveFactor = 3    # Drive delay per pixel shift of the middle circle.
+# Marker tracker constants.
+TrackProcessNoise = 50.0    # Expected change of the marker velocity in pixels/s per second, the robot turns between frames.
+TrackMeasurementNoise = 4.0 # Expected measurement error of the marker position and size in pixels.
+TrackConfidenceGain = 0.5   # Fraction of the remaining confidence gained with every image in which the marker is found.
+TrackConfidenceDecay = 0.6  # Factor the confidence is multiplied with for every image in which the marker is not found.
+TrackMinConfidence = 0.1    # Below this confidence the track is lost and the tracker starts again with the next found marker.
+
+
+# A found marker, the blobs are cv2.KeyPoint in full image coordinates. The middle blob can be None.
+class Marker(object):
+    def __init__(self, blobLeft, blobMiddle, blobRight):
+        self.blobLeft = blobLeft
+        self.blobMiddle = blobMiddle
+        self.blobRight = blobRight
+        self.xmid = (blobLeft.pt[0] + blobRight.pt[0]) / 2.0
+        self.ymid = (blobLeft.pt[1] + blobRight.pt[1]) / 2.0
+        # The size of a blob is radius in pixels.
+        self.distBlobLeftBlobRight = blobRight.pt[0] - blobLeft.pt[0]
+        self.avgSizeBlobLeftBlobRight = (blobLeft.size + blobRight.size) / 2.0
+
+
+# The pose of the robot relative to the marker.
+# distance:       distance in cm from the camera to the marker.
+# bearing:        angle in degrees between the camera axis and the marker, positive when the marker is to the right.
+# approachAngle:  angle in degrees between the line of sight and the marker axis (perpendicular to the marker).
+#                 Positive when the robot has to move to the left to get on the marker axis, like the former 'correction'.
+# lateralOffset:  distance in cm from the robot to the marker axis, with the sign of approachAngle.
+class MarkerPose(object):
+    def __init__(self, distance, bearing, approachAngle):
+        self.distance = distance
+        self.bearing = bearing
+        self.approachAngle = approachAngle
+        self.lateralOffset = distance * math.sin(math.radians(approachAngle))
+
+
+# Returns the focal length in pixels for an image width.
+def getFocalLength(width):
+    return (width / 2.0) / math.tan(math.radians(CameraHorizontalFov / 2.0))
+
+
+# Returns the angle in degrees between the camera axis and image column x, positive to the right.
+def getBearing(x, width):
+    return math.degrees(math.atan((x - width / 2.0) / getFocalLength(width)))
+
+
+# Estimate the pose from one image of the marker with a pinhole camera model.
+# cv2.solvePnP needs at least four points and the marker has three, so the pose is calculated in closed form:
+# - The middle circle is out of the plane of the outer circles, so seen at an angle it shifts with respect to the middle
+#   between the outer circles by MarkerMiddleDepth * sin(angle), while the outer circles are MarkerBlobDistance * cos(angle) apart.
+#   The ratio of the two gives the approach angle, independent of the distance and the focal length.
+# - The distance follows from the apparent distance between the outer circles and the focal length.
+# Returns a MarkerPose. Without a middle circle the approach angle cannot be estimated and is 0.
+def estimatePose(marker, width):
+    focalLength = getFocalLength(width)
+    bearing = getBearing(marker.xmid, width)
+    approachAngle = 0.0
+    if marker.blobMiddle is not None:
+        shift = marker.xmid - marker.blobMiddle.pt[0]
+        approachAngle = math.degrees(math.atan((shift / marker.distBlobLeftBlobRight) * MarkerBlobDistance / MarkerMiddleDepth))
+    distance = focalLength * MarkerBlobDistance * math.cos(math.radians(approachAngle)) / marker.distBlobLeftBlobRight
+    return MarkerPose(distance, bearing, approachAngle)
+
+
+# Returns the moves [(direction, delayMove)] to get on the marker axis in one go, facing the marker. Experimental, see above.
+# The robot faces the marker, so it turns 90 degrees minus the approach angle to drive perpendicular to the marker axis,
+# drives the lateral offset and turns 90 degrees back towards the marker.
+# These are three separate moves, not one continuous approach: a drive and turn of the Arduino turns and then drives
+# straight, so it can not end facing the marker.
+def planApproachCorrection(pose):
+    turnUnits = TurnUnitsPer90Degrees / 90.0
+    if pose.approachAngle > 0:
+        (away, back) = ('left', 'right')
+    else:
+        (away, back) = ('right', 'left')
+    return [(away, (90.0 - abs(pose.approachAngle)) * turnUnits),
+            ('forward', min(abs(pose.lateralOffset) * DriveUnitsPerCm, MaxMoveDelay)),
+            (back, 90.0 * turnUnits)]
+
+
+# Returns the turn delay to face image column x.
+# With the pose the turn follows the bearing, at least the smallest possible turn. Without it the empirical steps are used.
+def getTurnDelay(x, width, usePose):
+    if usePose:
+        return max(abs(getBearing(x, width)) * TurnUnitsPer90Degrees / 90.0, 1)
+    if abs(x - width / 2.0) > width / 5.0:
+        return EmpiricalTurnLarge
+    return EmpiricalTurnSmall
+
+
+# Returns the empirical correction: the shift of the middle circle with respect to the middle between the outer circles,
+# in pixels of a 640 * 480 image. Positive when the robot has to move to the left. It is 0 without a middle circle.
+def getEmpiricalCorrection(marker, width):
+    if marker.blobMiddle is None:
+        return 0
+    return (marker.xmid - marker.blobMiddle.pt[0]) / (width / 640.0)
+
+
+# Returns the empirical moves [(direction, delayMove)] to get on the marker axis.
+# Turn 90 degrees minus a correction dependant on the sideways displacement, drive and turn back 90 degrees.
+# No correction is used on the way back because the robot has to turn a bit further back to the marker.
+def planEmpiricalCorrection(correction):
+    if correction > 0:
+        return [('left', TurnUnitsPer90Degrees - correction), ('forward', correction * EmpiricalDriveFactor), ('right', TurnUnitsPer90Degrees)]
+    return [('right', TurnUnitsPer90Degrees + correction), ('forward', -correction * EmpiricalDriveFactor), ('left', TurnUnitsPer90Degrees)]
+
+
+# Returns a SimpleBlobDetector for the marker circles in an image of width * height.
+def createBlobDetector(width, height):
+    # Setup SimpleBlobDetector parameters.
+    params = cv2.SimpleBlobDetector_Params()
+
+    # Change thresholds
+    # The default value of params.thresholdStep (10?) seems to work well.
+    # To speed processing up, increase to 20 or more.
+    #params.thresholdStep = 20
+    params.minThreshold = 20
+    params.maxThreshold = 200
+
+    # Filter by Area.
+    # This prevents that many small blobs (one pixel) will be detected.
+    # In addition tt is observed that in that case invalid keypoint coordinates are produced: nan (not a number).
+    # When filterByArea is set to True with a minArea > 0 this problem does not occur.
+    imgAreaFactor = (width * height) / (640.0 * 480.0)
+    params.filterByArea = True
+    params.minArea = MinBlobArea * imgAreaFactor
+    params.maxArea = MaxBlobArea * imgAreaFactor
+
+    # Filter by Circularity
+    params.filterByCircularity = True
+    params.minCircularity = MinCircularity
+
+    # Filter by Convexity
+    params.filterByConvexity = False
+    params.minConvexity = 0.87
+
+    # Filter by Inertia
+    params.filterByInertia = False
+    params.minInertiaRatio = 0.01
+
+    #Filter by distance between blobs
+    #params.minDistBetweenBlobs = 100
+
+    if hasattr(cv2, 'SimpleBlobDetector_create'):
+        return cv2.SimpleBlobDetector_create(params)
+    return cv2.SimpleBlobDetector(params)
+
+
+# Sort blobs on horizontal position and find the left, middle and right blob of the marker.
+# Returns a Marker or None if no valid marker is found.
+def findMarker(blobs, doPrint = False):
+    sortedBlobs = sorted(blobs, key=lambda x: x.pt[0], reverse=False)
+    blobLeft = None
+    blobMiddle = None
+    blobRight = None
+    for blob in sortedBlobs:
+        # Fill in three blobs, left, middle, right.
+        if blobLeft is None:
+            blobLeft = blob
+        elif blobMiddle is None:
+            # Check if there is a middle blob found which is 3 times smaller than the left blob.
+            if blob.size > blobLeft.size/4.0 and blob.size < blobLeft.size/2.0:
+                blobMiddle = blob
+                continue
+        if blobRight is None:
+            # Skip blop if it is significantly smaller than the first blob.
+            if blob.size < blobLeft.size/2.0:
+                continue
+            blobRight = blob
+            # We have two or three blobs now, check if these are valid
+            # For now we consider the blobs valid if the left and right one have appr. equal size.
+            marker = Marker(blobLeft, blobMiddle, blobRight)
+            distBlobLeftBlobRight = marker.distBlobLeftBlobRight
+            avgSizeBlobLeftBlobRight = marker.avgSizeBlobLeftBlobRight
+            if abs((blobLeft.size - blobRight.size) / avgSizeBlobLeftBlobRight) < 0.3 and abs((distBlobLeftBlobRight - avgSizeBlobLeftBlobRight * 3.0) / ((distBlobLeftBlobRight + avgSizeBlobLeftBlobRight * 3.0) / 2.0)) < 0.3:
+                # We have found two or three valid blobs.
+                return marker
+            if doPrint:
+                if blobMiddle is not None:
+                    print 'Blob conditions not met, left:', blobLeft.pt[0], blobLeft.size, 'middle:', blobMiddle.pt[0], blobMiddle.size, 'right:', blobRight.pt[0], blobRight.size, 'distBlobLeftBlobRight:', distBlobLeftBlobRight
+                else:
+                    print 'Blob conditions not met, left:', blobLeft.pt[0], blobLeft.size, 'right:', blobRight.pt[0], blobRight.size, 'distBlobLeftBlobRight:', distBlobLeftBlobRight
+            # No valid blobs found yet, shift one blob up.
+            # We assume that valid blobs are adjacent.
+            # This is reasonable as the real blobs will indeed be close to each other.
+            if blobMiddle is not None:
+                blobLeft = blobMiddle
+                blobMiddle = blobRight
+                blobRight = None
+            else:
+                blobLeft = blobRight
+                blobRight = None
+    return None
+
+
+# The MarkerDetector finds the docking marker in grayscale images. The blob detector is created once.
+# When the marker is found (locked), the next image is only searched in a region of interest around the last position.
+# If the marker is not found there the lock is lost and the whole image is searched again.
+class MarkerDetector(object):
+    def __init__(self, width, height, doPrint = False):
+        self.width = width
+        self.height = height
+        self.doPrint = doPrint
+        self.blobDetector = createBlobDetector(width, height)
+        self.marker = None          # Last found marker, None when not locked.
+        self.blobs = []             # Blobs found in the last image, in full image coordinates.
+        self.detectionTime = 0      # Duration in seconds of the last detection.
+        self.nofImages = 0
+        self.nofLocks = 0           # Number of times the marker was found with a full image search.
+        self.nofLosses = 0          # Number of times the marker was not found in the region of interest.
+        self.nofRoiSearches = 0
+        self.nofFullSearches = 0
+        self.totalDetectionTime = 0
+
+    def reset(self):
+        self.marker = None
+        self.blobs = []
+
+    # Returns the region of interest (x, y, w, h) around the last marker position.
+    def getRoi(self):
+        marker = self.marker
+        margin = max(marker.distBlobLeftBlobRight * RoiMarginFactor, self.width * RoiMinMargin)
+        xLeft = max(int(marker.blobLeft.pt[0] - marker.blobLeft.size - margin), 0)
+        xRight = min(int(marker.blobRight.pt[0] + marker.blobRight.size + margin), self.width)
+        yTop = max(int(marker.ymid - marker.avgSizeBlobLeftBlobRight - margin), 0)
+        yBottom = min(int(marker.ymid + marker.avgSizeBlobLeftBlobRight + margin), self.height)
+        return (xLeft, yTop, xRight - xLeft, yBottom - yTop)
+
+    def _detectBlobs(self, img_gray, roi):
+        (x, y, w, h) = roi
+        blobs = self.blobDetector.detect(img_gray[y:y + h, x:x + w])
+        if x == 0 and y == 0:
+            return blobs
+        # Translate to full image coordinates.
+        return [cv2.KeyPoint(blob.pt[0] + x, blob.pt[1] + y, blob.size) for blob in blobs]
+
+    # Returns the Marker found in img_gray or None.
+    def detect(self, img_gray):
+        startTime = time.time()
+        self.nofImages += 1
+        marker = None
+        if self.marker is not None:
+            self.nofRoiSearches += 1
+            self.blobs = self._detectBlobs(img_gray, self.getRoi())
+            marker = findMarker(self.blobs, self.doPrint)
+            if marker is None:
+                self.nofLosses += 1
+                if self.doPrint:
+                    print 'marker lost, searching full image'
+        if marker is None:
+            self.nofFullSearches += 1
+            self.blobs = self._detectBlobs(img_gray, (0, 0, self.width, self.height))
+            marker = findMarker(self.blobs, self.doPrint)
+            if marker is not None:
+                self.nofLocks += 1
+        self.marker = marker
+        self.detectionTime = time.time() - startTime
+        self.totalDetectionTime += self.detectionTime
+        return marker
+
+
+# The MarkerTracker filters the marker position (x, y) and size across images with a Kalman filter.
+# The state is x, y, size and their rates per second. When the marker is not found in an image the state is predicted,
+# so a short dropout does not lose the marker. The confidence [0..1] goes up with every image the marker is found in
+# and down with every image it is not, the controller only uses the predicted state when the confidence is high enough.
+# When the marker is found the controller uses the measurement itself: the filter knows nothing about the moves of the
+# robot, so the filtered state lags after a turn or a drive.
+class MarkerTracker(object):
+    def __init__(self):
+        self.kalman = cv2.KalmanFilter(6, 3)
+        self.kalman.measurementMatrix = np.eye(3, 6, dtype=np.float32)
+        self.kalman.measurementNoiseCov = np.eye(3, dtype=np.float32) * TrackMeasurementNoise ** 2
+        self.reset()
+
+    def reset(self):
+        self.confidence = 0.0
+        self.lastTime = None
+        self.x = self.y = self.size = 0.0
+        self.nofPredicted = 0       # Number of images in a row the marker is predicted instead of found.
+
+    def _setTimeStep(self, dt):
+        transitionMatrix = np.eye(6, dtype=np.float32)
+        for i in range(3):
+            transitionMatrix[i, i + 3] = dt
+        self.kalman.transitionMatrix = transitionMatrix
+        # The velocity can change between every image, because the robot moves.
+        processNoiseCov = np.zeros((6, 6), np.float32)
+        for i in range(3):
+            processNoiseCov[i, i] = (TrackProcessNoise * dt * dt / 2.0) ** 2
+            processNoiseCov[i + 3, i + 3] = (TrackProcessNoise * dt) ** 2
+        self.kalman.processNoiseCov = processNoiseCov
+
+    # Update the track with the marker found at timestamp, or None if it was not found.
+    # Returns the confidence.
+    def update(self, marker, timestamp):
+        if self.confidence == 0.0:
+            if marker is not None:
+                # Start a new track at the found marker, with an unknown velocity.
+                self.kalman.statePost = np.array([[marker.xmid], [marker.ymid], [marker.avgSizeBlobLeftBlobRight], [0], [0], [0]], np.float32)
+                self.kalman.errorCovPost = np.diag(np.array([TrackMeasurementNoise ** 2] * 3 + [TrackProcessNoise ** 2] * 3, np.float32))
+                self.lastTime = timestamp
+                self.confidence = TrackConfidenceGain
+                (self.x, self.y, self.size) = (marker.xmid, marker.ymid, marker.avgSizeBlobLeftBlobRight)
+                self.nofPredicted = 0
+            return self.confidence
+
+        self._setTimeStep(max(timestamp - self.lastTime, 0.0))
+        self.lastTime = timestamp
+        state = self.kalman.predict()
+        if marker is not None:
+            state = self.kalman.correct(np.array([[marker.xmid], [marker.ymid], [marker.avgSizeBlobLeftBlobRight]], np.float32))
+            self.confidence += (1.0 - self.confidence) * TrackConfidenceGain
+            self.nofPredicted = 0
+        else:
+            # Without a measurement the prediction is the new state.
+            self.kalman.statePost = state
+            self.kalman.errorCovPost = self.kalman.errorCovPre
+            self.confidence *= TrackConfidenceDecay
+            self.nofPredicted += 1
+        (self.x, self.y, self.size) = (float(state[0]), float(state[1]), float(state[2]))
+        if self.confidence < TrackMinConfidence:
+            self.reset()
+        return self.confidence
+
+
+# Log the detection statistics of the marker detector.
+def logMetrics(markerDetector):
+    nofImages = max(markerDetector.nofImages, 1)
+    logging.getLogger("MyLog").info('docking: ' + str(markerDetector.nofImages) + ' images, detection ' + str(round(markerDetector.totalDetectionTime / nofImages * 1000, 1)) +
+                                    ' ms/image, locks ' + str(markerDetector.nofLocks) + ', losses ' + str(markerDetector.nofLosses) +
+                                    ', roi searches ' + str(markerDetector.nofRoiSearches) + ', full searches ' + str(markerDetector.nofFullSearches))
+
+
+# The code below is used when this script is run as a separate python script.
+# It runs the marker detection over the images of a recorded Home run, with and without region of interest tracking,
+# and prints the detection time per image, the number of images with a marker and the lock and loss counts.
+# With --pose the estimated pose is printed for every image with a marker.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='/home/pi/DFRobotUploads/benchmark')
+    parser.add_argument('--pose', action='store_true')
+    parser.add_argument('--session', default='', help='use the frames of a Home run session, see session_log.py, instead of --dir')
+    parser.add_argument('--compare', action='store_true', help='compare the empirical and the pose based turns and corrections')
+    args = parser.parse_args()
+
+    if args.session != '':
+        jpgs = [frame.jpg for (record, frame) in session_log.SessionReader(args.session).frames()]
+    else:
+        jpgs = [open(jpgFile, 'rb').read() for jpgFile in sorted(glob.glob(os.path.join(args.dir, '*.jpg')))]
+    imgs = [cv2.imdecode(np.fromstring(jpg, dtype=np.uint8), cv2.IMREAD_GRAYSCALE) for jpg in jpgs]
+    height, width = imgs[0].shape
+    for useRoi in [False, True]:
+        markerDetector = MarkerDetector(width, height)
+        nofMarkers = 0
+        for img_gray in imgs:
+            if not useRoi:
+                markerDetector.reset()
+            marker = markerDetector.detect(img_gray)
+            if marker is not None:
+                nofMarkers += 1
+                if args.pose and useRoi:
+                    pose = estimatePose(marker, width)
+                    print 'image', markerDetector.nofImages, 'distance', round(pose.distance, 1), 'cm, bearing', round(pose.bearing, 1), 'deg, approach angle', round(pose.approachAngle, 1), 'deg, lateral offset', round(pose.lateralOffset, 1), 'cm'
+                if args.compare and useRoi:
+                    # The Home run turns when the marker is more than a twentieth of the image width off course
+                    # and corrects the approach when it is on course, see homeRun() in run_dfrobot.py.
+                    pose = estimatePose(marker, width)
+                    correction = getEmpiricalCorrection(marker, width)
+                    if abs(marker.xmid - width / 2.0) > width / 20.0:
+                        print 'image', markerDetector.nofImages, 'turn empirical', getTurnDelay(marker.xmid, width, False), ', pose', round(getTurnDelay(marker.xmid, width, True), 1)
+                    else:
+                        print 'image', markerDetector.nofImages, 'correction empirical', round(correction, 1), (planEmpiricalCorrection(correction) if abs(correction) > EmpiricalMinCorrection else 'none'),
+                        print ', pose', round(pose.lateralOffset, 1), 'cm', (planApproachCorrection(pose) if abs(pose.lateralOffset) > MaxLateralOffset else 'none')
+        print 'roi' if useRoi else 'full', ':', round(markerDetector.totalDetectionTime / len(imgs) * 1000, 2), 'ms/image,', nofMarkers, 'of', len(imgs), 'images with marker,',
+        print 'locks', markerDetector.nofLocks, ', losses', markerDetector.nofLosses
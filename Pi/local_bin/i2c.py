@@ -1,16 +1,34 @@
 #!/usr/bin/python
 
 import thread
+import time
+import argparse
 import RPi.GPIO as GPIO
 import smbus
 import logging
+import latency
+
+# Global constants.
+ReopenDelayMin = 0.1    # Time in seconds before the bus is opened again after opening failed, doubled after every failure.
+ReopenDelayMax = 10.0
+FrameMarker = 0xa5      # Register byte of a framed command, see write_frame().
+RegisterConsumed = 1    # Register of the Arduino with the sequence number of the last command it handled, see waitConsumed().
+RegisterTelemetry = 2   # Register of the Arduino with the telemetry block, see own_util.updatePowerInfo().
+TelemetrySize = 7
+RegisterPending = 3     # Register of the Arduino which is 1 while it has a command which it did not take over yet.
+HandshakeTimeout = 0.1  # Maximum time in seconds to wait until the Arduino handled a command, loop() of the Arduino does not block.
+HandshakePollInterval = 0.002
 
 # Global variables
 globI2cLock = None
-# globI2cDelay is the minimum time needed between two I2C commands to give the Arduino time to handle the commands.
-# The Arduino does not buffer the I2C commands. If the Raspberry issues an I2C command too fast for the Arduino,
-# it will overwrite the previous command on the Arduino.
-globI2cDelay = 0.1
+globI2cLockTime = 0     # Time the lock was acquired, see acquireLock().
+globCommandSeq = 0      # Sequence number of the last framed command, [1..255].
+globNofCommands = 0
+globNofHandshakeTimeouts = 0
+globNofRejected = 0     # Commands not sent because the previous command was still pending on the Arduino.
+globPendingSeqs = {}    # Slave address -> sequence number of the last command which is not confirmed as handled yet.
+globMetricsTime = time.time()
+globMetricsNofCommands = 0
 
 
 def createI2cLock():
@@ -20,6 +38,21 @@ def createI2cLock():
         globI2cLock = thread.allocate_lock()
 
 
+# Take the i2c bus for this thread. The time waited for the lock and, in releaseLock(), the time the lock was held are
+# added to the histograms of the 'i2c' pipeline, see latency.getReport().
+def acquireLock():
+    global globI2cLockTime
+    createI2cLock()
+    startTime = latency.now()
+    globI2cLock.acquire()
+    globI2cLockTime = latency.now()
+    latency.record('i2c', 'lockWait', globI2cLockTime - startTime)
+
+def releaseLock():
+    latency.record('i2c', 'lockHold', latency.now() - globI2cLockTime)
+    globI2cLock.release()
+
+
 def get_smbus():
     try:
         rev = GPIO.RPI_REVISION
@@ -32,26 +65,183 @@ def get_smbus():
         logging.getLogger("MyLog").info('I2C get_smbus exception: ' + str(e))
         return None
 
+
+# The I2cBus opens the bus once per process and reuses it for all transactions, instead of opening the device node
+# for every byte. After an error the bus is closed and opened again at the next transaction. When opening fails,
+# the next attempt waits ReopenDelayMin seconds, doubling up to ReopenDelayMax, and transactions fail at once meanwhile.
+# The transactions per device are counted. The callers still serialize the transactions with globI2cLock.
+class I2cBus(object):
+    def __init__(self, openBus = get_smbus):
+        self.openBus = openBus
+        self.bus = None
+        self.lock = thread.allocate_lock()
+        self.reopenDelay = ReopenDelayMin
+        self.nextOpenTime = 0
+        self.nofOpens = 0
+        self.nofOpenFailures = 0
+        self.counters = {}      # Slave address -> [reads, writes, errors].
+
+    def _getBus(self):
+        self.lock.acquire()
+        if self.bus is None and time.time() >= self.nextOpenTime:
+            self.bus = self.openBus()
+            if self.bus is not None:
+                self.nofOpens += 1
+                self.reopenDelay = ReopenDelayMin
+            else:
+                self.nofOpenFailures += 1
+                self.nextOpenTime = time.time() + self.reopenDelay
+                self.reopenDelay = min(self.reopenDelay * 2, ReopenDelayMax)
+        bus = self.bus
+        self.lock.release()
+        return bus
+
+    def _count(self, slaveAddr, index):
+        self.lock.acquire()
+        self.counters.setdefault(slaveAddr, [0, 0, 0])[index] += 1
+        self.lock.release()
+
+    # Close the bus, it is opened again at the next transaction.
+    # The device node is closed at once, otherwise every reopen after an error keeps a file descriptor open until
+    # the garbage collector removes the old SMBus.
+    def close(self):
+        self.lock.acquire()
+        bus = self.bus
+        self.bus = None
+        self.lock.release()
+        if bus is not None:
+            try:
+                bus.close()
+            except Exception,e:
+                logging.getLogger("MyLog").info('I2C close exception: ' + str(e))
+
+    def _transaction(self, slaveAddr, index, function, *args):
+        bus = self._getBus()
+        if bus is None:
+            self._count(slaveAddr, 2)
+            raise IOError('I2C bus not available')
+        try:
+            result = getattr(bus, function)(*args)
+        except Exception,e:
+            self._count(slaveAddr, 2)
+            self.close()
+            raise
+        self._count(slaveAddr, index)
+        return result
+
+    def read_byte_data(self, slaveAddr, adr):
+        return self._transaction(slaveAddr, 0, 'read_byte_data', slaveAddr, adr)
+
+    def write_byte_data(self, slaveAddr, adr, value):
+        return self._transaction(slaveAddr, 1, 'write_byte_data', slaveAddr, adr, value)
+
+    def read_i2c_block_data(self, slaveAddr, adr, length):
+        return self._transaction(slaveAddr, 0, 'read_i2c_block_data', slaveAddr, adr, length)
+
+    def write_i2c_block_data(self, slaveAddr, adr, values):
+        return self._transaction(slaveAddr, 1, 'write_i2c_block_data', slaveAddr, adr, values)
+
+
+globI2cBus = I2cBus()
+
+
+# Log the number of transactions per device, the number of times the bus was opened and the command throughput
+# since the previous call.
+def logMetrics():
+    global globMetricsTime, globMetricsNofCommands
+    counters = dict(globI2cBus.counters)
+    logging.getLogger("MyLog").info('I2C: opens ' + str(globI2cBus.nofOpens) + ', open failures ' + str(globI2cBus.nofOpenFailures) + ', ' +
+                                    ', '.join([hex(slaveAddr) + ' reads ' + str(c[0]) + ' writes ' + str(c[1]) + ' errors ' + str(c[2])
+                                               for (slaveAddr, c) in sorted(counters.items())]))
+    duration = time.time() - globMetricsTime
+    logging.getLogger("MyLog").info('I2C: commands ' + str(globNofCommands) + ', handshake timeouts ' + str(globNofHandshakeTimeouts) +
+                                    ', rejected ' + str(globNofRejected) + ', ' +
+                                    str(round((globNofCommands - globMetricsNofCommands) / max(duration, 1.0), 2)) + ' commands/s')
+    globMetricsTime = time.time()
+    globMetricsNofCommands = globNofCommands
+
+
 def read_byte(slaveAddr, adr):
     try:
-        bus = get_smbus()
-        byte = bus.read_byte_data(slaveAddr, adr)
+        byte = globI2cBus.read_byte_data(slaveAddr, adr)
         return byte
     except Exception,e:
         logging.getLogger("MyLog").info('I2C read_byte exception: ' + str(e))
         return 0
 
+# Read length bytes in one transaction. Returns a list of the bytes, or None when the read failed.
+def read_block(slaveAddr, adr, length):
+    try:
+        return globI2cBus.read_i2c_block_data(slaveAddr, adr, length)
+    except Exception,e:
+        logging.getLogger("MyLog").info('I2C read_block exception: ' + str(e))
+        return None
+
 def read_word(slaveAddr, adr):
     try:
-        bus = get_smbus()
-        high = bus.read_byte_data(slaveAddr, adr)
-        low = bus.read_byte_data(slaveAddr, adr+1)
+        high = globI2cBus.read_byte_data(slaveAddr, adr)
+        low = globI2cBus.read_byte_data(slaveAddr, adr+1)
         val = (high << 8) + low
         return val
     except Exception,e:
         logging.getLogger("MyLog").info('I2C read_word exception: ' + str(e))
         return 0
 
+# Returns a framed command: the sequence number, the command, the number of parameters, the parameters and a checksum
+# which makes the sum of all these bytes 0 modulo 256. The Arduino drops a frame with a wrong length or checksum.
+def makeFrame(seq, command, parameters):
+    frame = [int(seq), int(command), len(parameters)] + [int(p) & 0xff for p in parameters]
+    return frame + [-sum(frame) & 0xff]
+
+# Write a command with its parameters in one transaction, so it can not be mixed up with a command of another thread.
+# Call it with globI2cLock taken, it numbers the commands. Returns the sequence number, or None when the command is not sent.
+# A command is only written when the previous command is handled, or when the Arduino has no command pending anymore,
+# which means the previous frame was dropped. Otherwise the Arduino would drop this frame, so it is not sent.
+# urgent: True for a stop, the Arduino handles a stop at once, also while a command is pending.
+def write_frame(slaveAddr, command, parameters, urgent = False):
+    global globCommandSeq, globNofCommands, globNofRejected
+    pendingSeq = globPendingSeqs.get(slaveAddr)
+    if pendingSeq is not None and not urgent and not waitConsumed(slaveAddr, pendingSeq):
+        if read_byte(slaveAddr, RegisterPending) != 0:
+            globNofRejected += 1
+            logging.getLogger("MyLog").info('I2C write_frame: command ' + str(pendingSeq) + ' still pending, command ' + str(command) + ' not sent')
+            return None
+        globPendingSeqs.pop(slaveAddr, None)
+    # Sequence number 0 is never sent, it is the initial value of the register of the Arduino.
+    globCommandSeq = globCommandSeq % 255 + 1
+    try:
+        globI2cBus.write_i2c_block_data(slaveAddr, FrameMarker, makeFrame(globCommandSeq, command, parameters))
+    except Exception,e:
+        logging.getLogger("MyLog").info('I2C write_frame exception: ' + str(e))
+        return None
+    globNofCommands += 1
+    globPendingSeqs[slaveAddr] = globCommandSeq
+    return globCommandSeq
+
+# The Arduino does not buffer the I2C commands, a command written before the previous one is handled overwrites it.
+# Instead of a fixed delay after every command, poll the register with the sequence number of the last handled command
+# until it is seq, at most timeout seconds. A frame which the Arduino dropped never shows up and times out.
+# A command which times out stays pending, write_frame() checks it again before the next command.
+# Returns True when the command is handled.
+def waitConsumed(slaveAddr, seq, timeout = HandshakeTimeout):
+    global globNofHandshakeTimeouts
+    startTime = latency.now()
+    while True:
+        try:
+            if globI2cBus.read_byte_data(slaveAddr, RegisterConsumed) == seq:
+                latency.record('i2c', 'handshake', latency.now() - startTime)
+                if globPendingSeqs.get(slaveAddr) == seq:
+                    del globPendingSeqs[slaveAddr]
+                return True
+        except Exception,e:
+            pass
+        if latency.now() - startTime > timeout:
+            break
+        time.sleep(HandshakePollInterval)
+    globNofHandshakeTimeouts += 1
+    logging.getLogger("MyLog").info('I2C waitConsumed: command ' + str(seq) + ' not handled within ' + str(timeout) + ' s')
+    return False
+
 def read_word_2c(slaveAddr, adr):
     try:
         val = read_word(slaveAddr, adr)
@@ -65,7 +255,75 @@ def read_word_2c(slaveAddr, adr):
 
 def write_byte(slaveAddr, adr, value):
     try:
-        bus = get_smbus()
-        bus.write_byte_data(slaveAddr, adr, value)
+        globI2cBus.write_byte_data(slaveAddr, adr, value)
     except Exception,e:
         logging.getLogger("MyLog").info('I2C write_byte exception: ' + str(e))
+
+
+# A bus which only counts, to measure the overhead of the Python side of a transaction. Opening it opens a device node
+# like smbus.SMBus() does. Like the Arduino it reports a framed command as handled handleTime seconds after it is written.
+class FakeSmBus(object):
+    def __init__(self, handleTime = 0):
+        self.fd = open('/dev/null', 'rb')
+        self.handleTime = handleTime
+        self.seq = 0
+        self.writeTime = 0
+
+    def read_byte_data(self, slaveAddr, adr):
+        handled = time.time() - self.writeTime >= self.handleTime
+        if adr == RegisterConsumed and handled:
+            return self.seq
+        if adr == RegisterPending and not handled:
+            return 1
+        return 0
+
+    def write_byte_data(self, slaveAddr, adr, value):
+        pass
+
+    def read_i2c_block_data(self, slaveAddr, adr, length):
+        return [0] * length
+
+    def write_i2c_block_data(self, slaveAddr, adr, values):
+        self.seq = values[0]
+        self.writeTime = time.time()
+
+
+# The code below is used when this script is run as a separate python script.
+# It runs a micro-benchmark of a transaction with a new bus per transaction, as before, against the I2cBus.
+# Then it sends commands with the fixed delay of 0.1 s, as before, and with the handshake to a bus which handles
+# a command in --handletime seconds.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--commands', type=int, default=20)
+    parser.add_argument('--handletime', type=float, default=0.001)
+    args = parser.parse_args()
+
+    startTime = time.time()
+    for i in range(args.transactions):
+        FakeSmBus().write_byte_data(0x04, 0, 1)
+    duration = time.time() - startTime
+    print 'new bus per transaction:', int(args.transactions / duration), 'transactions/s'
+
+    i2cBus = I2cBus(FakeSmBus)
+    startTime = time.time()
+    for i in range(args.transactions):
+        i2cBus.write_byte_data(0x04, 0, 1)
+    duration = time.time() - startTime
+    print 'I2cBus:                 ', int(args.transactions / duration), 'transactions/s, opens', i2cBus.nofOpens, ', counters', i2cBus.counters
+
+    for name in ['fixed delay', 'handshake']:
+        globI2cBus = I2cBus(lambda: FakeSmBus(args.handletime))
+        globPendingSeqs.clear()
+        startTime = time.time()
+        for i in range(args.commands):
+            acquireLock()
+            seq = write_frame(0x04, 1, [192, 192, 128, 128])
+            if name == 'fixed delay':
+                time.sleep(0.1)
+            else:
+                waitConsumed(0x04, seq)
+            releaseLock()
+        duration = time.time() - startTime
+        print name + ':', round(args.commands / duration, 1), 'commands/s, lock hold', latency.getStatistics(latency.globPipelines['i2c']['lockHold'])
+        latency.globPipelines.clear()
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+import thread
+import threading
+import time
+import heapq
+import argparse
+import logging
+import i2c
+import latency
+
+
+# Global constants.
+PriorityStop = 0        # Stop the motors.
+PriorityMotion = 1      # Drive and turn.
+PriorityServo = 2       # Camera servo and light.
+PriorityTelemetry = 3   # Power info and compass reads.
+PriorityNames = ['stop', 'motion', 'servo', 'telemetry']
+
+# Global variables.
+globI2cDispatcher = None
+globI2cDispatcherLock = thread.allocate_lock()
+
+
+# The I2cFuture gives the result of a job when the dispatcher ran it.
+# A job which is superseded by a newer job with the same key is never run, its result is None.
+class I2cFuture(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.superseded = False
+
+    def set(self, result):
+        self.result = result
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    # Wait until the job is run or superseded and return its result.
+    def wait(self, timeout = None):
+        self.event.wait(timeout)
+        return self.result
+
+
+# The I2cDispatcher runs all I2C jobs one after the other in its own thread, the job with the highest priority first,
+# and jobs with the same priority in the order they were submitted. Before, every thread took globI2cLock itself
+# and the thread which was first won, so a stop of the motors could wait behind a power info poll and a compass read.
+# Now a stop waits at most for the job in progress: one command with its handshake, see i2c.waitConsumed().
+# A job with a key replaces a queued job with the same key, so when the FPV sends new speeds faster than they can be
+# sent to the Arduino, only the latest speed is sent. A job never replaces a queued job with a higher priority, so a
+# motion command can not remove a queued stop: it is queued behind the stop, which is sent first.
+# The time a job waits in the queue is added to the histogram 'queue <priority>' of the 'i2c' pipeline.
+class I2cDispatcher(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []         # Heap of [priority, order, job, future, key, submit time], job is None when superseded.
+        self.keys = {}          # Key -> queued entry.
+        self.order = 0
+        self.nofJobs = [0] * len(PriorityNames)
+        self.nofCoalesced = 0
+        self.nofExceptions = 0
+        thread.start_new_thread(self._dispatcherThread, ())
+
+    # Queue a job, a function without parameters which does the I2C transactions. Returns an I2cFuture.
+# When a queued job with the same key has a higher priority, both are kept and the key refers to the new job.
+    def submit(self, priority, job, key = None):
+        future = I2cFuture()
+        self.condition.acquire()
+        if key is not None and key in self.keys and self.keys[key][0] >= priority:
+            entry = self.keys[key]
+            entry[2] = None
+            entry[3].superseded = True
+            entry[3].set(None)
+            self.nofCoalesced += 1
+        entry = [priority, self.order, job, future, key, latency.now()]
+        self.order += 1
+        heapq.heappush(self.queue, entry)
+        if key is not None:
+            self.keys[key] = entry
+        self.condition.notify()
+        self.condition.release()
+        return future
+
+    def _dispatcherThread(self):
+        while True:
+            self.condition.acquire()
+            while len(self.queue) == 0:
+                self.condition.wait()
+            (priority, order, job, future, key, submitTime) = heapq.heappop(self.queue)
+            if key is not None and self.keys.get(key) is not None and self.keys[key][1] == order:
+                del self.keys[key]
+            self.condition.release()
+            if job is None:
+                continue
+            latency.record('i2c', 'queue ' + PriorityNames[priority], latency.now() - submitTime)
+            self.nofJobs[priority] += 1
+            result = None
+            # The lock is still taken, so code which does not use the dispatcher can not interfere.
+            i2c.acquireLock()
+            try:
+                result = job()
+            except Exception,e:
+                self.nofExceptions += 1
+                logging.getLogger("MyLog").info('I2C dispatcher: exception: ' + str(e))
+            i2c.releaseLock()
+            future.set(result)
+
+
+# Returns the dispatcher, it is started at the first use.
+def getDispatcher():
+    global globI2cDispatcher
+    globI2cDispatcherLock.acquire()
+    if globI2cDispatcher is None:
+        globI2cDispatcher = I2cDispatcher()
+    globI2cDispatcherLock.release()
+    return globI2cDispatcher
+
+
+# Queue a job on the dispatcher, see I2cDispatcher.submit().
+def submit(priority, job, key = None):
+    return getDispatcher().submit(priority, job, key)
+
+
+# Log the number of jobs per priority and the number of superseded jobs.
+def logMetrics():
+    if globI2cDispatcher is None:
+        return
+    dispatcher = globI2cDispatcher
+    logging.getLogger("MyLog").info('I2C dispatcher: ' + ', '.join([PriorityNames[p] + ' ' + str(dispatcher.nofJobs[p]) for p in range(len(PriorityNames))]) +
+                                    ', coalesced ' + str(dispatcher.nofCoalesced) + ', exceptions ' + str(dispatcher.nofExceptions))
+
+
+# The code below is used when this script is run as a separate python script.
+# It polls the telemetry in one thread, like the status update thread, while another thread sends motor commands and
+# stops, and prints the time the stops and the motor commands waited in the queue.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--jobtime', type=float, default=0.01, help='time in seconds the I2C transactions of a job take')
+    args = parser.parse_args()
+
+    def job():
+        time.sleep(args.jobtime)
+
+    def telemetryThread():
+        while True:
+            submit(PriorityTelemetry, job, 'telemetry').wait()
+
+    thread.start_new_thread(telemetryThread, ())
+    startTime = time.time()
+    i = 0
+    while time.time() - startTime < args.duration:
+        if i % 10 == 9:
+            submit(PriorityStop, job, 'motor').wait()
+        else:
+            submit(PriorityMotion, job, 'motor')
+        time.sleep(0.005)
+        i += 1
+    stages = latency.getReport()['pipelines']['i2c']
+    for stage in stages:
+        if stage.startswith('queue'):
+            print stage + ':', stages[stage]
+    print 'jobs', globI2cDispatcher.nofJobs, ', coalesced', globI2cDispatcher.nofCoalesced
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+import thread
+import time
+import json
+import ctypes
+import ctypes.util
+import logging
+import collections
+
+
+# Global constants.
+HistorySize = 1000              # Number of latencies kept per stage, the histograms are over these last values.
+BucketEdges = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # Upper edges in ms of the histogram buckets, the last bucket is open.
+Percentiles = [50, 90, 99]
+LogInterval = 300               # Interval in seconds to write the histograms to the log.
+ClockMonotonic = 1              # CLOCK_MONOTONIC of <time.h> on Linux.
+
+# Global variables.
+globPipelines = collections.OrderedDict()   # Pipeline name -> stage name -> deque of latencies in seconds.
+globPipelinesLock = thread.allocate_lock()
+
+
+# The timestamps are taken from the monotonic clock, so they do not jump when the time is set by NTP,
+# which happens on the Pi after every boot. Python 2 has no time.monotonic(), so clock_gettime() is called directly.
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+except Exception,e:
+    clock_gettime = None
+
+
+# Returns the monotonic time in seconds, or the wall clock time when the monotonic clock is not available.
+def now():
+    if clock_gettime is not None:
+        t = Timespec()
+        if clock_gettime(ClockMonotonic, ctypes.byref(t)) == 0:
+            return t.tv_sec + t.tv_nsec * 1e-9
+    return time.time()
+
+
+# Add a latency in seconds to the histogram of a stage of a pipeline.
+def record(pipeline, stage, duration):
+    globPipelinesLock.acquire()
+    stages = globPipelines.setdefault(pipeline, collections.OrderedDict())
+    if stage not in stages:
+        stages[stage] = collections.deque(maxlen = HistorySize)
+    stages[stage].append(duration)
+    globPipelinesLock.release()
+
+
+# A Trace follows one frame or one command through a pipeline, for example from the stream read to the I2C write.
+# Every stage adds a timestamp with mark(). When the trace is finished the time between two stages is added to the
+# histogram of the later stage, and the time from the first to the last stage to the histogram 'total'.
+# A trace can be handed over to another thread, for example the move executor, which finishes it.
+class Trace(object):
+    def __init__(self, pipeline, stamps = []):
+        self.pipeline = pipeline
+        self.stamps = list(stamps)      # (stage, monotonic time) in the order of the stages.
+        self.finished = False
+
+    def mark(self, stage):
+        self.stamps.append((stage, now()))
+
+    def hasStage(self, stage):
+        return stage in [s for (s, t) in self.stamps]
+
+    # Add the stage latencies to the histograms, only the first call counts.
+    def finish(self):
+        if self.finished or len(self.stamps) == 0:
+            return
+        self.finished = True
+        for i in range(1, len(self.stamps)):
+            record(self.pipeline, self.stamps[i][0], self.stamps[i][1] - self.stamps[i - 1][1])
+        record(self.pipeline, 'total', self.stamps[-1][1] - self.stamps[0][1])
+
+
+# Returns the statistics of a list of latencies in seconds: count, percentiles and maximum in ms and the histogram.
+def getStatistics(durations):
+    values = sorted(durations)
+    statistics = {'count': len(values)}
+    if len(values) == 0:
+        return statistics
+    for p in Percentiles:
+        statistics['p' + str(p)] = round(values[min(len(values) * p / 100, len(values) - 1)] * 1000, 1)
+    statistics['max'] = round(values[-1] * 1000, 1)
+    histogram = [0] * (len(BucketEdges) + 1)
+    bucket = 0
+    for value in values:
+        while bucket < len(BucketEdges) and value * 1000 > BucketEdges[bucket]:
+            bucket += 1
+        histogram[bucket] += 1
+    statistics['histogram'] = histogram
+    return statistics
+
+
+# Returns the statistics of all stages of all pipelines, as sent to the websocket client.
+def getReport():
+    globPipelinesLock.acquire()
+    pipelines = [(pipeline, [(stage, list(durations)) for (stage, durations) in stages.items()]) for (pipeline, stages) in globPipelines.items()]
+    globPipelinesLock.release()
+    report = {'bucketEdgesMs': BucketEdges, 'pipelines': {}}
+    for (pipeline, stages) in pipelines:
+        report['pipelines'][pipeline] = collections.OrderedDict([(stage, getStatistics(durations)) for (stage, durations) in stages])
+    return report
+
+
+def getReportJson():
+    return json.dumps(getReport())
+
+
+# Write the percentiles of all stages to the log, one line per pipeline.
+def logReport():
+    report = getReport()
+    for pipeline in report['pipelines']:
+        stages = report['pipelines'][pipeline]
+        logging.getLogger("MyLog").info('latency: ' + pipeline + ': ' + ', '.join([stage + ' ' + str(stages[stage].get('p50')) + '/' + str(stages[stage].get('p99')) + ' ms'
+                                                                                  for stage in stages]) + ' (p50/p99)')
+
+
+def logThread(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            logReport()
+        except Exception,e:
+            logging.getLogger("MyLog").info('latency: exception: ' + str(e))
+
+
+# Write the histograms to the log every interval seconds.
+def startLogThread(interval = LogInterval):
+    thread.start_new_thread(logThread, (interval,))
+
+
+# The code below is used when this script is run as a separate python script.
+# It shows the resolution and the cost of the monotonic clock.
+if __name__ == '__main__':
+    print 'monotonic clock:', clock_gettime is not None
+    startTime = now()
+    for i in range(100000):
+        now()
+    print 'now():', round((now() - startTime) * 10, 3), 'us per call'
+    trace = Trace('test')
+    trace.mark('start')
+    time.sleep(0.01)
+    trace.mark('sleep')
+    trace.finish()
+    print json.dumps(getReport(), indent=2)
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+import re
+import os
+import time
+import argparse
+import StringIO
+import latency
+
+
+# Global constants.
+# mjpg_streamer sends every frame as one part of a multipart http response, for example:
+#   --boundarydonotcross
+#   Content-Type: image/jpeg
+#   Content-Length: 41523
+#   X-Timestamp: 1467.123456
+#   <empty line>
+#   <Content-Length bytes of JPEG data>
+ChunkSize = 16384            # Number of bytes read from the stream in one go when the frame length is not known.
+HeaderChunkSize = 256        # Number of bytes read while looking for a part header, small so a read never waits for the next frame.
+BufferSize = 1024 * 1024     # Initial size of the parse buffer, must be larger than the largest frame including its header.
+MaxHeaderSize = 1024         # A part header larger than this is considered garbage and is skipped.
+ContentLengthExpr = re.compile(r'Content-Length:\s*(\d+)', re.IGNORECASE)
+
+
+# The MjpegParser reads a multipart MJPEG stream in large chunks into one preallocated bytearray.
+# Frames are handed out as a memoryview on this bytearray, so no copy is made of the JPEG data.
+# The returned frame is only valid until the next call of readFrame() because the buffer is reused.
+class MjpegParser(object):
+    def __init__(self, stream, bufferSize = BufferSize):
+        self.stream = stream
+        self.buffer = bytearray(bufferSize)
+        self.start = 0          # Start of the data in the buffer that is not parsed yet.
+        self.end = 0            # End of the valid data in the buffer.
+        self.scanPos = 0        # Position where the next search has to continue, so bytes are never scanned twice.
+        self.frameOffset = 0    # Offset of the last returned frame in the buffer.
+        self.frameLength = 0    # Length of the last returned frame.
+        self.headerTime = 0     # Monotonic time the header or the start of the last returned frame was read, see latency.py.
+        self.framesParsed = 0
+        self.bytesRead = 0
+        self.bytesCopied = 0    # Bytes copied inside the parser, so without the unavoidable copy from the stream into the buffer.
+
+    # Read the next size bytes from the stream into the buffer. Returns False at the end of the stream.
+    # A read on a socket blocks until all size bytes are received, so never ask for more than is needed.
+    def _fill(self, size = ChunkSize):
+        if self.start > 0 and len(self.buffer) - self.end < size:
+            # Not enough room at the end, move the unparsed data to the front of the buffer.
+            # A frame handed out before is no longer valid at this point.
+            unparsed = self.end - self.start
+            self.buffer[0:unparsed] = self.buffer[self.start:self.end]
+            self.bytesCopied += unparsed
+            self.scanPos -= self.start
+            self.start = 0
+            self.end = unparsed
+        if len(self.buffer) - self.end < size:
+            # Frame is larger than the buffer, allocate a larger one.
+            # A new bytearray is made instead of resizing because a resize is not allowed while a memoryview exists.
+            buffer = bytearray(max(len(self.buffer) * 2, self.end + size))
+            buffer[0:self.end] = self.buffer[0:self.end]
+            self.bytesCopied += self.end
+            self.buffer = buffer
+        chunk = self.stream.read(size)
+        if not chunk:
+            return False
+        # Slice assignment of equal length does not resize the bytearray.
+        self.buffer[self.end:self.end + len(chunk)] = chunk
+        self.end += len(chunk)
+        self.bytesRead += len(chunk)
+        return True
+
+    # Returns the frame found at [frameStart, frameEnd) and marks it as parsed.
+    def _frame(self, frameStart, frameEnd):
+        self.frameOffset = frameStart
+        self.frameLength = frameEnd - frameStart
+        self.start = self.scanPos = frameEnd
+        self.framesParsed += 1
+        return memoryview(self.buffer)[frameStart:frameEnd]
+
+    # Returns the next JPEG frame as a memoryview or None when the stream is closed.
+    def readFrame(self):
+        while True:
+            headerEnd = self.buffer.find('\r\n\r\n', max(self.scanPos, self.start), self.end)
+            if headerEnd == -1:
+                if self.end - self.start > MaxHeaderSize and self.buffer.find('\xff\xd8', self.start, self.end) != -1:
+                    # No multipart header found but there is JPEG data, the stream is probably not multipart.
+                    return self._readFrameWithoutHeader(self.start)
+                # Continue scanning where we stopped, keep 3 bytes because '\r\n\r\n' can be split over two chunks.
+                self.scanPos = max(self.end - 3, self.start)
+                if not self._fill(HeaderChunkSize):
+                    return None
+                continue
+
+            self.headerTime = latency.now()
+            contentLength = ContentLengthExpr.search(str(self.buffer[self.start:headerEnd]))
+            frameStart = headerEnd + 4
+            if contentLength is None:
+                # mjpg_streamer always sends a Content-Length, but fall back to searching the end of image marker.
+                return self._readFrameWithoutHeader(frameStart)
+
+            frameEnd = frameStart + int(contentLength.group(1))
+            while self.end < frameEnd:
+                # Offsets of the header can shift when the buffer is compacted, so keep them relative to start.
+                relStart = frameStart - self.start
+                relEnd = frameEnd - self.start
+                # The frame length is known, so read the rest of the frame at once.
+                if not self._fill(frameEnd - self.end):
+                    return None
+                frameStart = self.start + relStart
+                frameEnd = self.start + relEnd
+            if self.buffer[frameStart:frameStart + 2] == '\xff\xd8':
+                return self._frame(frameStart, frameEnd)
+            # Content-Length does not point to a JPEG, skip this header and resynchronize on the next one.
+            self.start = self.scanPos = frameStart
+
+    # Search a frame by its start of image (ff d8) and end of image (ff d9) markers.
+    def _readFrameWithoutHeader(self, searchStart):
+        relSearchStart = searchStart - self.start
+        self.headerTime = latency.now()
+        while True:
+            searchStart = self.start + relSearchStart
+            soi = self.buffer.find('\xff\xd8', searchStart, self.end)
+            if soi != -1:
+                eoi = self.buffer.find('\xff\xd9', max(self.scanPos, soi + 2), self.end)
+                if eoi != -1:
+                    return self._frame(soi, eoi + 2)
+                # Keep 1 byte because the end of image marker can be split over two chunks.
+                self.scanPos = max(self.end - 1, soi + 2)
+            if not self._fill():
+                return None
+
+
+# The original frame reader of run_dfrobot.getNewImage(), only used for the benchmark below.
+# It returns the frames and the number of bytes copied.
+def legacyReadFrames(stream):
+    bytes = ''
+    bytesCopied = 0
+    frames = []
+    while True:
+        chunk = stream.read(1024)
+        if not chunk:
+            return frames, bytesCopied
+        bytes += chunk
+        bytesCopied += len(bytes)
+        a = bytes.find('\xff\xd8')
+        b = bytes.find('\xff\xd9')
+        if a != -1 and b != -1:
+            jpg = bytes[a:b+2]
+            bytes = bytes[b+2:]
+            bytesCopied += len(jpg) + len(bytes)
+            frames.append(len(jpg))
+
+
+# Make a stream which looks like the mjpg_streamer output, with frames of about frameSize bytes.
+def makeTestStream(nofFrames, frameSize):
+    parts = []
+    for i in range(nofFrames):
+        # Entropy coded JPEG data never contains an unstuffed 0xff so remove them.
+        jpg = '\xff\xd8' + os.urandom(frameSize + (i % 7) * 100).replace('\xff', '\x00') + '\xff\xd9'
+        parts.append('--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpg)) + '\r\nX-Timestamp: ' + str(i) + '.0\r\n\r\n' + jpg + '\r\n')
+    return ''.join(parts)
+
+
+# The code below is used when this script is run as a separate python script.
+# It runs a micro-benchmark of the legacy frame reader against the MjpegParser.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--framesize', type=int, default=60000)
+    args = parser.parse_args()
+
+    data = makeTestStream(args.frames, args.framesize)
+
+    startTime = time.time()
+    frames, bytesCopied = legacyReadFrames(StringIO.StringIO(data))
+    duration = time.time() - startTime
+    print 'legacy:      ', len(frames), 'frames,', round(len(frames) / duration, 1), 'frames/s,', bytesCopied / len(frames), 'bytes copied per frame'
+
+    startTime = time.time()
+    mjpegParser = MjpegParser(StringIO.StringIO(data))
+    nofFrames = 0
+    while mjpegParser.readFrame() is not None:
+        nofFrames += 1
+    duration = time.time() - startTime
+    print 'MjpegParser: ', nofFrames, 'frames,', round(nofFrames / duration, 1), 'frames/s,', mjpegParser.bytesCopied / nofFrames, 'bytes copied per frame'
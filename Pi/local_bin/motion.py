@@ -0,0 +1,284 @@
+#!/usr/bin/python
+import os
+import sys
+import glob
+import time
+import gc
+import argparse
+import logging
+import cv2
+import numpy as np
+import capture
+
+
+# Motion detection constants.
+AnalysisScale = 4                   # Motion is detected on an image which is AnalysisScale times smaller in both directions: 1, 2, 4 or 8.
+GrayLevelDifferenceTreshold = 80    # The larger this number the larger the graylevel difference must be to be considered as true motion.
+MinContourArea = 100                # The larger this number the larger the motion contours must be to be considerd as true motion. Calibrated with 640 * 480 image.
+MaxNofContours = 200                # Maximum number of contours otherwise it will not be considered as true motion.
+BlurSize = 21                       # Size of the Gaussian blur kernel. Calibrated with 800 * 600 image.
+MinNofConsecutiveMotions = 3        # Number of images in sequence with motion before true motion is detected.
+BackgroundEngine = 'diff'           # 'diff' compares with the previous image, 'average' with a running average, 'mog2' uses a mixture of Gaussians model.
+                                    # The thresholds above are calibrated with 'diff', compare the engines with the benchmark below before switching.
+LearningRate = 0.05                 # Weight of a new image in the background model of 'average' and 'mog2', at 2 fps 0.05 adapts in about 10 seconds.
+Mog2ShadowValue = 127               # MOG2 marks shadows with this value, they are not considered as motion.
+
+
+# The BufferPool keeps the numpy buffers of the motion detection, so they are allocated once and reused for every frame.
+# The OpenCV functions write into them with their dst argument. A buffer is only allocated again when its shape changes.
+class BufferPool(object):
+    def __init__(self):
+        self.buffers = {}
+        self.nofAllocations = 0     # Number of buffers allocated since the start, stays constant after the first frames.
+        self.nofBytes = 0           # Number of bytes in the pool.
+
+    def get(self, name, shape, dtype = np.uint8):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            if buf is not None:
+                self.nofBytes -= buf.nbytes
+            buf = np.empty(shape, dtype)
+            self.buffers[name] = buf
+            self.nofAllocations += 1
+            self.nofBytes += buf.nbytes
+        return buf
+
+
+# The background engines return the foreground of a blurred grayscale image as a black and white image,
+# or None as long as there is no background yet. The returned image is a pool buffer which is overwritten by the next frame.
+
+# The original engine, the difference with the previous image.
+class FramePairBackground(object):
+    def __init__(self, learningRate, pool):
+        self.pool = pool
+        self.hasPrev = False
+
+    def foreground(self, img_gray):
+        prev = self.pool.get('prev', img_gray.shape)
+        if not self.hasPrev:
+            prev[...] = img_gray
+            self.hasPrev = True
+            return None
+        img_gray_diff = cv2.absdiff(img_gray, prev, self.pool.get('diff', img_gray.shape))
+        prev[...] = img_gray
+        return cv2.threshold(img_gray_diff, GrayLevelDifferenceTreshold, 255, cv2.THRESH_BINARY, self.pool.get('bw', img_gray.shape))[1]
+
+
+# The background is the running average of the images, kept in a float buffer which is allocated once.
+# Noise and flicker are averaged out and slow lighting changes are followed with the learning rate.
+class RunningAverageBackground(object):
+    def __init__(self, learningRate, pool):
+        self.learningRate = learningRate
+        self.pool = pool
+        self.hasAverage = False
+
+    def foreground(self, img_gray):
+        average = self.pool.get('average', img_gray.shape, np.float32)
+        if not self.hasAverage:
+            average[...] = img_gray
+            self.hasAverage = True
+            return None
+        # Compare with the background before the image is added to it.
+        background = cv2.convertScaleAbs(average, self.pool.get('background', img_gray.shape))
+        img_gray_diff = cv2.absdiff(img_gray, background, self.pool.get('diff', img_gray.shape))
+        cv2.accumulateWeighted(img_gray, average, self.learningRate)
+        return cv2.threshold(img_gray_diff, GrayLevelDifferenceTreshold, 255, cv2.THRESH_BINARY, self.pool.get('bw', img_gray.shape))[1]
+
+
+# The background is modelled per pixel by a mixture of Gaussians, which also copes with repetitive motion like leaves.
+class Mog2Background(object):
+    def __init__(self, learningRate, pool):
+        self.learningRate = learningRate
+        self.pool = pool
+        if hasattr(cv2, 'createBackgroundSubtractorMOG2'):
+            self.subtractor = cv2.createBackgroundSubtractorMOG2()
+        else:
+            self.subtractor = cv2.BackgroundSubtractorMOG2()
+        self.nofImages = 0
+
+    def foreground(self, img_gray):
+        mask = self.subtractor.apply(img_gray, self.pool.get('mask', img_gray.shape), self.learningRate)
+        self.nofImages += 1
+        if self.nofImages == 1:
+            # Everything is foreground until the model has seen an image.
+            return None
+        return cv2.threshold(mask, Mog2ShadowValue, 255, cv2.THRESH_BINARY, self.pool.get('bw', img_gray.shape))[1]
+
+
+BackgroundEngines = {'diff': FramePairBackground, 'average': RunningAverageBackground, 'mog2': Mog2Background}
+
+
+# The MotionDetector compares each image with the background of the selected engine and detects motion when the
+# difference is large enough in MinNofConsecutiveMotions images in sequence.
+# The analysis is done on a reduced grayscale image. The blur size and contour area are scaled
+# with it and the bounding boxes are mapped back to full resolution for annotation.
+# All intermediate images are kept in a BufferPool, only the decoded image is allocated per frame.
+class MotionDetector(object):
+    def __init__(self, width, height, scale = AnalysisScale, engine = BackgroundEngine, learningRate = LearningRate):
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.engine = engine
+        self.learningRate = learningRate
+        # Blur size must be odd.
+        self.blurSize = max(3, int(BlurSize / scale) | 1)
+        self.minContourArea = MinContourArea * (width * height) / (640.0 * 480.0) / (scale * scale)
+        self.timings = {}   # Duration in seconds of each stage for the last image.
+        self.pool = BufferPool()
+        self.reset()
+
+    def reset(self):
+        self.background = BackgroundEngines[self.engine](self.learningRate, self.pool)
+        self.noOfConsecutiveMotions = 0
+        self.nofContours = 0
+        self.boxes = []     # Bounding boxes (x, y, w, h) of the valid contours in full resolution.
+        self.box = None     # Outer bounding box (xLeft, yTop, xRight, yBottom) of all valid contours in full resolution.
+
+    # Start counting consecutive motions again, for example after a motion video is finished.
+    def resetMotionCount(self):
+        self.noOfConsecutiveMotions = 0
+
+    # The frame is not analysed because the scene is static, see capture.StaticSceneGate. It counts as a frame without motion.
+    def skip(self):
+        self.boxes = []
+        self.box = None
+        self.timings = {}
+        self.noOfConsecutiveMotions = 0
+
+    # Returns True when motion is detected in this frame and the MinNofConsecutiveMotions - 1 frames before.
+    def detect(self, frame):
+        self.boxes = []
+        self.box = None
+        self.timings = {}
+        startTime = time.time()
+        img_gray = frame.gray(self.scale)
+        if img_gray is None:
+            return False
+        decodeTime = time.time()
+        img_gray = cv2.GaussianBlur(img_gray, (self.blurSize, self.blurSize), 0, self.pool.get('blur', img_gray.shape))
+        blurTime = time.time()
+
+        img_bw_diff = self.background.foreground(img_gray)
+        if img_bw_diff is None:
+            return False
+        diffTime = time.time()
+        # findContours modifies the image, which is fine as the pool buffer is overwritten by the next frame anyway.
+        (cnts, _) = cv2.findContours(img_bw_diff, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        self.nofContours = len(cnts)
+
+        motion = False
+        # Loop over the contours.
+        # If number of contours is too high it is not considered true motion.
+        if len(cnts) < MaxNofContours:
+            for c in cnts:
+                # If the contour is too small, ignore it.
+                if cv2.contourArea(c) > self.minContourArea:
+                    x,y,w,h = cv2.boundingRect(c)
+                    self.boxes.append((x * self.scale, y * self.scale, w * self.scale, h * self.scale))
+            if len(self.boxes) > 0:
+                # Compute the outer bounding box of all valid contours.
+                xLeft = min([x for (x, y, w, h) in self.boxes])
+                xRight = max([x + w for (x, y, w, h) in self.boxes])
+                yTop = min([y for (x, y, w, h) in self.boxes])
+                yBottom = max([y + h for (x, y, w, h) in self.boxes])
+                self.box = (xLeft, yTop, xRight, yBottom)
+                totalArea = (xRight - xLeft) * (yBottom - yTop)
+                if totalArea < (self.width * self.height) * 0.5:
+                    # Motion is detected for this image.
+                    # Consider true motion detected only after sufficient images in sequence with motion.
+                    self.noOfConsecutiveMotions = self.noOfConsecutiveMotions + 1
+                    motion = self.noOfConsecutiveMotions >= MinNofConsecutiveMotions
+                else:
+                    # Reset, images with motion have to be in sequence.
+                    self.noOfConsecutiveMotions = 0
+        endTime = time.time()
+
+        self.timings = {'decode': decodeTime - startTime, 'blur': blurTime - decodeTime, 'diff': diffTime - blurTime, 'contours': endTime - diffTime}
+        return motion
+
+
+# Returns the resident set size of this process in bytes, or 0 if it is not available.
+def getRss():
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    except Exception,e:
+        pass
+    return 0
+
+
+# Log the buffer pool and memory statistics of the motion detection.
+def logMetrics(motionDetector):
+    logging.getLogger("MyLog").info('motion: buffer pool ' + str(motionDetector.pool.nofBytes) + ' bytes, allocations ' + str(motionDetector.pool.nofAllocations) +
+                                    ', gc counts ' + str(gc.get_count()) + ', rss ' + str(getRss()) + ' bytes')
+
+
+# Returns the names and the bytes of all JPEG files in a directory, in the order of their names.
+def loadJpgs(directory):
+    jpgFiles = sorted(glob.glob(os.path.join(directory, '*.jpg')))
+    return [os.path.basename(jpgFile) for jpgFile in jpgFiles], [open(jpgFile, 'rb').read() for jpgFile in jpgFiles]
+
+
+# The code below is used when this script is run as a separate python script.
+# It runs the motion detection with several background engines and analysis scales over recorded images. It prints the
+# timings per stage, the number of motion events (each one is a Telegram video) and the agreement with the first configuration.
+# With --truth, a file with the names of the images that show true motion, one per line, the false positives are counted as well.
+# With --soak the images are replayed in a loop, as fast as possible, for the given number of hours of frames at --fps, to check that
+# the latency per frame and the resident memory stay stable.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='/home/pi/DFRobotUploads/benchmark')
+    parser.add_argument('--engines', default='diff,average,mog2')
+    parser.add_argument('--scales', default='1,2,4,8')
+    parser.add_argument('--learningrate', type=float, default=LearningRate)
+    parser.add_argument('--truth', default='')
+    parser.add_argument('--soak', type=float, default=0)
+    parser.add_argument('--fps', type=float, default=2)
+    args = parser.parse_args()
+
+    names, jpgs = loadJpgs(args.dir)
+    truth = None
+    if args.truth != '':
+        truth = set([line.strip() for line in open(args.truth) if line.strip() != ''])
+    height, width = capture.decodeGray(jpgs[0], 1).shape
+
+    if args.soak > 0:
+        motionDetector = MotionDetector(width, height, int(args.scales.split(',')[0]), args.engines.split(',')[0], args.learningrate)
+        nofFrames = int(args.soak * 3600 * args.fps)
+        reportInterval = int(600 * args.fps)  # Report every 10 minutes of frames.
+        latencies = []
+        for i in range(nofFrames):
+            frame = capture.Frame(i + 1, jpgs[i % len(jpgs)], 0)
+            startTime = time.time()
+            motionDetector.detect(frame)
+            latencies.append(time.time() - startTime)
+            if (i + 1) % reportInterval == 0 or i + 1 == nofFrames:
+                print str(round((i + 1) / args.fps / 60)) + ' min:', 'latency avg', round(sum(latencies) / len(latencies) * 1000, 2), 'ms, max', round(max(latencies) * 1000, 2), 'ms,',
+                print 'rss', getRss(), 'bytes, pool allocations', motionDetector.pool.nofAllocations, ', pool', motionDetector.pool.nofBytes, 'bytes, gc counts', gc.get_count()
+                latencies = []
+        sys.exit(0)
+
+    reference = None
+    for engine in args.engines.split(','):
+        for scale in [int(scale) for scale in args.scales.split(',')]:
+            # Fresh frames for every configuration, so decoding is measured each time.
+            frames = [capture.Frame(i + 1, jpg, 0) for i, jpg in enumerate(jpgs)]
+            motionDetector = MotionDetector(width, height, scale, engine, args.learningrate)
+            totals = {}
+            decisions = []
+            for frame in frames:
+                decisions.append(motionDetector.detect(frame))
+                for stage in motionDetector.timings:
+                    totals[stage] = totals.get(stage, 0.0) + motionDetector.timings[stage]
+            if reference is None:
+                reference = decisions
+            nofEvents = sum([1 for i in range(len(decisions)) if decisions[i] and (i == 0 or not decisions[i - 1])])
+            agreement = sum([1 for (a, b) in zip(decisions, reference) if a == b]) / float(len(frames))
+            print engine, 'scale 1/' + str(scale) + ':', ', '.join([stage + ' ' + str(round(totals.get(stage, 0.0) / len(frames) * 1000, 2)) + ' ms' for stage in ['decode', 'blur', 'diff', 'contours']]),
+            print '| images with motion:', sum(decisions), 'of', len(frames), '| motion events:', nofEvents, '| agreement:', round(agreement * 100, 1), '%',
+            if truth is not None:
+                falsePositives = sum([1 for (name, decision) in zip(names, decisions) if decision and name not in truth])
+                falseNegatives = sum([1 for (name, decision) in zip(names, decisions) if not decision and name in truth])
+                print '| false positives:', falsePositives, '| false negatives:', falseNegatives,
+            print
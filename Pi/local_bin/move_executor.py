@@ -0,0 +1,129 @@
+#!/usr/bin/python
+import thread
+import threading
+import time
+import collections
+import logging
+import own_util
+
+
+# Global constants.
+SettleTime = 0.5        # Default time in seconds after a move before the robot and the camera are considered settled.
+
+
+# Returns the duration in seconds of a move with delay [1..127], see own_util.driveAndTurn().
+# The Arduino maps the delay [1..127] to [50..1000] ms.
+def getMoveDuration(delayMove):
+    delayMove = min(max(int(delayMove), 1), 127)
+    return (50 + (delayMove - 1) * 950 / 126.0) / 1000.0
+
+
+# The MoveExecutor executes moves in its own thread, so the caller, for example the vision loop of the Home run,
+# can continue processing frames while the robot moves.
+# Moves are queued and executed one after the other. The state is:
+#   'moving':   a move is queued or the robot is moving.
+#   'settling': the last move is finished but the settle time of that move has not passed yet.
+#   'settled':  the robot is standing still and the camera is stable.
+# The next queued move is sent when the previous move is done and its settle time has passed, so a sequence of moves,
+# like the approach correction, pauses between the moves for the robot and the camera to settle.
+# Queued moves can be cancelled. A move which was already sent to the Arduino is only interrupted by stop().
+class MoveExecutor(object):
+    def __init__(self, doMove):
+        self.doMove = doMove
+        self.condition = threading.Condition()
+        self.moves = collections.deque()    # Queued moves (direction, delayMove, settleTime, trace).
+        self.busy = False                   # True while a move is being sent to the Arduino.
+        self.moveEndTime = 0                # Time the last sent move is finished.
+        self.settledTime = 0                # Time the robot is settled after the last sent move.
+        self.nofMoves = 0
+        self.nofCancelled = 0
+        self.nofQueued = 0                  # Number of moves queued since the start.
+        self.lastMove = ('', 0)             # (direction, delayMove) of the last queued move.
+        thread.start_new_thread(self._executorThread, ())
+
+    # Queue a move, see own_util.move() for direction and delayMove.
+    # The optional latency.Trace of the frame the move is decided on is marked 'decision' here and finished after the I2C write.
+    def move(self, direction, delayMove, settleTime = SettleTime, trace = None):
+        if trace is not None:
+            trace.mark('decision')
+        self.condition.acquire()
+        self.moves.append((direction, delayMove, settleTime, trace))
+        self.nofQueued += 1
+        self.lastMove = (direction, delayMove)
+        self.condition.notify_all()
+        self.condition.release()
+
+    # Cancel the queued moves.
+    def cancel(self):
+        self.condition.acquire()
+        self.nofCancelled += len(self.moves)
+        self.moves.clear()
+        self.condition.notify_all()
+        self.condition.release()
+
+    # Cancel the queued moves and stop the motors.
+    def stop(self):
+        self.cancel()
+        own_util.driveAndTurn(0, 0, 0, 0, 0, self.doMove)
+
+    # The state is evaluated under the condition, so a move which the executor thread takes from the queue is always
+    # seen as queued or busy. The condition uses a reentrant lock, so these functions can call each other.
+    def isMoving(self):
+        self.condition.acquire()
+        moving = self.busy or len(self.moves) > 0 or time.time() < self.moveEndTime
+        self.condition.release()
+        return moving
+
+    def isSettled(self):
+        self.condition.acquire()
+        settled = not self.isMoving() and time.time() >= self.settledTime
+        self.condition.release()
+        return settled
+
+    def getState(self):
+        self.condition.acquire()
+        if self.isMoving():
+            state = 'moving'
+        elif not self.isSettled():
+            state = 'settling'
+        else:
+            state = 'settled'
+        self.condition.release()
+        return state
+
+    # Wait until all queued moves are done and the robot is settled, at most timeout seconds.
+    # Returns True when settled.
+    def waitSettled(self, timeout):
+        endTime = time.time() + timeout
+        while not self.isSettled():
+            if time.time() >= endTime:
+                return False
+            time.sleep(0.02)
+        return True
+
+    def _executorThread(self):
+        while True:
+            self.condition.acquire()
+            while len(self.moves) == 0:
+                self.condition.wait()
+            self.busy = True
+            (direction, delayMove, settleTime, trace) = self.moves.popleft()
+            self.condition.release()
+            (moveEndTime, settledTime) = (self.moveEndTime, self.settledTime)
+            try:
+                startTime = time.time()
+                own_util.move(direction, delayMove, 0, self.doMove, trace)
+                if trace is not None:
+                    trace.finish()
+                moveEndTime = startTime + getMoveDuration(delayMove)
+                settledTime = moveEndTime + settleTime
+                self.nofMoves += 1
+            except Exception,e:
+                logging.getLogger("MyLog").info('move executor: exception: ' + str(e))
+            # The end of the move is set together with busy, so the state does not show settled in between.
+            self.condition.acquire()
+            (self.moveEndTime, self.settledTime) = (moveEndTime, settledTime)
+            self.busy = False
+            self.condition.release()
+            # The Arduino executes the move now, wait until it is finished and settled before sending the next one.
+            time.sleep(max(self.settledTime - time.time(), 0))
@@ -9,15 +9,23 @@ import inspect
 import logging
 import numpy as np
 import i2c
+import i2c_dispatcher
 import own_gpio
 
 
+# Internal power levels [0..1023] of an empty and a full battery, to map the battery level to a percentage.
+# Calibrate these with the voltage divider of INT_POWER_SENSE_PIN, the defaults map the full range of the ADC.
+BatteryEmptyLevel = 0
+BatteryFullLevel = 1023
+
 # Global variables.
 slaveAddressArduino = 0x04
 globUptime = 0
 globExtPowerAvailable = False
 globIntPowerLevel = 0
 globIsCharging = False
+globTelemetry = None        # Last TelemetrySnapshot of the Arduino, see updatePowerInfo().
+globNofTelemetryErrors = 0
 globWifiLevel = 0
 globDistance = 1000
 globDoHomeRun = False
@@ -60,16 +68,18 @@ def ownReboot(reason):
 
 
 # Move for a short distance. Used for safe remote control.
-def move(direction, delayMove, delayAfterMove, doMove):
+def move(direction, delayMove, delayAfterMove, doMove, trace = None, wait = True):
     if doMove:
         if direction == 'forward':
-            driveAndTurn(63, 0, delayMove, 0, delayAfterMove, doMove)
+            driveAndTurn(63, 0, delayMove, 0, delayAfterMove, doMove, trace, wait)
         elif direction == 'backward':
-            driveAndTurn(-63, 0, delayMove, 0, delayAfterMove, doMove)
+            driveAndTurn(-63, 0, delayMove, 0, delayAfterMove, doMove, trace, wait)
         elif direction == 'left':
-            driveAndTurn(0, -63, 0, delayMove, delayAfterMove, doMove)
+            driveAndTurn(0, -63, 0, delayMove, delayAfterMove, doMove, trace, wait)
         elif direction == 'right':
-            driveAndTurn(0, 63, 0, delayMove, delayAfterMove, doMove)
+            driveAndTurn(0, 63, 0, delayMove, delayAfterMove, doMove, trace, wait)
+    elif trace is not None and not wait:
+        trace.finish()
 
 
 # The driveAndTurn() function lets the robot drive and turn temporary or infinitely.
@@ -81,125 +91,140 @@ def move(direction, delayMove, delayAfterMove, doMove):
 # delayTurn:  [0..127], where 0 means infinite, 1 means 50 ms and 127 means 1000 ms.
 # delayAfterMove is used in autonomous mode to synchronize the python script with the movements and camera stabilization of the robot.
 # doMove: False to disable the actual move, for testing purposes.
-def driveAndTurn(speedStraight, speedTurn, delayDrive, delayTurn, delayAfterMove, doMove):
+# trace: optional latency.Trace, the stages 'i2cIssued' and 'i2cDone' are marked when the I2C write starts and is done.
+# wait: False to return before the command is sent, like the FPV does. A command which is not sent yet is replaced by
+#       a newer one, so only the latest speed is sent. A stop (both speeds zero) is sent before all other commands.
+def driveAndTurn(speedStraight, speedTurn, delayDrive, delayTurn, delayAfterMove, doMove, trace = None, wait = True):
     if doMove:
-        # Create i2c lock if it does not exist yet.
-        i2c.createI2cLock()
-        # Lock i2c communication for this thread.
-        i2c.globI2cLock.acquire()
+        if int(speedStraight) == 0 and int(speedTurn) == 0:
+            priority = i2c_dispatcher.PriorityStop
+        else:
+            priority = i2c_dispatcher.PriorityMotion
         # I2C command 1.
-        i2c.write_byte(slaveAddressArduino, 0, 1)
         # Because the I2C parameters are in the range of [128..255], speed range [-63..63] is mapped to [129..255].
         # Start with 129 to keep backward / forward or left / right symmetry around 192.
-        i2c.write_byte(slaveAddressArduino, 0, int(speedStraight) + 192)
-        i2c.write_byte(slaveAddressArduino, 0, int(speedTurn) + 192)
         # Because the I2C parameters are in the range of [128..255], delay range [0..127] is mapped to [128..255].
-        i2c.write_byte(slaveAddressArduino, 0, int(delayDrive) + 128)
-        i2c.write_byte(slaveAddressArduino, 0, int(delayTurn) + 128)
-        # Delay for i2c communication.
-        time.sleep(i2c.globI2cDelay)
-        # Release i2c communication for this thread.
-        i2c.globI2cLock.release()
+        sendCommand(1, [int(speedStraight) + 192, int(speedTurn) + 192, int(delayDrive) + 128, int(delayTurn) + 128], trace,
+                    priority, 'motor', wait)
+    elif trace is not None and not wait:
+        trace.finish()
     # Still delay when doMove == False to have similar timing.
     time.sleep(delayAfterMove)
 
 
+# Send a command with its parameters to the Arduino in one I2C transaction, see i2c.write_frame().
+# The parameters keep the [128..255] range of the former byte protocol.
+# The command is sent by the I2C dispatcher thread, see i2c_dispatcher.I2cDispatcher, with this priority. A command
+# with a key replaces a command with the same key which is not sent yet.
+# trace: optional latency.Trace, the stages 'i2cIssued', 'i2cDone' and 'i2cConsumed' are marked.
+#        When the caller does not wait, the trace is finished when the command is sent.
+# wait: True to return when the command is sent, else it returns at once. Returns the i2c_dispatcher.I2cFuture.
+def sendCommand(command, parameters = [], trace = None, priority = i2c_dispatcher.PriorityServo, key = None, wait = True):
+    def job():
+        sendCommandLocked(command, parameters, trace)
+        if trace is not None and not wait:
+            trace.finish()
+    future = i2c_dispatcher.submit(priority, job, key)
+    if wait:
+        future.wait()
+    return future
+
+
+# Send a command with the i2c lock already taken by this thread.
+# Instead of a fixed delay, wait until the Arduino handled the command, so the next command does not overwrite it.
+def sendCommandLocked(command, parameters = [], trace = None):
+    if trace is not None:
+        trace.mark('i2cIssued')
+    # A stop is sent even when the previous command is still pending on the Arduino, see i2c.write_frame().
+    seq = i2c.write_frame(slaveAddressArduino, command, parameters, command == 1 and list(parameters[:2]) == [192, 192])
+    if trace is not None:
+        trace.mark('i2cDone')
+    if seq is not None:
+        i2c.waitConsumed(slaveAddressArduino, seq)
+    if trace is not None:
+        trace.mark('i2cConsumed')
+
+
 def moveCamRel(degrees, delay):
     if degrees >= -90 and degrees <= 90:
         if degrees > 0:
-            # Create i2c lock if it does not exist yet.
-            i2c.createI2cLock()
-            # Lock i2c communication for this thread.
-            i2c.globI2cLock.acquire()
             # I2C command 10.
-            i2c.write_byte(slaveAddressArduino, 0, 10)
-            i2c.write_byte(slaveAddressArduino, 0, 128 + int(degrees))
-            # Delay for i2c communication.
-            time.sleep(i2c.globI2cDelay)
-            # Release i2c communication for this thread.
-            i2c.globI2cLock.release()
+            sendCommand(10, [128 + int(degrees)])
         elif degrees < 0:
-            # Create i2c lock if it does not exist yet.
-            i2c.createI2cLock()
-            # Lock i2c communication for this thread.
-            i2c.globI2cLock.acquire()
             # I2C command 11.
-            i2c.write_byte(slaveAddressArduino, 0, 11)
-            i2c.write_byte(slaveAddressArduino, 0, 128 - int(degrees))
-            # Delay for i2c communication.
-            time.sleep(i2c.globI2cDelay)
-            # Release i2c communication for this thread.
-            i2c.globI2cLock.release()
+            sendCommand(11, [128 - int(degrees)])
         # Delay to let camera image stabilize.
         time.sleep(delay)
 
 
 def moveCamAbs(degrees, delay):
     if degrees >= 0 and degrees <= 90:
-        # Create i2c lock if it does not exist yet.
-        i2c.createI2cLock()
-        # Lock i2c communication for this thread.
-        i2c.globI2cLock.acquire()
         # I2C command 12.
-        i2c.write_byte(slaveAddressArduino, 0, 12)
-        i2c.write_byte(slaveAddressArduino, 0, 128 + int(degrees))
-        # Delay for i2c communication.
-        time.sleep(i2c.globI2cDelay)
-        # Release i2c communication for this thread.
-        i2c.globI2cLock.release()
+        sendCommand(12, [128 + int(degrees)])
         # Delay to let camera image stabilize.
         time.sleep(delay)
 
 
 def switchLight(on):
     if on == True:
-        # Create i2c lock if it does not exist yet.
-        i2c.createI2cLock()
-        # Lock i2c communication for this thread.
-        i2c.globI2cLock.acquire()
         # I2C command 20.
-        i2c.write_byte(slaveAddressArduino, 0, 20)
-        # Delay for i2c communication.
-        time.sleep(i2c.globI2cDelay)
-        # Release i2c communication for this thread.
-        i2c.globI2cLock.release()
+        sendCommand(20)
     else:
-        # Create i2c lock if it does not exist yet.
-        i2c.createI2cLock()
-        # Lock i2c communication for this thread.
-        i2c.globI2cLock.acquire()
         # I2C command 21.
-        i2c.write_byte(slaveAddressArduino, 0, 21)
-        # Delay for i2c communication.
-        time.sleep(i2c.globI2cDelay)
-        # Release i2c communication for this thread.
-        i2c.globI2cLock.release()
+        sendCommand(21)
+
+
+# The TelemetrySnapshot holds the telemetry of the Arduino of one I2C block read, see updatePowerInfo().
+# Every read makes a new snapshot which replaces globTelemetry at once, so a reader never mixes values of two reads.
+# The power levels are in the range [0..1023].
+class TelemetrySnapshot(object):
+    def __init__(self, extPowerLevel, intPowerLevel, isCharging, extPowerSwitchedOn, nofFrameErrors, timestamp):
+        self.extPowerLevel = extPowerLevel
+        self.intPowerLevel = intPowerLevel              # Can be from external power or the batteries.
+        self.isCharging = isCharging                    # External power is connected, so the batteries are charging.
+        self.extPowerSwitchedOn = extPowerSwitchedOn    # The Arduino switched to external power.
+        self.nofFrameErrors = nofFrameErrors            # Commands dropped by the Arduino, modulo 256.
+        self.timestamp = timestamp
+
 
+# Returns the TelemetrySnapshot of a telemetry block, or None when the checksum is wrong.
+# See updateTelemetry() of the Arduino sketch for the layout of the block.
+def parseTelemetry(block, timestamp):
+    if block is None or len(block) != i2c.TelemetrySize or sum(block) & 0xff != 0:
+        return None
+    return TelemetrySnapshot((block[0] << 8) + block[1], (block[2] << 8) + block[3], (block[4] & 1) != 0, (block[4] & 2) != 0,
+                             block[5], timestamp)
 
+
+# Read the power info by the I2C dispatcher at the lowest priority, so it does not delay a stop of the motors.
+# The power levels, the charging state and the state of the external power switch are read in one transaction.
 def updatePowerInfo():
-    global globExtPowerAvailable, globIntPowerLevel
-    # Create i2c lock if it does not exist yet.
-    i2c.createI2cLock()
-    # Lock i2c communication for this thread.
-    i2c.globI2cLock.acquire()
-    # Going to read I2C data.
-    # Read external power level. If the level > 100, we assume external power is available.
-    i2c.write_byte(slaveAddressArduino, 0, 100)  # Command to indicate a read is going to follow.
-    i2c.write_byte(slaveAddressArduino, 0, 128)  # 128 means read external power level.
-    if i2c.read_byte(slaveAddressArduino, 0) > 100:
-        globExtPowerAvailable = True
-    else:
-        globExtPowerAvailable = False
-    # Delay before retrieving the next power info.
-    time.sleep(i2c.globI2cDelay)
-    # Read internal power level. This power level can be from external power or the batteries.
-    i2c.write_byte(slaveAddressArduino, 0, 100)  # Command to indicate a read is going to follow.
-    i2c.write_byte(slaveAddressArduino, 0, 129)  # 129 means read internal power level.
-    globIntPowerLevel = i2c.read_byte(slaveAddressArduino, 0)
-    # Delay for i2c communication.
-    time.sleep(i2c.globI2cDelay)
-    # Release i2c communication for this thread.
-    i2c.globI2cLock.release()
+    i2c_dispatcher.submit(i2c_dispatcher.PriorityTelemetry, updatePowerInfoLocked, 'power').wait()
+
+
+def updatePowerInfoLocked():
+    global globTelemetry, globNofTelemetryErrors, globExtPowerAvailable, globIntPowerLevel, globIsCharging
+    telemetry = parseTelemetry(i2c.read_block(slaveAddressArduino, i2c.RegisterTelemetry, i2c.TelemetrySize), time.time())
+    if telemetry is None:
+        # Keep the previous snapshot.
+        globNofTelemetryErrors += 1
+        return
+    globTelemetry = telemetry
+    # External power is available when the Arduino sees it connected, with the threshold EXT_POWER_CONNECTED_LEVEL of
+    # the sketch, so the FPV page and the charging state agree. The internal level is mapped to [0..255] as before.
+    globExtPowerAvailable = telemetry.isCharging
+    globIntPowerLevel = telemetry.intPowerLevel / 4
+    globIsCharging = telemetry.isCharging
+
+
+# Returns the battery level in percent [0..100], from the internal power level between BatteryEmptyLevel and
+# BatteryFullLevel, or 0 when no telemetry is read yet.
+def getBatteryLevel():
+    telemetry = globTelemetry
+    if telemetry is None:
+        return 0
+    level = (telemetry.intPowerLevel - BatteryEmptyLevel) * 100 / (BatteryFullLevel - BatteryEmptyLevel)
+    return max(0, min(100, level))
 
 
 def updateDistanceInfo():
@@ -609,9 +609,9 @@ def handleIntent(intent, value, client):
             response = 'hi there!'
         elif intent == "battery":
             if own_util.globIsCharging == True:
-                response = 'I am charging, my battery level is ' + str(own_util.getBatteryLevel())
+                response = 'I am charging, my battery level is ' + str(own_util.getBatteryLevel()) + '%'
             else:
-                response = 'I am not charging, my battery level is ' + str(own_util.getBatteryLevel())
+                response = 'I am not charging, my battery level is ' + str(own_util.getBatteryLevel()) + '%'
         elif intent == "awake":
             response = 'I am awake for ' + own_util.getUptime()
         elif intent == "joke":
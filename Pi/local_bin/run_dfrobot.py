@@ -1,21 +1,31 @@
 #!/usr/bin/python
 import os
-import shutil
 import sys
 import thread
 import cv2
 import numpy as np
-import urllib
 import argparse
 import re
 import time
+import collections
 import compass
+import i2c
+import i2c_dispatcher
 import logging
 from logging import Formatter
 from logging.handlers import RotatingFileHandler
 import communication
 import personal_assistant
 import own_util
+import capture
+import clip
+import motion
+import docking
+import move_executor
+import session_log
+import vision_worker
+import latency
+import stream_manager
 
 # General constants.
 ImgWidth = 800
@@ -33,206 +43,127 @@ ImgAreaFactor = (ImgWidth * ImgHeight) / (640.0 * 480.0)  # Calibrated with 640
 # Blob detection constants
 SizeMinForCorrection = 30.0 * ImgWidthFactor  # Calibrated with 640 * 480 image.
 SizeMaxForCorrection = 40.0 * ImgWidthFactor  # Calibrated with 640 * 480 image.
+MinTrackConfidence = 0.3  # Minimum confidence of the marker tracker to steer on the predicted marker position when the marker is not found.
+HomeRunSettleTime = 0.5  # Time in seconds after a Home run move before a frame is used to decide the next move.
+HomeRunCorrectionSettleTime = 1.0  # Settle time after the approach correction, which ends with a 90 degrees turn.
 SizeSlow = 30.0 * ImgWidthFactor  # Calibrated with 640 * 480 image.
 SizeStop = 60.0 * ImgWidthFactor  # Calibrated with 640 * 480 image.
 # Motion detection constants.
 MotionDetectionBufferLength = FpsLq * 30  # Number of images in motion detection buffer.
 MotionDetectionBufferOffset = FpsLq * 3   # Number of images that are kept before the motion is detected.
-GrayLevelDifferenceTreshold = 80        # The larger this number the larger the graylevel difference must be to be considered as true motion.
-MinContourArea = 100 * ImgAreaFactor    # The larger this number the larger the motion contours must be to be considerd as true motion.
-MaxNofContours = 200                    # Maximum number of contours otherwise it will not be considered as true motion.
+MotionAnalysisScale = 4                   # Motion is detected on an image which is MotionAnalysisScale times smaller in both directions, see motion.py.
+MotionFpsActive = 5                       # Frame rate of the motion detection while there is motion, it is FpsLq when the scene is idle.
+MotionIdleTime = 10                       # Time in seconds without motion before the motion detection is back at FpsLq.
+LatencyLogInterval = 60                   # Interval in seconds to log the frame latency and the websocket server responsiveness.
 # Upload constants.
 NofMotionVideosToKeep = 10
 NofHomeRunVideosToKeep = 3
 
 # Global variables.
 globMyLog = None
-globBrightness = 0
+globCapture = None
+globClipWorker = None
+globMoveExecutor = None
+globVisionWorker = None
+globStreamManager = None
 
 # Initialization.
 doPrint = False
 doTestMotion = False
 doShow = False
 doMove = True
+usePoseCorrection = False
 logFilePath = ''
 
 
-def getNewImage():
-    global globContinueCapture, globBytes, globStream, globImg, globNewImageAvailable, globNewImageAvailableLock
-    global globBrightness
-
-    while globContinueCapture == True:
-        globBytes+=globStream.read(1024)
-        a = globBytes.find('\xff\xd8')
-        b = globBytes.find('\xff\xd9')
-        if a!=-1 and b!=-1:
-            jpg = globBytes[a:b+2]
-            globBytes= globBytes[b+2:]
-
-            img = cv2.imdecode(np.fromstring(jpg, dtype=np.uint8),cv2.CV_LOAD_IMAGE_COLOR)
-            # Get average brightness of hsv image by averaging the 'v' (value or brightness) bytes.
-            img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            totalPixel = cv2.sumElems(img_hsv)
-            globBrightness = totalPixel[2] / (ImgWidth * ImgHeight)
-            if doPrint:
-                print 'brightness:', globBrightness
-            # Keep critical section as short as possible.
-            globNewImageAvailableLock.acquire()
-            globImg = img
-            globNewImageAvailable = True
-            globNewImageAvailableLock.release()
-    # Close the stream to have a correct administration of the number of connections.
-    globStream.close()
-
-
 def homeRun():
-    global globContinueCapture, globBytes, globStream, globImg, globNewImageAvailable, globNewImageAvailableLock
-    global globBrightness
-
-    globStream=urllib.urlopen('http://@localhost:44445/?action=stream')
-    globBytes=''
-    globNewImageAvailable = False
-    globNewImageAvailableLock = thread.allocate_lock()
-    globContinueCapture = True
-    thread.start_new_thread(getNewImage, ())
+    # The Home run video is written at FpsLq.
+    mailbox = globCapture.subscribe('homeRun', fps = FpsLq)
+    continueCapture = True
 
     correctApproachAngle = False
-    correction = 0
-    imgCount = 0
-
-    # Remove tmp_img and tmp_tmp_img files to be sure no tmp images are left from a previous run.
-    stdOutAndErr = own_util.runShellCommandWait('rm -f /home/pi/DFRobotUploads/tmp_*img*')
-    globMyLog.info(stdOutAndErr)
+    approachMoves = None
+    # Statistics to compare Home runs.
+    startTime = time.time()
+    nofFrames = 0
+    nofMoves = 0
+    # The marker detector is created once for the whole Home run.
+    if globVisionWorker is not None:
+        # Decode and detect in the vision process, see vision_worker.py.
+        markerDetector = globVisionWorker.createMarkerDetector(ImgWidth, ImgHeight, doPrint)
+    else:
+        markerDetector = docking.MarkerDetector(ImgWidth, ImgHeight, doPrint)
+    # The marker tracker filters the marker position and size over the images and predicts it when the marker is not found.
+    markerTracker = docking.MarkerTracker()
+    nofSearchTurns = 0
+    # The raw frames and a record per frame with the vision results and the chosen move are logged for analysis and replay.
+    # The Home run video is made from the session log when the Home run is finished, so during the Home run every frame
+    # is written to the SD card once.
+    sessionLog = session_log.SessionLog('homerun')
+    headingFuture = None
 
     # Start with cam down.
     own_util.moveCamAbs(0, 0.1)
     # Switch on light if needed
-    if globBrightness < 60:
+    if globCapture.brightness < 60:
         own_util.switchLight(True)
 
     # Indicate that a Home run is started.
     # A Home run can be stopped by setting own_util.globStop to True.
     own_util.globDoHomeRun = True
-    while globContinueCapture == True and own_util.globStop == False:
-        # Keep critical section as short as possible.
-        globNewImageAvailableLock.acquire()
-        newImageAvailable = globNewImageAvailable
-        if newImageAvailable:
-            img = globImg
-            globNewImageAvailableLock.release()
-            img_gray = cv2.cvtColor(img, cv2.cv.CV_BGR2GRAY)
-
-            # Setup SimpleBlobDetector parameters.
-            params = cv2.SimpleBlobDetector_Params()
-
-            # Change thresholds
-            # The default value of params.thresholdStep (10?) seems to work well.
-            # To speed processing up, increase to 20 or more.
-            #params.thresholdStep = 20
-            params.minThreshold = 20
-            params.maxThreshold = 200
-
-            # Filter by Area.
-            # This prevents that many small blobs (one pixel) will be detected.
-            # In addition tt is observed that in that case invalid keypoint coordinates are produced: nan (not a number).
-            # When filterByArea is set to True with a minArea > 0 this problem does not occur.
-            params.filterByArea = True
-            params.minArea = 100 * ImgAreaFactor
-            params.maxArea = 100000 * ImgAreaFactor
-
-            # Filter by Circularity
-            params.filterByCircularity = True
-            params.minCircularity = 0.80
-
-            # Filter by Convexity
-            params.filterByConvexity = False
-            params.minConvexity = 0.87
-
-            # Filter by Inertia
-            params.filterByInertia = False
-            params.minInertiaRatio = 0.01
-
-            #Filter by distance between blobs
-            #params.minDistBetweenBlobs = 100
-
-            # Detect blobs.
-            detector = cv2.SimpleBlobDetector(params)
-            blobs = detector.detect(img_gray)
-
-            # Sort blobs on horizontal position and check if they are valid.
-            sortedBlobs = sorted(blobs, key=lambda x: x.pt[0], reverse=False)
-            blobLeft = None
-            blobMiddle = None
-            blobRight = None
-            validBlobsFound = False
-            for blob in sortedBlobs:
-                # Fill in three blobs, left, middle, right.
-                if blobLeft is None:
-                    blobLeft = blob
-                elif blobMiddle is None:
-                    # Check if there is a middle blob found which is 3 times smaller than the left blob.
-                    if blob.size > blobLeft.size/4.0 and blob.size < blobLeft.size/2.0:
-                        blobMiddle = blob
-                        continue
-                if blobRight is None:
-                    # Skip blop if it is significantly smaller than the first blob.
-                    if blob.size < blobLeft.size/2.0:
-                        continue
-                    blobRight = blob
-                    # We have two or three blobs now, check if these are valid
-                    # For now we consider the blobs valid if the left and right one have appr. equal size.
-                    # The size of a blob is radius in pixels.
-                    distBlobLeftBlobRight = blobRight.pt[0] - blobLeft.pt[0]
-                    avgSizeBlobLeftBlobRight = (blobLeft.size + blobRight.size) / 2.0
-                    if abs((blobLeft.size - blobRight.size) / avgSizeBlobLeftBlobRight) < 0.3 and abs((distBlobLeftBlobRight - avgSizeBlobLeftBlobRight * 3.0) / ((distBlobLeftBlobRight + avgSizeBlobLeftBlobRight * 3.0) / 2.0)) < 0.3:
-                        validBlobsFound = True
-                    else:
-                        if doPrint:
-                            if blobMiddle is not None:
-                                print 'Blob conditions not met, left:', blobLeft.pt[0], blobLeft.size, 'middle:', blobMiddle.pt[0], blobMiddle.size, 'right:', blobRight.pt[0], blobRight.size, 'distBlobLeftBlobRight:', distBlobLeftBlobRight
-                            else:
-                                print 'Blob conditions not met, left:', blobLeft.pt[0], blobLeft.size, 'right:', blobRight.pt[0], blobRight.size, 'distBlobLeftBlobRight:', distBlobLeftBlobRight
-                    if validBlobsFound:
-                        # We have found two or three valid blobs, break out of loop.
-                        break
-                    else:
-                        # No valid blobs found yet, shift one blob up.
-                        # We assume that valid blobs are adjacent.
-                        # This is reasonable as the real blobs will indeed be close to each other.
-                        if blobMiddle is not None:
-                            blobLeft = blobMiddle
-                            blobMiddle = blobRight
-                            blobRight = None
-                        else:
-                            blobLeft = blobRight
-                            blobRight = None
+    while continueCapture == True and own_util.globStop == False:
+        # Sleep until a new frame arrives. The timeout makes sure a stop command is handled.
+        frame = mailbox.wait(0.5)
+        # With the vision process the marker is detected there while the frame is decoded here to check it.
+        if frame is not None and globVisionWorker is not None:
+            markerDetector.submit(frame)
+        # The capture thread does not decode the frames any more, so a corrupt frame shows up here as an img of None.
+        if frame is not None and frame.img is not None:
+            nofFrames += 1
+            # The trace follows the frame from the stream read to the I2C write of the move decided on it.
+            trace = latency.Trace('homerun', frame.stamps)
+            trace.mark('decode')
+
+            # Detect the docking marker, in the region around the last position when it was found before.
+            if globVisionWorker is not None:
+                marker = markerDetector.collect()
+            else:
+                img_gray = cv2.cvtColor(frame.img, cv2.COLOR_BGR2GRAY)
+                marker = markerDetector.detect(img_gray)
+            sortedBlobs = markerDetector.blobs
+            validBlobsFound = marker is not None
+            if validBlobsFound:
+                blobLeft = marker.blobLeft
+                blobMiddle = marker.blobMiddle
+                blobRight = marker.blobRight
+                distBlobLeftBlobRight = marker.distBlobLeftBlobRight
+                avgSizeBlobLeftBlobRight = marker.avgSizeBlobLeftBlobRight
+            markerTracker.update(marker, frame.timestamp)
+            trace.mark('detect')
+            nofQueuedMoves = globMoveExecutor.nofQueued
+            if doPrint:
+                print 'marker detection:', round(markerDetector.detectionTime * 1000, 1), 'ms, track confidence:', round(markerTracker.confidence, 2)
 
-            if correctApproachAngle:
-                # Going to check and correct the approach angle.
-                if correction > 1.5:  # we have to turn to the left, move forward and then turn back again
-                    if doPrint:
-                        print '********** Going to do approach correction to the left.'
-                    # Rotate left 90 degrees minus a correction dependant on the sideways displacement.
-                    own_util.move('left', 112 - correction * 1, 1.0, doMove)
-                    own_util.move('forward', correction * 3, 1.0, doMove)
-                    # Rotate back 90 degrees towards target. We do not use a correction here because we have to rotate a bit further back to the target.
-                    own_util.move('right', 112, 5.0, doMove)
-                    # approach correction finished
-                    correctApproachAngle = False
-                    if doPrint:
-                        print 'Approach correction Finished.'
-                elif correction < -1.5:  # we have to turn to the right, move forward and then turn back again
-                    if doPrint:
-                        print 'Going to do approach correction to the right.'
-                    # Rotate right 90 degrees minus a correction dependant on the sideways displacement.
-                    own_util.move('right', 112 + correction * 1, 1.0, doMove)
-                    own_util.move('forward', -correction * 3, 1.0, doMove)
-                    # Rotate back 90 degrees towards target. We do not use a correction here because we have to rotate a bit further back to the target.
-                    own_util.move('left', 112, 5.0, doMove)
-                    # approach correction finished
-                    correctApproachAngle = False
-                    if doPrint:
-                        print 'Approach correction finished.'
+            # The next move is only decided on a frame taken after the robot and the camera are settled.
+            # While the robot moves, the frames are still used to keep track of the marker.
+            if not globMoveExecutor.isSettled() or frame.timestamp < globMoveExecutor.settledTime:
+                if doPrint:
+                    print 'robot', globMoveExecutor.getState()
+            elif correctApproachAngle:
+                # Correct the approach angle in one go with the moves planned on the frame where it was detected.
+                # Turn perpendicular to the marker axis, drive to the axis and turn back towards the marker.
+                if doPrint:
+                    print '********** Going to do approach correction:', approachMoves
+                moves = approachMoves
+                # The trace of this frame ends with the first move.
+                for (i, (direction, delayMove)) in enumerate(moves[:-1]):
+                    globMoveExecutor.move(direction, delayMove, HomeRunSettleTime, trace if i == 0 else None)
+                # Give the camera more time to stabilize after the last move.
+                (direction, delayMove) = moves[-1]
+                globMoveExecutor.move(direction, delayMove, HomeRunCorrectionSettleTime)
+                nofMoves += len(moves)
+                # approach correction planned, it is executed while the next frames are tracked
+                correctApproachAngle = False
 
             elif validBlobsFound:
                 if doPrint:
@@ -241,161 +172,220 @@ def homeRun():
                         print 'left:', blobLeft.pt[0], blobLeft.size, 'middle:', blobMiddle.pt[0], blobMiddle.size, 'right:', blobRight.pt[0], blobRight.size, 'distBlobLeftBlobRight:', distBlobLeftBlobRight
                     else:
                         print 'left:', blobLeft.pt[0], blobLeft.size, 'right:', blobRight.pt[0], blobRight.size, 'distBlobLeftBlobRight:', distBlobLeftBlobRight
-                # Go home!
-                xmid = (blobLeft.pt[0] + blobRight.pt[0]) / 2.0
-                ymid = (blobLeft.pt[1] + blobRight.pt[1]) / 2.0
+                # Go home! Steer on the marker found in this image. The tracker has no input for the moves of the robot
+                # itself, so its filtered position lags after every turn and its size lags the growing marker.
+                # The tracked position is only used when the marker is missed, see below.
+                xmid = marker.xmid
+                ymid = marker.ymid
                 # Move cam to vertically center the target.
                 own_util.moveCamRel(30 * (ImgHeight/2 - ymid) / ImgHeight, 0.1)
                 course = ImgWidth / 2.0
-                if blobMiddle is not None:
-                    correction = (xmid - blobMiddle.pt[0]) / ImgWidthFactor
+                turnDelay = docking.getTurnDelay(xmid, ImgWidth, usePoseCorrection)
+                if usePoseCorrection:
+                    # Estimate distance, bearing and approach angle from this image.
+                    pose = docking.estimatePose(marker, ImgWidth)
+                    needsCorrection = abs(pose.lateralOffset) > docking.MaxLateralOffset
+                    if doPrint:
+                        print 'xmid, course, distance, bearing, approach angle:', xmid, course, round(pose.distance, 1), round(pose.bearing, 1), round(pose.approachAngle, 1)
                 else:
-                    correction = 0
-                if doPrint:
-                    print 'xmid, course, correction:', xmid, course, correction
+                    correction = docking.getEmpiricalCorrection(marker, ImgWidth)
+                    needsCorrection = abs(correction) > docking.EmpiricalMinCorrection
+                    if doPrint:
+                        print 'xmid, course, correction:', xmid, course, correction
                 if xmid < course - ImgWidth / 20.0:
                     if doPrint:
                         print 'turn left'
-                    if xmid < course - ImgWidth / 5.0:
-                        own_util.move('left', 12, 1.0, doMove)
-                    else:
-                        own_util.move('left', 1, 1.0, doMove)
+                    globMoveExecutor.move('left', turnDelay, HomeRunSettleTime, trace)
+                    nofMoves += 1
                 elif xmid > course + ImgWidth / 20.0:
                     if doPrint:
                         print 'turn right'
-                    if xmid > course + ImgWidth / 5.0:
-                        own_util.move('right', 12, 1.0, doMove)
-                    else:
-                        own_util.move('right', 1, 1.0, doMove)
-                elif abs(correction) > 2.0 and avgSizeBlobLeftBlobRight > SizeMinForCorrection and avgSizeBlobLeftBlobRight < SizeMaxForCorrection:
+                    globMoveExecutor.move('right', turnDelay, HomeRunSettleTime, trace)
+                    nofMoves += 1
+                elif needsCorrection and avgSizeBlobLeftBlobRight > SizeMinForCorrection and avgSizeBlobLeftBlobRight < SizeMaxForCorrection:
                     correctApproachAngle = True
+                    if usePoseCorrection:
+                        approachMoves = docking.planApproachCorrection(pose)
+                    else:
+                        approachMoves = docking.planEmpiricalCorrection(correction)
                 else:
                     if avgSizeBlobLeftBlobRight < SizeStop:
                         if doPrint:
                             print 'move forward'
                         if avgSizeBlobLeftBlobRight < SizeSlow:
-                            own_util.move('forward', 32, 1.0, doMove)
+                            globMoveExecutor.move('forward', 32, HomeRunSettleTime, trace)
                         else:
-                            own_util.move('forward', 12, 1.0, doMove)
+                            globMoveExecutor.move('forward', 12, HomeRunSettleTime, trace)
+                        nofMoves += 1
                     else:
                         # Make one more additional move towards the garage before turning 180 degrees.
                         # Switch off the light relay as its magnetic field influences the compass (can be 10 degrees difference)!!
+                        # This last part is not vision controlled, so wait for the moves to finish.
                         own_util.switchLight(False)
-                        own_util.move('forward',20, 1.0, doMove)
+                        globMoveExecutor.move('forward', 20, HomeRunSettleTime)
+                        globMoveExecutor.waitSettled(5.0)
                         compass.gotoDegreeRel(180, doMove)
                         for i in range(0, 8):
-                            own_util.move('backward', 12, 1.0, doMove)
+                            globMoveExecutor.move('backward', 12, HomeRunSettleTime)
+                        globMoveExecutor.waitSettled(10.0)
                         globMyLog.info('Home found!')
-                        globContinueCapture = False
+                        continueCapture = False
 
+            elif markerTracker.confidence >= MinTrackConfidence:
+                # The marker is not found in this image but it was found just before, so it is probably missed.
+                # Instead of a search turn only turn towards the predicted position if it is off course, and look again.
+                if doPrint:
+                    print '********** Marker not found, predicted at:', round(markerTracker.x), round(markerTracker.y), 'images predicted:', markerTracker.nofPredicted
+                turnDelay = docking.getTurnDelay(markerTracker.x, ImgWidth, usePoseCorrection)
+                if markerTracker.x < ImgWidth / 2.0 - ImgWidth / 20.0:
+                    globMoveExecutor.move('left', turnDelay, HomeRunSettleTime, trace)
+                    nofMoves += 1
+                elif markerTracker.x > ImgWidth / 2.0 + ImgWidth / 20.0:
+                    globMoveExecutor.move('right', turnDelay, HomeRunSettleTime, trace)
+                    nofMoves += 1
             elif len(sortedBlobs) > 0:
                 if doPrint:
                     print '**********', len(sortedBlobs), 'Blobs found, but not valid.'
                     print 'turn left'
-                own_util.move('left', 22, 1.0, doMove)
+                globMoveExecutor.move('left', 22, HomeRunSettleTime, trace)
+                nofMoves += 1
+                nofSearchTurns += 1
             else:
                 if doPrint:
                     print '********** No blobs found.'
                     print 'turn left'
-                own_util.move('left', 22, 1.0, doMove)
-
-            for blob in sortedBlobs:
-                x = blob.pt[0]
-                y = blob.pt[1]
-                cv2.circle(img, (int(x), int(y)), int(blob.size), (0, 255, 0), 2)
-
-            # Write images with name like 'tmp_img000042.jpg'.
-            # Use leading zeros to make sure order is correct when using shell filename expansion.
-            cv2.imwrite('/home/pi/DFRobotUploads/tmp_img' + str(imgCount).zfill(6) + '.jpg', img)
+                globMoveExecutor.move('left', 22, HomeRunSettleTime, trace)
+                nofMoves += 1
+                nofSearchTurns += 1
+
+            # A trace with a move is finished by the move executor after the I2C write.
+            if not trace.hasStage('decision'):
+                trace.finish()
+
+            # Log the frame with the move chosen for it. The compass is only read when a move is chosen,
+            # and not with --nomove, which is also used to replay recorded sessions without the robot.
+            # The read is queued behind the move on the I2C dispatcher and this loop does not wait for it,
+            # the heading is logged with the first frame after the read is done.
+            (command, commandValue, heading) = ('', np.nan, np.nan)
+            if headingFuture is not None and headingFuture.done():
+                if headingFuture.result is not None:
+                    heading = headingFuture.result
+                headingFuture = None
+            if globMoveExecutor.nofQueued > nofQueuedMoves:
+                (command, commandValue) = globMoveExecutor.lastMove
+                if doMove and headingFuture is None:
+                    headingFuture = compass.requestCompass()
+            sessionLog.append(frame, len(sortedBlobs), marker is not None, markerTracker.x, markerTracker.y, markerTracker.size,
+                              markerTracker.confidence, command, commandValue, heading)
 
             if doShow:
-                # Show keypoints
+                # Show keypoints. Copy because the frame is shared with other subscribers.
+                img = frame.img.copy()
+                for blob in sortedBlobs:
+                    x = blob.pt[0]
+                    y = blob.pt[1]
+                    cv2.circle(img, (int(x), int(y)), int(blob.size), (0, 255, 0), 2)
                 cv2.imshow("Keypoints", img)
                 cv2.waitKey(100)
 
-            # Increase imgCount with a maximum for protection.
-            imgCount = (imgCount + 1) % (FpsLq * 300)
-
-            # Ready with movement. Make globNewImageAvailable false to make sure a new image is taken after movement.
-            # Keep critical section as short as possible.
-            globNewImageAvailableLock.acquire()
-            globNewImageAvailable = False
-            globNewImageAvailableLock.release()
-        else:
-            globNewImageAvailableLock.release()
-
-    # Stop the getNewImage thread and indicate Home run is finished.
-    globContinueCapture = False
+    # Stop receiving frames and indicate Home run is finished.
+    # Moves which are not executed yet are cancelled, for example when the Home run is stopped.
+    globMoveExecutor.cancel()
+    globCapture.unsubscribe(mailbox)
+    docking.logMetrics(markerDetector)
+    if globVisionWorker is not None:
+        vision_worker.logMetrics(markerDetector)
+    i2c.logMetrics()
+    i2c_dispatcher.logMetrics()
+    globMyLog.info('Home run: ' + str(round(time.time() - startTime, 1)) + ' s, ' + str(nofFrames) + ' frames, ' + str(nofMoves) + ' moves, ' + str(nofSearchTurns) + ' search turns')
     own_util.globDoHomeRun = False
     # Move cam down again.
     own_util.moveCamAbs(0, 0.1)
     # Switch off light if it was on.
     own_util.switchLight(False)
-    # Convert the Home run images to a video and remove the images.
-    stdOutAndErr = own_util.runShellCommandWait('mencoder mf:///home/pi/DFRobotUploads/tmp_img*.jpg -mf w=' + str(ImgWidth) + ':h=' + str(ImgHeight) + ':fps=' + str(FpsLq) + ':type=jpg -ovc lavc -lavcopts vcodec=mpeg4:mbd=2:trell -oac copy -o /home/pi/DFRobotUploads/dfrobot_video.avi')
-    globMyLog.info(stdOutAndErr)
-    # Remove tmp_img and tmp_tmp_img files.
-    stdOutAndErr = own_util.runShellCommandWait('rm -f /home/pi/DFRobotUploads/tmp_*img*')
-    globMyLog.info(stdOutAndErr)
+    sessionLog.close()
+    globMyLog.info('Home run: session logged in ' + sessionLog.path)
+    # Make the Home run video from the session log.
+    session_log.SessionReader(sessionLog.path).writeClip('/home/pi/DFRobotUploads/dfrobot_video.avi', ImgWidth, ImgHeight, FpsLq)
 
 
 def captureAndMotionDetection():
-    global globContinueCapture, globBytes, globStream, globImg, globNewImageAvailable, globNewImageAvailableLock
-    global globBrightness
-
-    globStream=urllib.urlopen('http://@localhost:44445/?action=stream')
-    globBytes=''
-    globNewImageAvailable = False
-    globNewImageAvailableLock = thread.allocate_lock()
-    globContinueCapture = True
-    thread.start_new_thread(getNewImage, ())
-
-    img = img_gray = img_gray_prev = None
-    imgCount = 0
-    motionDetected = prevMotionDetected = False
-    noOfConsecutiveMotions = 0
-    firstImageIndex = 0
+    # The motion detection runs at FpsLq when the scene is idle and at MotionFpsActive while there is motion.
+    mailbox = globCapture.subscribe('captureAndMotionDetection', fps = FpsLq)
+    lastMotionTime = 0
+    # The ring buffer and the motion video always get FpsLq frames per second.
+    clipDecimator = capture.FrameDecimator(FpsLq)
 
-    # Remove tmp_img and tmp_tmp_img files to be sure no tmp images are left from a previous run.
-    stdOutAndErr = own_util.runShellCommandWait('rm -f /home/pi/DFRobotUploads/tmp_*img*')
-    globMyLog.info(stdOutAndErr)
+    img = None
+    motionDetected = prevMotionDetected = False
+    if globVisionWorker is not None:
+        # Decode and detect in the vision process, see vision_worker.py.
+        motionDetector = globVisionWorker.createMotionDetector(ImgWidth, ImgHeight, MotionAnalysisScale)
+    else:
+        motionDetector = motion.MotionDetector(ImgWidth, ImgHeight, MotionAnalysisScale)
+    # Frames of an unchanged scene are not decoded and analysed.
+    staticSceneGate = capture.StaticSceneGate()
+    # Time in seconds from receiving a frame from the stream until its motion detection is done.
+    latencies = collections.deque(maxlen = FpsLq * LatencyLogInterval)
+    latencyLogTime = time.time()
+    # The motion detection images are kept in memory as the JPEG bytes from the stream,
+    # only when motion is detected they are written to the motion video.
+    ringBuffer = clip.JpegRingBuffer(MotionDetectionBufferLength)
+    clipWriter = None
+    blindWindowStartTime = None
 
     logCount = 0
     pictureCountDown = 0
     lightSwitchedOn = False
-    while globContinueCapture == True:
+    lightSwitchedOnTime = 0
+    while True:
         if communication.globWebSocketInteractive == True or personal_assistant.globInteractive == True:
             if doPrint:
                 print 'stopping capture and motion detection because the interactive mode is active'
             globMyLog.info('stopping capture and motion detection because the interactive mode is active')
-            globContinueCapture = False
-            return False
-
-        # Keep critical section as short as possible.
-        globNewImageAvailableLock.acquire()
-        newImageAvailable = globNewImageAvailable
-        if newImageAvailable:
-            img = globImg
-            globNewImageAvailableLock.release()
+            globCapture.unsubscribe(mailbox)
+            # The motion video is not complete, so it is not sent.
+            if clipWriter is not None:
+                globClipWorker.discard(clipWriter)
+            return
+
+        if blindWindowStartTime is not None:
+            # Ready to wait for the next image after a motion video was handed over to the clip worker.
+            globMyLog.info('motion: blind window ' + str(round(time.time() - blindWindowStartTime, 3)) + ' s')
+            blindWindowStartTime = None
+
+        # Sleep until a new frame arrives. The timeout makes sure the interactive mode is checked regularly.
+        frame = mailbox.wait(0.5)
+        if frame is not None:
+            # The full resolution image is only decoded when motion is drawn on it.
+            # The frame is shared with other subscribers, so img is a copy.
+            img = None
+            imgAnnotated = False
 
             # Check if picture has to be sent to Telegram.
             if personal_assistant.globTelegramSendPicture == True:
                 # pictureCountDown is used in case it is dark and the ligth has to be switched on.
-                # It counts down a number of images to give the camera time to settle. When pictureCountDown == 0, the picture is taken.
+                # The picture is taken as soon as the exposure is settled after switching on the light,
+                # or at the latest when pictureCountDown, which counts down the images, reaches 0.
                 # Switch on light if needed.
-                if globBrightness < 60 and lightSwitchedOn == False:
+                if globCapture.brightness < 60 and lightSwitchedOn == False:
                     own_util.switchLight(True)
                     lightSwitchedOn = True
+                    lightSwitchedOnTime = time.time()
                     pictureCountDown = 10
                 # Save img to latest_img.jpg and send it with Telegram.
-                if pictureCountDown == 0:
-                    cv2.imwrite('/home/pi/DFRobotUploads/latest_img.jpg', img)
+                if pictureCountDown == 0 or (lightSwitchedOn and globCapture.brightnessEstimator.isSettled(lightSwitchedOnTime)):
+                    # Write the JPEG bytes from the stream, there is no need to encode the image again.
+                    f = open('/home/pi/DFRobotUploads/latest_img.jpg', 'wb')
+                    f.write(frame.jpg)
+                    f.close()
                     communication.sendTelegramImg('/home/pi/DFRobotUploads/latest_img.jpg', 'Here is your picture!')
                     # Not needed to lock here as it is ok to miss a 'send picture' command when they come in too fast.
                     personal_assistant.globTelegramSendPicture = False
                     # Switch off light.
                     own_util.switchLight(False)
                     lightSwitchedOn = False
+                    pictureCountDown = 0
                 else:
                     pictureCountDown = pictureCountDown - 1
 
@@ -407,11 +397,14 @@ def captureAndMotionDetection():
                     globMyLog.info('globDoMotionDetection set to False')
                     logCount = 1
                 # Reset values for the next time motion detection is switched on.
-                img = img_gray = img_gray_prev = None
-                imgCount = 0
+                img = None
                 motionDetected = prevMotionDetected = False
-                noOfConsecutiveMotions = 0
-                firstImageIndex = 0
+                motionDetector.reset()
+                staticSceneGate.reset()
+                ringBuffer.clear()
+                if clipWriter is not None:
+                    globClipWorker.discard(clipWriter)
+                    clipWriter = None
             else:
                 # Motion detection
                 if logCount == 1:
@@ -420,71 +413,65 @@ def captureAndMotionDetection():
                     globMyLog.info('globDoMotionDetection set to True')
                     logCount = 0
 
-                if img_gray is not None:
-                    img_gray_prev = img_gray.copy()
-                img_gray = cv2.cvtColor(img, cv2.cv.CV_BGR2GRAY)
-                img_gray = cv2.GaussianBlur(img_gray, (21, 21), 0)
-
-
-                if img_gray_prev is not None:
-                    img_gray_diff = cv2.absdiff(img_gray, img_gray_prev)
-                    img_bw_diff = cv2.threshold(img_gray_diff, GrayLevelDifferenceTreshold, 255, cv2.THRESH_BINARY)[1]
-                    (cnts, _) = cv2.findContours(img_bw_diff.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
+                # The motion is detected on a reduced grayscale image, the boxes are in full resolution.
+                trace = latency.Trace('motion', frame.stamps)
+                # The static scene gate is only asked when there is no motion going on, so a motion is never interrupted.
+                if motionDetector.noOfConsecutiveMotions == 0 and motionDetected == False and staticSceneGate.isStatic(frame):
+                    motionDetector.skip()
+                    motionInImage = False
+                else:
+                    motionInImage = motionDetector.detect(frame)
+                trace.mark('detect')
+                trace.finish()
+                latencies.append(time.time() - frame.timestamp)
+                if time.time() - latencyLogTime > LatencyLogInterval:
+                    logLatency(latencies, globVisionWorker is not None)
+                    capture.logMetrics(staticSceneGate)
+                    latencyLogTime = time.time()
+                # Ramp the frame rate up on motion, so true motion is confirmed sooner, and back down when the scene is idle.
+                if motionInImage or motionDetector.noOfConsecutiveMotions > 0 or motionDetected:
+                    lastMotionTime = frame.timestamp
+                    mailbox.setFps(MotionFpsActive)
+                elif frame.timestamp - lastMotionTime > MotionIdleTime:
+                    mailbox.setFps(FpsLq)
+                if motionInImage:
                     if doPrint:
-                        print 'number of contours:', len(cnts)
-
-                    # Loop over the contours.
-                    # If number of contours is too high it is not considered true motion.
-                    if len(cnts) < MaxNofContours:
-                        # xLeft, xRight, yTop, yBottom will be the coordinates of the outer bounding box of all contours.
-                        xLeft = ImgWidth
-                        xRight = 0
-                        yTop = ImgHeight
-                        yBottom = 0
-                        nofValidContours = 0
-                        for c in cnts:
-                            # If the contour is too small, ignore it.
-                            if cv2.contourArea(c) > MinContourArea:
-                                # Compute the outer bounding box of all valid contours.
-                                nofValidContours = nofValidContours + 1
-                                x,y,w,h = cv2.boundingRect(c)
-                                xLeft = x if x < xLeft else xLeft
-                                xRight = x+w if x+w > xRight else xRight
-                                yTop = y if y < yTop else yTop
-                                yBottom = y+h if y+h > yBottom else yBottom
-                                if doShow:
-                                    # Only with -show option draw all the contours.
-                                    cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                        if nofValidContours > 0:
-                            totalArea = (xRight - xLeft) * (yBottom - yTop)
-                            if doPrint:
-                                print 'total area:', totalArea
-                            if totalArea < (ImgWidth * ImgHeight) * 0.5:
-                                # Motion is detected for this image.
-                                # Consider true motion detected only after sufficient images in sequence with motion.
-                                noOfConsecutiveMotions = noOfConsecutiveMotions + 1
-                                if noOfConsecutiveMotions >= 3:
-                                    if doPrint:
-                                        print '******************** MOTION DETECTED! ********************'
-                                    # Draw the outer bounding box of all contours.
-                                    cv2.rectangle(img, (xLeft, yTop), (xRight, yBottom), (0, 255, 255), 2)
-                                    if doTestMotion == False:
-                                        motionDetected = True
-                            else:
-                                # Reset, images with motion have to be in sequence.
-                                noOfConsecutiveMotions = 0
-
-                # Write images with name like 'tmp_img000042.jpg'.
-                # Use leading zeros to make sure order is correct when using shell filename expansion.
-                firstImageName = '/home/pi/DFRobotUploads/tmp_tmp_img' + str(imgCount).zfill(6) + '.jpg'
-                cv2.imwrite(firstImageName, img)
+                        print '******************** MOTION DETECTED! ********************'
+                    if doTestMotion == False:
+                        motionDetected = True
+                if doPrint:
+                    print 'number of contours:', motionDetector.nofContours
+                if doShow:
+                    # Only with -show option draw all the contours.
+                    for (x, y, w, h) in motionDetector.boxes:
+                        if imgAnnotated == False:
+                            img = frame.img.copy()
+                            imgAnnotated = True
+                        cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                if motionInImage:
+                    # Draw the outer bounding box of all contours.
+                    if imgAnnotated == False:
+                        img = frame.img.copy()
+                        imgAnnotated = True
+                    (xLeft, yTop, xRight, yBottom) = motionDetector.box
+                    cv2.rectangle(img, (xLeft, yTop), (xRight, yBottom), (0, 255, 255), 2)
+
+                # Keep the image in the ring buffer at FpsLq, also when the frame rate is ramped up, and always the image the motion is detected on.
+                # Only an annotated image has to be encoded, otherwise the JPEG from the stream is kept.
+                startClip = motionDetected == True and prevMotionDetected == False
+                isClipFrame = clipDecimator.accept(frame.timestamp) or startClip
+                if isClipFrame:
+                    if imgAnnotated:
+                        jpg = cv2.imencode('.jpg', img)[1].tostring()
+                    else:
+                        jpg = frame.jpg
+                    ringBuffer.append(jpg)
 
                 if motionDetected == True:
                     # Motion is detected,
                     # now acquire MotionDetectionBufferLength - MotionDetectionBufferOffset new images.
-                    # First determine where we are in the circular buffer.
-                    if prevMotionDetected == False and motionDetected == True:
+                    # They are written to the motion video while they come in, so the video is ready after the last image.
+                    if startClip:
                         # Send  motion image or text to Telegram. Do it here so it will arrive fast!
                         #if doPrint:
                         #    print 'motion detected, going to send motion picture to Telegram'
@@ -492,61 +479,60 @@ def captureAndMotionDetection():
                         # Line below commented out, motion video is sent instead.
                         #communication.sendTelegramImg(firstImageName, 'Motion detected!')
 
-                        firstImageIndex = imgCount
+                        # Start the motion video with the MotionDetectionBufferOffset images before the motion and this image.
+                        clipWriter = clip.openClipWriter(globClipWorker.newClipPath('/home/pi/DFRobotUploads', 'dfrobot_motion'), ImgWidth, ImgHeight, FpsLq)
+                        for preMotionJpg in ringBuffer.frames()[-(MotionDetectionBufferOffset + 1):]:
+                            clipWriter.addFrame(preMotionJpg)
                         extraImgCount = 0
                         prevMotionDetected = True
-                    else:
+                    elif isClipFrame:
+                        clipWriter.addFrame(jpg)
                         extraImgCount = extraImgCount + 1
                         if doPrint:
                             print 'capturing extra image no:', extraImgCount
 
                         if extraImgCount == MotionDetectionBufferLength - MotionDetectionBufferOffset - 1:
-                            # All required images for this motion are captured, stop the capturing.
-                            globContinueCapture = False
+                            # All required images for this motion are captured. The video is finished and sent to Telegram
+                            # by the clip worker, so motion detection continues with the next image.
+                            # The blind window is the time motion detection is not waiting for new images because of this motion.
+                            blindWindowStartTime = time.time()
+                            if doPrint:
+                                print 'motion detected, going to send motion video to Telegram'
+                            globMyLog.info('motion detected, going to send motion video to Telegram')
+                            globClipWorker.finish(clipWriter, 'Motion detected!')
+                            clip.logMetrics(ringBuffer)
+                            motion.logMetrics(motionDetector)
+                            if globVisionWorker is not None:
+                                vision_worker.logMetrics(motionDetector)
+                            clipWriter = None
+                            motionDetected = prevMotionDetected = False
+                            motionDetector.resetMotionCount()
 
                 if doShow:
                     # Show motion
-                    cv2.imshow("Motion", img)
+                    cv2.imshow("Motion", img if imgAnnotated else frame.img)
                     cv2.waitKey(100)
 
-                # imgCount keeps position in circular buffer.
-                imgCount = (imgCount + 1) % MotionDetectionBufferLength
 
-            # Ready with this image. Make globNewImageAvailable false to make sure a new image is taken.
-            # Keep critical section as short as possible.
-            globNewImageAvailableLock.acquire()
-            globNewImageAvailable = False
-            globNewImageAvailableLock.release()
-        else:
-            globNewImageAvailableLock.release()
-
-    # Motion detection loop is finished. The images are in a circular buffer and the first image with
-    # motion is at firstImageIndex. Before this image there are MotionDetectionBufferOffset images
-    # before the motion.
-    # Before we can make a movie we have to shift the motion detection images so the preamble
-    # starts at index 0.
-    for i in range(0, MotionDetectionBufferLength):
-        # Rename images such that tmp_img000000.jpg is the first image to show in the movie.
-        # Note that this is MotionDetectionBufferOffset images before motion is detected.
-        iOffset = i - (firstImageIndex - MotionDetectionBufferOffset)
-        # Map iOffset back into circular buffer.
-        if iOffset < 0:
-            iOffset = iOffset + MotionDetectionBufferLength
-        elif iOffset >= MotionDetectionBufferLength:
-            iOffset = iOffset - MotionDetectionBufferLength
-        # Rename the tmp_tmp_img file with index i to tmp_img files with the correct index iOffset.
-        # As we are not sure all MotionDetectionBufferLength tmp_tmp_img* images are really created, we accept IOError exceptions here.
-        try:
-            shutil.move('/home/pi/DFRobotUploads/tmp_tmp_img' + str(i).zfill(6) + '.jpg', '/home/pi/DFRobotUploads/tmp_img' + str(iOffset).zfill(6) + '.jpg')
-        except IOError:
-            pass
-    # Motion detection images are shifted now. Convert the images to a video and remove the images.
-    stdOutAndErr = own_util.runShellCommandWait('mencoder mf:///home/pi/DFRobotUploads/tmp_img*.jpg -mf w=' + str(ImgWidth) + ':h=' + str(ImgHeight) + ':fps=' + str(FpsLq) + ':type=jpg -ovc lavc -lavcopts vcodec=mpeg4:mbd=2:trell -oac copy -o /home/pi/DFRobotUploads/dfrobot_video.avi')
-    globMyLog.info(stdOutAndErr)
-    # Remove tmp_img and tmp_tmp_img files.
-    stdOutAndErr = own_util.runShellCommandWait('rm -f /home/pi/DFRobotUploads/tmp_*img*')
-    globMyLog.info(stdOutAndErr)
-    return True
+# Log the frame latency of the motion detection and the responsiveness of the websocket server, to compare the motion
+# detection in a thread with the motion detection in the vision process.
+def logLatency(latencies, visionProcess):
+    values = sorted(latencies)
+    if len(values) == 0:
+        return
+    (lagMedian, lagMax) = communication.getIoLoopLag()
+    globMyLog.info('motion: vision process ' + ('on' if visionProcess else 'off') +
+                   ', frame latency p50 ' + str(round(values[len(values) / 2] * 1000, 1)) + ' ms, max ' + str(round(values[-1] * 1000, 1)) +
+                   ' ms, websocket lag p50 ' + str(lagMedian) + ' ms, max ' + str(lagMax) + ' ms')
+
+
+# Returns the latency trace of a command received over the websocket at receivedTime, or None for other commands.
+def createCommandTrace(receivedTime):
+    if receivedTime is None:
+        return None
+    trace = latency.Trace('fpv', [('received', receivedTime)])
+    trace.mark('decision')
+    return trace
 
 
 def createMyLog(path):
@@ -579,6 +565,9 @@ parser.add_argument('--doprint', action='store_true')
 parser.add_argument('--testmotion', action='store_true')
 parser.add_argument('--show', action='store_true')
 parser.add_argument('--nomove', action='store_true')
+parser.add_argument('--posecorrection', action='store_true')  # Experimental: steer and correct the approach with the pose of the marker instead of the empirical correction, see docking.py.
+parser.add_argument('--visionprocess', action='store_true')  # Run the motion and docking marker detection in a separate process, see vision_worker.py.
+parser.add_argument('--source', default='')  # Replay a recorded .mjpg or .avi file or a directory of JPEG files instead of the camera stream.
 args = parser.parse_args()
 
 logFilePath = args.log
@@ -592,10 +581,18 @@ if args.show:
     doShow = True
 if args.nomove:
     doMove = False
+if args.posecorrection:
+    usePoseCorrection = True
 
 # Create logger.
 createMyLog(logFilePath)
 globMyLog.info('START LOG  *****')
+if usePoseCorrection:
+    globMyLog.info('Home run: experimental pose correction is on, the pose constants in docking.py are not calibrated')
+
+# Start the vision process first, it is forked and a fork only copies the calling thread.
+if args.visionprocess:
+    globVisionWorker = vision_worker.VisionWorker()
 
 # Start Telegram client.
 communication.startTelegramClient()
@@ -609,7 +606,26 @@ personal_assistant.startPersonalAssistant()
 
 # Start status update thread.
 thread.start_new_thread(communication.statusUpdateThread, ())
-streamStarted = False
+
+# Write the latency histograms of the pipelines to the log regularly, they can also be queried over the websocket.
+latency.startLogThread()
+
+# Start the capture service. It keeps one connection to the MJPEG stream for all vision functions.
+if args.source != '':
+    # Replay at the frame rate of the low quality stream.
+    globCapture = capture.CaptureService(capture.createSource(args.source), FpsLq)
+else:
+    globCapture = capture.CaptureService()
+globCapture.start()
+
+# The stream manager keeps mjpg_streamer running at FpsHq, the highest frame rate needed, for all modes.
+globStreamManager = stream_manager.StreamManager(globCapture, FpsHq, ImgWidth, ImgHeight, args.source == '')
+
+# Start the clip worker which finishes motion videos and sends them to Telegram in the background.
+globClipWorker = clip.ClipWorker(communication.sendTelegramVideo)
+
+# Start the move executor which lets the Home run continue processing frames while the robot moves.
+globMoveExecutor = move_executor.MoveExecutor(doMove)
 
 # FPV vatiables
 # Take rounded values of maxSpeed and minSpeed such that rounded increments and decrements will pass the '0' value so we can stop the robot exactly.
@@ -640,8 +656,10 @@ while True:
             # The below regular expression will separate the command on the dots so the result will be an tuple ["drive-and-turn", "0", "31"].
             expr = re.compile('(.+?)(?:$|\.)')
             cmdList = []
+            cmdReceivedTime = None
             if communication.globWebSocketInteractive == True and len(cmdList) == 0: # Only execute when len(cmdList) == 0 meaning still no valid cmd received.
                 cmdList = expr.findall(communication.globWebSocketInMsg)
+                cmdReceivedTime = communication.globWebSocketInTime
             if personal_assistant.globInteractive == True and len(cmdList) == 0:     # Only execute when len(cmdList) == 0 meaning still no valid cmd received.
                 cmdList = expr.findall(personal_assistant.globCmd)
             # Now cmdList is a a list containing the cmd and its parameters. The cmdList[0] contains the command.
@@ -652,52 +670,19 @@ while True:
                 if doPrint:
                     print 'command received:', str(cmdList)
                 globMyLog.info('command received: ' + str(cmdList))
-                if cmdList[0] == 'start-stream-hq':
-                    # Start MJPEG stream. Stop previous stream first if any. Use sudo because stream can be started by another user.
-                    stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
-                    globMyLog.info('going to start hq stream')
-                    if doPrint:
-                        print 'going to start hq stream'
-                    time.sleep(0.5)
-                    own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps ' + str(FpsHq) + ' -q 10 -x ' + str(ImgWidth) + ' -y '+ str(ImgHeight) + '" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
-                    #own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                elif cmdList[0] == 'start-stream-lq':
-                    # Start MJPEG stream. Stop previous stream first if any. Use sudo because stream can be started by another user.
-                    stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
-                    globMyLog.info('going to start lq stream')
-                    if doPrint:
-                        print 'going to start lq stream'
-                    time.sleep(0.5)
-                    own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps ' + str(FpsLq) + ' -q 10 -x ' + str(ImgWidth) + ' -y '+ str(ImgHeight) + '" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
-                    #own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                elif cmdList[0] == 'start-fpv':
-                    # Start MJPEG stream. Stop previous stream first if any. Use sudo because stream can be started by another user.
-                    stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
-                    globMyLog.info('going to start fpv stream')
-                    if doPrint:
-                        print 'going to start fpv stream'
-                    time.sleep(0.5)
-                    own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps ' + str(FpsHq) + ' -q 10 -x ' + str(ImgWidth) + ' -y '+ str(ImgHeight) + '" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
-                    #own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                elif cmdList[0] == 'stop-fpv':
-                    # Start MJPEG stream. Stop previous stream first if any. Use sudo because stream can be started by another user.
-                    stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
-                    globMyLog.info('going to start lq stream')
+                if cmdList[0] in ['start-stream-hq', 'start-stream-lq', 'start-fpv', 'stop-fpv']:
+                    # The stream keeps running at FpsHq for all modes and every vision function gets its own frame rate,
+                    # so the stream is only started when it is not running yet.
+                    globMyLog.info('going to start stream for ' + cmdList[0])
                     if doPrint:
-                        print 'going to start lq stream'
-                    time.sleep(0.5)
-                    own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps ' + str(FpsLq) + ' -q 10 -x ' + str(ImgWidth) + ' -y '+ str(ImgHeight) + '" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
-                    #own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
+                        print 'going to start stream for', cmdList[0]
+                    globStreamManager.start()
                 elif cmdList[0] == 'stop-stream':
                     # Stop stream. Use sudo because stream can be started by another user.
                     globMyLog.info('going to stop stream')
                     if doPrint:
                         print 'going to stop stream'
-                    stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
+                    globStreamManager.stop()
                 elif cmdList[0] == 'capture-start':
                     # Start capture video from http stream, with timeout of 60 seconds.
                     globMyLog.info('going to start capture http MJPEG stream')
@@ -720,26 +705,22 @@ while True:
                     globMyLog.info('going to start Home run')
                     if doPrint:
                         print 'Going to start Home run'
-                    # Start MJPEG stream. Stop previous stream first if any. Use sudo because stream can be started by another user.
-                    stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
-                    globMyLog.info('going to start lq stream')
-                    time.sleep(0.5)
-                    own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps ' + str(FpsLq) + ' -q 10 -x ' + str(ImgWidth) + ' -y '+ str(ImgHeight) + '" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
-                    #own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Delay to give stream time to start up and camera to stabilize.
-                    time.sleep(5)
+                    # Make sure the stream is running, this only waits when it has to be started.
+                    globStreamManager.start()
                     homeRun()
                     # Upload homerun video to Telegram.
                     communication.sendTelegramVideo('/home/pi/DFRobotUploads/dfrobot_video.avi', 'Here is your homerun video!')
                 elif cmdList[0] in ['forward', 'backward', 'left', 'right']:
-                    own_util.move(cmdList[0], int(cmdList[1]), 0, doMove)
+                    # Do not wait until the command is sent, the trace is finished by the I2C dispatcher, see own_util.sendCommand().
+                    trace = createCommandTrace(cmdReceivedTime)
+                    own_util.move(cmdList[0], int(cmdList[1]), 0, doMove, trace, False)
                 elif cmdList[0] == 'ws-alive':
                     lastTimeWsConnectionAlive = time.time()
                 elif cmdList[0] == 'drive-inc':
                     # Calculate new speed and keep it between minSpeed and maxSpeed.
                     newSpeedStraight = max(min(prevSpeedStraight + int(cmdList[1]), maxSpeed), minSpeed)
-                    own_util.driveAndTurn(newSpeedStraight, 0, 0, 0, 0, doMove) # Drive straight ahead.
+                    trace = createCommandTrace(cmdReceivedTime)
+                    own_util.driveAndTurn(newSpeedStraight, 0, 0, 0, 0, doMove, trace, False) # Drive straight ahead.
                     prevSpeedStraight = newSpeedStraight
                     lastTimeWsConnectionAlive = time.time()
                 elif cmdList[0] == 'turn-inc':
@@ -747,10 +728,11 @@ while True:
                     if prevSpeedStraight == 0:
                         # When standing still a higher turning speed is needed.
                         turnSpeed = int(int(cmdList[1]) * turnSpeedFactorWhenStandingStill)
-                    own_util.driveAndTurn(prevSpeedStraight, turnSpeed, 0, 60, 0, doMove)
+                    trace = createCommandTrace(cmdReceivedTime)
+                    own_util.driveAndTurn(prevSpeedStraight, turnSpeed, 0, 60, 0, doMove, trace, False)
                     lastTimeWsConnectionAlive = time.time()
                 elif cmdList[0] == 'drive-and-turn':
-                    own_util.driveAndTurn(cmdList[1], cmdList[2], cmdList[3], cmdList[4], 0, doMove)
+                    own_util.driveAndTurn(cmdList[1], cmdList[2], cmdList[3], cmdList[4], 0, doMove, None, False)
                     lastTimeWsConnectionAlive = time.time()
                 elif cmdList[0] == 'cam-move-rel':
                     own_util.moveCamRel(int(cmdList[1]), 0.1)
@@ -762,7 +744,7 @@ while True:
                     own_util.switchLight(False)
                 elif cmdList[0] == 'demo-start':
                     # Switch on light if needed
-                    if globBrightness < 60:
+                    if globCapture.brightness < 60:
                         own_util.switchLight(True)
                     own_util.move('forward', 72, 1.0, doMove)
                     own_util.move('forward', 72, 1.0, doMove)
@@ -772,15 +754,8 @@ while True:
                     globMyLog.info('going to start Home run')
                     if doPrint:
                         print 'going to start Home run'
-                    # Start MJPEG stream. Stop previous stream first if any. Use sudo because stream can be started by another user.
-                    stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
-                    globMyLog.info('going to start lq stream')
-                    time.sleep(0.5)
-                    own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps ' + str(FpsLq) + ' -q 10 -x ' + str(ImgWidth) + ' -y '+ str(ImgHeight) + '" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
-                    #own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                    # Delay to give stream time to start up and camera to stabilize.
-                    time.sleep(5)
+                    # Make sure the stream is running, this only waits when it has to be started.
+                    globStreamManager.start()
                     homeRun()
                     # Upload homerun video to Telegram.
                     communication.sendTelegramVideo('/home/pi/DFRobotUploads/dfrobot_video.avi', 'Here is your homerun video!')
@@ -815,34 +790,13 @@ while True:
         else:
             # Non interactive mode.
             # Switch to captureAndMotionDetection. This mode stops when there is interaction.
-            if streamStarted == False:
-                # Start MJPEG stream. Stop previous stream first if any. Use sudo because stream can be started by another user.
-                stdOutAndErr = own_util.runShellCommandWait('sudo killall mjpg_streamer')
-                globMyLog.info('going to start lq default stream')
-                own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps ' + str(FpsLq) + ' -q 10 -x ' + str(ImgWidth) + ' -y '+ str(ImgHeight) + '" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                # Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
-                #own_util.runShellCommandNowait('LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"')
-                # Delay to give stream time to start up and camera to stabilize.
-                time.sleep(5)
-                streamStarted = True
+            # Make sure the stream is running, this only waits when it has to be started.
+            globStreamManager.start()
 
             globMyLog.info('going to call captureAndMotionDetection()')
-            # Call captureAndMotionDetection(). This function returns with True when motion is detected
-            # and dfrobot_video.avi is created. It returns false when the interactive mode is active.
-            motionDetected = captureAndMotionDetection()
-
-            if motionDetected:
-                if doPrint:
-                    print 'motion detected, going to send motion video to Telegram'
-                globMyLog.info('motion detected, going to send motion video to Telegram')
-                # Send motion video to Telegram.
-                communication.sendTelegramVideo('/home/pi/DFRobotUploads/dfrobot_video.avi', 'Motion detected!')
-            else:
-                # The interactive mode is active. The current MJPEG stream can be kept running.
-                # However we indicate to (re)start a new stream at the next Default run, because
-                # the stream can be switched by an interactive user.
-                # Stop MJPEG stream. Use sudo because stream can be started by another user.
-                streamStarted = False
+            # Call captureAndMotionDetection(). This function only returns when the interactive mode is active.
+            # Motion videos are sent to Telegram by the clip worker while motion detection continues.
+            captureAndMotionDetection()
 
     except Exception,e:
         globMyLog.info('run_dfrobot exception: ' + str(e))
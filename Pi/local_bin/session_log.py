@@ -0,0 +1,134 @@
+#!/usr/bin/python
+import os
+import glob
+import time
+import argparse
+import cv2
+import numpy as np
+import capture
+import clip
+
+
+# Global constants.
+SessionDir = '/home/pi/DFRobotUploads/sessions'
+NofSessionsToKeep = 5
+FlushInterval = 1.0         # Interval in seconds to flush the files.
+# One record per frame. The frame itself is in the .mjpg file at offset, length bytes.
+# Fields which are not known for a frame are NaN or empty.
+RecordDtype = np.dtype([
+    ('seq', '<u4'),
+    ('timestamp', '<f8'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('nofBlobs', '<u2'),
+    ('markerFound', 'u1'),
+    ('markerX', '<f4'),         # Filtered marker position and size in pixels.
+    ('markerY', '<f4'),
+    ('markerSize', '<f4'),
+    ('confidence', '<f4'),      # Confidence of the marker tracker.
+    ('command', 'S12'),         # Move chosen for this frame, for example 'left' or 'forward'.
+    ('commandValue', '<f4'),    # Delay of the move, see own_util.move().
+    ('heading', '<f4')])        # Compass heading in degrees, read after a move is chosen and logged with the first frame after the read.
+
+
+# The SessionLog appends the JPEG frames of a session, for example a Home run, to a .mjpg file and a record per frame
+# with the vision results and the chosen command to a .rec file. Both files are only appended to, so they can be left
+# on in production: the frames are written as they come from the stream, without encoding, and the files are flushed
+# once per FlushInterval instead of for every frame.
+# The .mjpg file uses the mjpg_streamer multipart format, so it can be replayed with capture.MjpegFileSource.
+class SessionLog(object):
+    def __init__(self, name, directory = SessionDir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, name + '_' + time.strftime('%Y%m%d_%H%M%S'))
+        self.mjpgFile = open(self.path + '.mjpg', 'ab')
+        self.recFile = open(self.path + '.rec', 'ab')
+        self.record = np.zeros(1, RecordDtype)
+        self.nofRecords = 0
+        self.flushTime = time.time()
+        purge(directory, name, NofSessionsToKeep)
+
+    def append(self, frame, nofBlobs = 0, markerFound = False, markerX = np.nan, markerY = np.nan, markerSize = np.nan,
+               confidence = np.nan, command = '', commandValue = np.nan, heading = np.nan):
+        header = '--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(frame.jpg)) + '\r\nX-Timestamp: ' + repr(frame.timestamp) + '\r\n\r\n'
+        self.mjpgFile.write(header)
+        offset = self.mjpgFile.tell()
+        self.mjpgFile.write(frame.jpg)
+        self.mjpgFile.write('\r\n')
+        self.record[0] = (frame.seq, frame.timestamp, offset, len(frame.jpg), nofBlobs, markerFound, markerX, markerY, markerSize,
+                          confidence, command, commandValue, heading)
+        self.record.tofile(self.recFile)
+        # Flush regularly, so a session is complete up to the last FlushInterval when the program stops unexpectedly.
+        if time.time() - self.flushTime >= FlushInterval:
+            self.mjpgFile.flush()
+            self.recFile.flush()
+            self.flushTime = time.time()
+        self.nofRecords += 1
+
+    def close(self):
+        self.mjpgFile.close()
+        self.recFile.close()
+
+
+# Remove the oldest sessions with this name, keeping the last nofSessionsToKeep.
+def purge(directory, name, nofSessionsToKeep):
+    recFiles = sorted(glob.glob(os.path.join(directory, name + '_*.rec')))
+    for recFile in recFiles[:-nofSessionsToKeep]:
+        for path in [recFile, recFile[:-len('.rec')] + '.mjpg']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# The SessionReader loads a session for analysis or replay, path is the session path without extension.
+class SessionReader(object):
+    def __init__(self, path):
+        if path.endswith('.rec') or path.endswith('.mjpg'):
+            path = os.path.splitext(path)[0]
+        self.path = path
+        self.records = np.fromfile(path + '.rec', dtype = RecordDtype)
+
+    # Returns the JPEG bytes of the frame of a record.
+    def readFrame(self, record):
+        f = open(self.path + '.mjpg', 'rb')
+        f.seek(int(record['offset']))
+        jpg = f.read(int(record['length']))
+        f.close()
+        return jpg
+
+    # Generator which returns (record, frame) for all frames of the session.
+    def frames(self):
+        f = open(self.path + '.mjpg', 'rb')
+        for record in self.records:
+            f.seek(int(record['offset']))
+            yield (record, capture.Frame(int(record['seq']), f.read(int(record['length'])), float(record['timestamp'])))
+        f.close()
+
+    # Returns a frame source to replay the session with the capture service or the benchmark.
+    def getSource(self):
+        return capture.MjpegFileSource(self.path + '.mjpg')
+
+    # Write the frames of the session to a clip, see clip.openClipWriter().
+    # Only the frames in which the marker is found are decoded, to circle the tracked marker, the other frames are copied.
+    def writeClip(self, path, width, height, fps):
+        clipWriter = clip.openClipWriter(path, width, height, fps)
+        for (record, frame) in self.frames():
+            jpg = frame.jpg
+            if record['markerFound'] and frame.img is not None:
+                # The marker is about 3 blob sizes wide between the centers of the outer blobs.
+                cv2.circle(frame.img, (int(record['markerX']), int(record['markerY'])), int(record['markerSize'] * 2.5), (0, 255, 0), 2)
+                jpg = cv2.imencode('.jpg', frame.img)[1].tostring()
+            clipWriter.addFrame(jpg)
+        clipWriter.close()
+
+
+# The code below is used when this script is run as a separate python script.
+# It prints the records of a session.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    sessionReader = SessionReader(args.path)
+    print len(sessionReader.records), 'frames'
+    for record in sessionReader.records:
+        print ', '.join([name + ' ' + str(record[name]) for name in RecordDtype.names if name not in ('offset', 'length')])
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+import time
+import logging
+import own_util
+
+
+# Global constants.
+StreamCommand = 'LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_raspicam.so -vf -hf -fps %d -q 10 -x %d -y %d" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"'
+# Resolution of PU` Aimetis HD USB Camera Module: 2560x960 or 1280x480. Set contrast (co) and sharpness (sh), range 0..100.
+#StreamCommand = 'LD_LIBRARY_PATH=/opt/mjpg-streamer/mjpg-streamer-experimental/ /opt/mjpg-streamer/mjpg-streamer-experimental/mjpg_streamer -i "input_uvc.so -d /dev/video0 -f 20 -r 1280x480 -co 50 -sh 100" -o "output_http.so -p 44445 -w /opt/mjpg-streamer/mjpg-streamer-experimental/www"'
+StreamTimeout = 1.0     # The stream is considered running when the capture service received a frame in the last StreamTimeout seconds.
+StartupTimeout = 5.0    # Maximum time in seconds to wait for the stream to start up and the camera exposure to settle.
+
+
+# The StreamManager keeps one mjpg_streamer running at the highest frame rate any consumer needs, so a mode change like
+# starting the FPV or a Home run does not restart the stream, which made the robot blind for more than 5 s.
+# The FPV page gets the full frame rate from mjpg_streamer, the vision functions get their own lower frame rate from the
+# capture service, see capture.CaptureService.subscribe() and FrameMailbox.setFps().
+# A changed frame rate of the camera itself would need a restart, so the stream keeps running at fps.
+class StreamManager(object):
+    def __init__(self, capture, fps, width, height, enabled = True):
+        self.capture = capture
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.enabled = enabled      # False when the capture service replays a recording, then there is no stream to manage.
+        self.nofStarts = 0
+
+    def isRunning(self):
+        return time.time() - self.capture.lastFrameTime < StreamTimeout
+
+    # Make sure the stream is running. Only when it is not running yet it is started, then this waits until frames
+    # arrive and the exposure is settled, at most StartupTimeout seconds. Returns the time in seconds waited.
+    def start(self):
+        startTime = time.time()
+        if not self.enabled or self.isRunning():
+            return 0
+        # Stop a stream which does not deliver frames first, if any. Use sudo because the stream can be started by another user.
+        own_util.runShellCommandWait('sudo killall mjpg_streamer')
+        logging.getLogger("MyLog").info('stream manager: going to start stream at ' + str(self.fps) + ' fps')
+        own_util.runShellCommandNowait(StreamCommand % (self.fps, self.width, self.height))
+        self.nofStarts += 1
+        # The brightness is only estimated for subscribed frames, so subscribe while waiting for the camera to stabilize.
+        mailbox = self.capture.subscribe('streamManager')
+        while time.time() - startTime < StartupTimeout:
+            mailbox.wait(0.5)
+            if self.isRunning() and self.capture.brightnessEstimator.isSettled(startTime):
+                break
+        self.capture.unsubscribe(mailbox)
+        duration = time.time() - startTime
+        logging.getLogger("MyLog").info('stream manager: stream ' + ('started' if self.isRunning() else 'not started') + ' in ' + str(round(duration, 1)) + ' s')
+        return duration
+
+    # Stop the stream, for example on request of the user. Use sudo because the stream can be started by another user.
+    def stop(self):
+        if self.enabled:
+            own_util.runShellCommandWait('sudo killall mjpg_streamer')
+            logging.getLogger("MyLog").info('stream manager: stream stopped')
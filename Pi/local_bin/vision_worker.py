@@ -0,0 +1,402 @@
+#!/usr/bin/python
+import time
+import mmap
+import signal
+import logging
+import argparse
+import multiprocessing
+import cv2
+import capture
+import motion
+import docking
+
+
+# Global constants.
+NofSlots = 4                # Number of frames which can be in the vision process at the same time.
+SlotSize = 512 * 1024       # Maximum size in bytes of a JPEG frame, an 800 * 600 frame from the stream is about 100 kB.
+ResultTimeout = 2.0         # Maximum time in seconds to wait for the result of a frame.
+
+
+# Returns a cv2.KeyPoint as a tuple (x, y, size), which can be sent through the pipe, or None.
+def packBlob(blob):
+    if blob is None:
+        return None
+    return (blob.pt[0], blob.pt[1], blob.size)
+
+
+def unpackBlob(packedBlob):
+    if packedBlob is None:
+        return None
+    return cv2.KeyPoint(packedBlob[0], packedBlob[1], packedBlob[2])
+
+
+# The vision process. It receives the frames through the shared memory and the commands through the pipe:
+#   ('create', width, height, scale, engine, learningRate): create a new motion detector.
+#   ('detect', slot, seq, length, timestamp):                detect motion on the frame in the slot.
+#   ('reset',):                                              reset the background model.
+#   ('resetcount',):                                         reset the number of consecutive motions.
+#   ('createmarker', width, height, doPrint):                create a new docking marker detector.
+#   ('detectmarker', slot, seq, length, timestamp):          detect the docking marker on the frame in the slot.
+#   ('resetmarker',):                                        search the next frame for the marker without region of interest.
+#   None:                                                    stop the process.
+# For every frame it sends back a compact result, the frame itself is never copied back.
+def visionProcess(conn, sharedMemory):
+    # Ctrl-C is handled by the main process, which stops this process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    motionDetector = None
+    markerDetector = None
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        try:
+            if msg[0] == 'create':
+                motionDetector = motion.MotionDetector(*msg[1:])
+            elif msg[0] == 'reset':
+                motionDetector.reset()
+            elif msg[0] == 'resetcount':
+                motionDetector.resetMotionCount()
+            elif msg[0] == 'detect':
+                (slot, seq, length, timestamp) = msg[1:]
+                jpg = sharedMemory[slot * SlotSize:slot * SlotSize + length]
+                motionInImage = motionDetector.detect(capture.Frame(seq, jpg, timestamp))
+                conn.send(('result', slot, seq, motionInImage, motionDetector.boxes, motionDetector.box, motionDetector.nofContours,
+                           motionDetector.noOfConsecutiveMotions, motionDetector.timings,
+                           (motionDetector.pool.nofBytes, motionDetector.pool.nofAllocations, motion.getRss())))
+            elif msg[0] == 'createmarker':
+                markerDetector = docking.MarkerDetector(*msg[1:])
+            elif msg[0] == 'resetmarker':
+                markerDetector.reset()
+            elif msg[0] == 'detectmarker':
+                (slot, seq, length, timestamp) = msg[1:]
+                jpg = sharedMemory[slot * SlotSize:slot * SlotSize + length]
+                marker = markerDetector.detect(capture.decodeGray(jpg, 1))
+                if marker is not None:
+                    markerBlobs = [packBlob(marker.blobLeft), packBlob(marker.blobMiddle), packBlob(marker.blobRight)]
+                else:
+                    markerBlobs = None
+                conn.send(('result', slot, seq, [packBlob(blob) for blob in markerDetector.blobs], markerBlobs, markerDetector.detectionTime,
+                           (markerDetector.nofImages, markerDetector.nofLocks, markerDetector.nofLosses, markerDetector.nofRoiSearches,
+                            markerDetector.nofFullSearches, markerDetector.totalDetectionTime, motion.getRss())))
+        except Exception,e:
+            if msg[0] in ['detect', 'detectmarker']:
+                conn.send(('error', msg[1], msg[2], str(e)))
+    conn.close()
+
+
+# The VisionWorker runs the frame decoding, the motion detection and the docking marker detection in a separate process,
+# so they do not compete under the GIL with the websocket server, the Telegram client, the audio filtering and the status thread.
+# The JPEG frames are written into a ring of slots in shared memory, only the slot, the sequence number, the length
+# and the timestamp are sent through the pipe.
+# Start the worker before other threads are started, the process is forked and a fork only copies the calling thread.
+# For the same reason a vision process which stops is not started again: the remote detectors detect in this process
+# from then on, see isAlive().
+class VisionWorker(object):
+    def __init__(self):
+        self.sharedMemory = mmap.mmap(-1, NofSlots * SlotSize)
+        (self.conn, childConn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target = visionProcess, args = (childConn, self.sharedMemory))
+        self.process.daemon = True
+        self.process.start()
+        childConn.close()
+        self.nextSlot = 0
+        self.pending = {}           # Sequence number of the frame in each busy slot.
+        self.nofFrames = 0
+        self.nofDropped = 0         # Frames not analysed because all slots were busy or the frame was too large.
+        self.nofTimeouts = 0
+        self.alive = True
+        logging.getLogger("MyLog").info('vision worker: started process ' + str(self.process.pid))
+
+    # Returns False when the vision process stopped, for example because it crashed or was killed.
+    def isAlive(self):
+        if self.alive and not self.process.is_alive():
+            self.alive = False
+            self.pending.clear()
+            logging.getLogger("MyLog").info('vision worker: process ' + str(self.process.pid) + ' stopped, exit code ' + str(self.process.exitcode) +
+                                            ', detecting in this process from now on')
+        return self.alive
+
+    def createMotionDetector(self, width, height, scale = motion.AnalysisScale, engine = motion.BackgroundEngine, learningRate = motion.LearningRate):
+        return RemoteMotionDetector(self, width, height, scale, engine, learningRate)
+
+    def createMarkerDetector(self, width, height, doPrint = False):
+        return RemoteMarkerDetector(self, width, height, doPrint)
+
+    # Write the frame in a free slot and send it to the vision process with the detect command.
+    # Returns the slot, or None when the frame is dropped.
+    def submit(self, frame, command = 'detect'):
+        if not self.isAlive():
+            return None
+        if len(frame.jpg) > SlotSize:
+            self.nofDropped += 1
+            return None
+        for i in range(NofSlots):
+            slot = (self.nextSlot + i) % NofSlots
+            if slot not in self.pending:
+                break
+        else:
+            self.nofDropped += 1
+            return None
+        self.nextSlot = (slot + 1) % NofSlots
+        self.sharedMemory[slot * SlotSize:slot * SlotSize + len(frame.jpg)] = frame.jpg
+        self.pending[slot] = frame.seq
+        if not self.send((command, slot, frame.seq, len(frame.jpg), frame.timestamp)):
+            self.pending.pop(slot, None)
+            return None
+        self.nofFrames += 1
+        return slot
+
+    # Wait for the result of the frame in this slot. Results of earlier frames which timed out are discarded.
+    # Returns the result tuple, or None on a timeout or an error.
+    def collect(self, slot, timeout = ResultTimeout):
+        seq = self.pending.get(slot)
+        endTime = time.time() + timeout
+        try:
+            while self.conn.poll(max(endTime - time.time(), 0)):
+                result = self.conn.recv()
+                # The slot is only freed when it holds the frame of the result.
+                if self.pending.get(result[1]) == result[2]:
+                    del self.pending[result[1]]
+                if result[0] == 'error':
+                    logging.getLogger("MyLog").info('vision worker: exception: ' + result[3])
+                if result[1] == slot and result[2] == seq:
+                    return result if result[0] == 'result' else None
+        except Exception,e:
+            # The pipe is closed when the vision process stopped.
+            logging.getLogger("MyLog").info('vision worker: receive exception: ' + str(e))
+        self.nofTimeouts += 1
+        self.isAlive()
+        return None
+
+    # Send a command to the vision process. Returns False when it could not be sent.
+    def send(self, msg):
+        if not self.alive:
+            return False
+        try:
+            self.conn.send(msg)
+        except Exception,e:
+            logging.getLogger("MyLog").info('vision worker: send exception: ' + str(e))
+            self.isAlive()
+            return False
+        return True
+
+    def stop(self):
+        self.send(None)
+        self.process.join(1.0)
+
+
+# The buffer pool statistics of the motion detector in the vision process, see motion.BufferPool.
+class RemotePoolStats(object):
+    def __init__(self):
+        self.nofBytes = 0
+        self.nofAllocations = 0
+
+
+# Drop-in replacement of motion.MotionDetector which detects the motion in the vision process.
+# Only the results are available, the background model stays in the vision process.
+# When the vision process stopped, a motion.MotionDetector in this process takes over with a new background model.
+class RemoteMotionDetector(object):
+    def __init__(self, worker, width, height, scale, engine, learningRate):
+        self.worker = worker
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.engine = engine
+        self.learningRate = learningRate
+        self.local = None           # The motion detector in this process, when the vision process stopped.
+        self.countUnknown = False   # True when the count of consecutive motions of the vision process may differ from noOfConsecutiveMotions.
+        self.pool = RemotePoolStats()
+        self.rss = 0                # Resident set size in bytes of the vision process.
+        self.timings = {}
+        self.worker.send(('create', width, height, scale, engine, learningRate))
+        self._clear()
+
+    def _clear(self):
+        self.noOfConsecutiveMotions = 0
+        self.nofContours = 0
+        self.boxes = []
+        self.box = None
+
+    # Returns the motion detector in this process when the vision process stopped, else None.
+    def _getLocal(self):
+        if self.local is None and not self.worker.isAlive():
+            self.local = motion.MotionDetector(self.width, self.height, self.scale, self.engine, self.learningRate)
+            self.pool = self.local.pool
+        return self.local
+
+    def reset(self):
+        if self._getLocal() is not None:
+            self.local.reset()
+        else:
+            self.worker.send(('reset',))
+            self.countUnknown = False
+        self._clear()
+
+    # The vision process is only sent a reset when its count can be nonzero. skip() calls this for every frame of a
+    # static scene, which is most frames at night.
+    def resetMotionCount(self):
+        if self._getLocal() is not None:
+            self.local.resetMotionCount()
+        elif self.noOfConsecutiveMotions > 0 or self.countUnknown:
+            self.worker.send(('resetcount',))
+            self.countUnknown = False
+        self.noOfConsecutiveMotions = 0
+
+    def skip(self):
+        self.boxes = []
+        self.box = None
+        self.timings = {}
+        self.resetMotionCount()
+
+    # Returns True when there is true motion, like motion.MotionDetector.detect().
+    # A frame which is dropped or times out has no motion, the count of consecutive motions is kept.
+    def detect(self, frame):
+        if self._getLocal() is not None:
+            motionInImage = self.local.detect(frame)
+            (self.boxes, self.box, self.nofContours, self.noOfConsecutiveMotions, self.timings, self.rss) = \
+                (self.local.boxes, self.local.box, self.local.nofContours, self.local.noOfConsecutiveMotions, self.local.timings, motion.getRss())
+            return motionInImage
+        self.boxes = []
+        self.box = None
+        self.timings = {}
+        slot = self.worker.submit(frame)
+        if slot is None:
+            return False
+        # The pipe read releases the GIL, the other threads run while the vision process analyses the frame.
+        result = self.worker.collect(slot)
+        if result is None:
+            # The vision process may still analyse the frame and count it.
+            self.countUnknown = True
+            return False
+        self.countUnknown = False
+        (motionInImage, self.boxes, self.box, self.nofContours, self.noOfConsecutiveMotions, self.timings,
+         (self.pool.nofBytes, self.pool.nofAllocations, self.rss)) = result[3:]
+        return motionInImage
+
+
+# Drop-in replacement of docking.MarkerDetector which detects the marker in the vision process.
+# detect() takes the frame instead of the grayscale image, the frame is decoded in the vision process.
+# submit() and collect() are the two halves of detect(), so the Home run can decode the color image for its video
+# while the vision process detects the marker on the same frame.
+# A frame which is dropped or times out has no marker, like a frame in which the marker is not found.
+# When the vision process stopped, a docking.MarkerDetector in this process takes over.
+class RemoteMarkerDetector(object):
+    def __init__(self, worker, width, height, doPrint):
+        self.worker = worker
+        self.width = width
+        self.height = height
+        self.doPrint = doPrint
+        self.local = None           # The marker detector in this process, when the vision process stopped.
+        self.frame = None           # The submitted frame, only kept for the marker detector in this process.
+        self.marker = None
+        self.blobs = []
+        self.detectionTime = 0
+        self.nofImages = 0
+        self.nofLocks = 0
+        self.nofLosses = 0
+        self.nofRoiSearches = 0
+        self.nofFullSearches = 0
+        self.totalDetectionTime = 0
+        self.rss = 0                # Resident set size in bytes of the vision process.
+        self.slot = None            # Slot of the submitted frame.
+        self.worker.send(('createmarker', width, height, doPrint))
+
+    # Returns the marker detector in this process when the vision process stopped, else None.
+    def _getLocal(self):
+        if self.local is None and not self.worker.isAlive():
+            self.local = docking.MarkerDetector(self.width, self.height, self.doPrint)
+        return self.local
+
+    def reset(self):
+        if self._getLocal() is not None:
+            self.local.reset()
+        else:
+            self.worker.send(('resetmarker',))
+        self.marker = None
+        self.blobs = []
+
+    def submit(self, frame):
+        if self._getLocal() is not None:
+            self.frame = frame
+        else:
+            self.slot = self.worker.submit(frame, 'detectmarker')
+
+    # Wait for the result of the submitted frame. Returns the Marker or None.
+    def collect(self):
+        self.marker = None
+        self.blobs = []
+        self.detectionTime = 0
+        if self.local is not None and self.frame is not None:
+            local = self.local
+            self.marker = local.detect(self.frame.gray(1))
+            self.frame = None
+            (self.blobs, self.detectionTime, self.nofImages, self.nofLocks, self.nofLosses, self.nofRoiSearches, self.nofFullSearches,
+             self.totalDetectionTime, self.rss) = (local.blobs, local.detectionTime, local.nofImages, local.nofLocks, local.nofLosses,
+                                                   local.nofRoiSearches, local.nofFullSearches, local.totalDetectionTime, motion.getRss())
+            return self.marker
+        if self.slot is None:
+            return None
+        result = self.worker.collect(self.slot)
+        self.slot = None
+        if result is None:
+            return None
+        (blobs, markerBlobs, self.detectionTime, (self.nofImages, self.nofLocks, self.nofLosses, self.nofRoiSearches,
+         self.nofFullSearches, self.totalDetectionTime, self.rss)) = result[3:]
+        self.blobs = [unpackBlob(blob) for blob in blobs]
+        if markerBlobs is not None:
+            self.marker = docking.Marker(*[unpackBlob(blob) for blob in markerBlobs])
+        return self.marker
+
+    def detect(self, frame):
+        self.submit(frame)
+        return self.collect()
+
+
+# Log the statistics of the vision process, detector is a RemoteMotionDetector or a RemoteMarkerDetector.
+def logMetrics(detector):
+    worker = detector.worker
+    logging.getLogger("MyLog").info('vision worker: frames ' + str(worker.nofFrames) + ', dropped ' + str(worker.nofDropped) +
+                                    ', timeouts ' + str(worker.nofTimeouts) + ', process rss ' + str(detector.rss) + ' bytes')
+
+
+# The code below is used when this script is run as a separate python script.
+# It runs the motion detection over recorded images in this process and in the vision process and prints the latency per
+# frame, while a busy thread, like the websocket server or the audio filtering, runs next to it.
+if __name__ == '__main__':
+    import thread
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='/home/pi/DFRobotUploads/benchmark')
+    parser.add_argument('--busy', action='store_true')
+    args = parser.parse_args()
+
+    names, jpgs = motion.loadJpgs(args.dir)
+    (height, width) = capture.decodeGray(jpgs[0], 1).shape
+
+    busyCount = [0]
+    def busyThread():
+        while True:
+            busyCount[0] += 1
+    if args.busy:
+        thread.start_new_thread(busyThread, ())
+
+    # Start the worker first, see VisionWorker.
+    worker = VisionWorker()
+    for name in ['thread', 'process']:
+        if name == 'thread':
+            motionDetector = motion.MotionDetector(width, height)
+        else:
+            motionDetector = worker.createMotionDetector(width, height)
+        latencies = []
+        nofMotions = 0
+        busyStart = busyCount[0]
+        startTime = time.time()
+        for seq in range(len(jpgs)):
+            frameStartTime = time.time()
+            if motionDetector.detect(capture.Frame(seq, jpgs[seq], frameStartTime)):
+                nofMotions += 1
+            latencies.append(time.time() - frameStartTime)
+        duration = time.time() - startTime
+        latencies.sort()
+        print name + ':', len(jpgs), 'frames,', round(len(jpgs) / duration, 1), 'frames/s, latency p50', round(latencies[len(latencies) / 2] * 1000, 1), \
+              'ms, max', round(latencies[-1] * 1000, 1), 'ms, motions', nofMotions, ', busy thread', int((busyCount[0] - busyStart) / duration), 'loops/s'
+    worker.stop()